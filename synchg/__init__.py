@@ -1,4 +1,13 @@
 
-from .sync import SyncRemote
+
+def SyncRemote(*args, **kwargs):
+    '''
+    Syncs a remote repository.  See :func:`synchg.sync.SyncRemote`.
+
+    The sync module (and plumbum) is only imported when this is called, so
+    that importing synchg is cheap.
+    '''
+    from .sync import SyncRemote
+    return SyncRemote(*args, **kwargs)
 
 __version__ = '1.0.0'
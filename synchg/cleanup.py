@@ -0,0 +1,165 @@
+'''
+This module provides garbage collection of the files that synchg leaves
+behind on remote machines: strip backup bundles, stale synchg-commit
+changesets in mq repositories, and repositories whose local counterpart has
+been deleted.
+
+All the work for a remote is done by a single shell script that's fed to
+``sh`` on the remote, so garbage collection takes one remote invocation no
+matter how many repositories are involved.
+'''
+
+from collections import namedtuple
+
+__all__ = ['BackupRetention', 'CollectGarbage', 'PruneBackups']
+
+
+# Describes how many strip backups should be kept.  A value of 0 means no
+# limit.
+#   keep:       The number of backups to keep
+#   max_age:    The maximum age of a backup in days
+#   max_size:   The maximum total size of the backups in megabytes
+BackupRetention = namedtuple(
+        'BackupRetention', ['keep', 'max_age', 'max_size']
+        )
+
+# Revset matching synchg-commit changesets in an mq repository that are not
+# ancestors of it's working directory.  These are left behind when the mq
+# history is rewritten locally.  It's only used when the working directory
+# isn't at null, as every synchg-commit changeset would match otherwise
+StaleMqRevset = "desc('synchg-commit') and not ::."
+
+_Functions = r'''
+prune_backups() {
+    dir="$1"
+    [ -d "$dir" ] || return 0
+    if [ "$MAX_AGE" -gt 0 ]; then
+        for f in $(find "$dir" -name '*.hg' -mtime +"$MAX_AGE"); do
+            rm -f "$f" && echo "removed $f"
+        done
+    fi
+    count=0
+    total=0
+    for f in $(ls -1t "$dir" | grep '\.hg$'); do
+        count=$((count + 1))
+        total=$((total + $(wc -c < "$dir/$f")))
+        if [ "$KEEP" -gt 0 -a "$count" -gt "$KEEP" ] ||
+           [ "$MAX_SIZE" -gt 0 -a "$total" -gt "$MAX_SIZE" ]; then
+            rm -f "$dir/$f" && echo "removed $dir/$f"
+        fi
+    done
+}
+
+strip_stale_mq() {
+    mq="$1.hg/patches"
+    [ -d "$mq/.hg" ] || return 0
+    parent=$("$HG" -R "$mq" log -r . --template '{rev}') || return 0
+    [ -n "$parent" -a "$parent" != "-1" ] || return 0
+    # A forced push of squashed history leaves the working directory on the
+    # old history, and the new history would be stripped in it's place.  So
+    # move to the newest changeset first, unless there are changes to lose
+    tip=$("$HG" -R "$mq" log -r tip --template '{rev}') || return 0
+    if [ "$tip" != "$parent" ]; then
+        "$HG" -R "$mq" update -c tip >/dev/null || return 0
+    fi
+    stale=$("$HG" -R "$mq" log -r "$STALE" --template '{node}\n')
+    if [ -n "$stale" ]; then
+        "$HG" -R "$mq" strip -r "$STALE" >/dev/null &&
+            echo "stripped $(echo "$stale" | wc -l) from $mq"
+    fi
+}
+'''
+
+_Header = '''
+KEEP={retention.keep:d}
+MAX_AGE={retention.max_age:d}
+MAX_SIZE=$(({retention.max_size:d} * 1024 * 1024))
+HG={hg}
+STALE="{stale}"
+'''
+
+_GcBody = '''
+cd {root} || exit 1
+for repo in */; do
+    [ -d "${{repo}}.hg" ] || continue
+    prune_backups "${{repo}}.hg/strip-backup"
+    prune_backups "${{repo}}.hg/patches/.hg/strip-backup"
+    strip_stale_mq "$repo"
+done
+'''
+
+_OrphanLine = 'rm -rf {0} && echo deleted {0}\n'
+
+
+def _Quote(text):
+    ''' Quotes a string for use in the gc shell script '''
+    return "'" + str(text).replace("'", "'\\''") + "'"
+
+
+def _QuotePath(path):
+    ''' Quotes a path for the gc shell script, expanding any leading ~ '''
+    path = str(path)
+    if path == '~':
+        return '"$HOME"'
+    if path.startswith('~/'):
+        return '"$HOME"/' + _Quote(path[2:])
+    return _Quote(path)
+
+
+def _Script(retention, hg, body):
+    return (
+            _Header.format(
+                retention=retention, hg=_Quote(hg), stale=StaleMqRevset
+                ) +
+            _Functions +
+            body
+            )
+
+
+def _Run(machine, script):
+    '''
+    Runs a script on a machine with a single invocation of sh
+
+    :returns:   A list of the lines output by the script
+    '''
+    return (machine['sh'] << script)().splitlines()
+
+
+def PruneBackups(machine, repo_path, retention):
+    '''
+    Removes strip backups from a single repository according to a
+    retention policy
+
+    :param machine:     The plumbum machine the repository is on
+    :param repo_path:   The path to the repository
+    :param retention:   A :class:`BackupRetention`
+    :returns:           A list of lines describing what was removed
+    '''
+    body = (
+            'cd {0} || exit 1\n'
+            'prune_backups .hg/strip-backup\n'
+            'prune_backups .hg/patches/.hg/strip-backup\n'
+            ).format(_QuotePath(repo_path))
+    return _Run(machine, _Script(retention, 'hg', body))
+
+
+def CollectGarbage(machine, remote_root, retention, orphans=(), hg='hg'):
+    '''
+    Collects garbage from every repository under a remote root.  This prunes
+    strip backups, strips stale synchg-commit changesets from mq repositories
+    and deletes any orphaned repositories.
+
+    :param machine:     The plumbum machine to collect garbage on
+    :param remote_root: The path to the directory containing the repositories
+    :param retention:   A :class:`BackupRetention`
+    :param orphans:     The names of repositories under remote_root that
+                        should be deleted
+    :param hg:          The hg executable to use on the machine
+    :returns:           A list of lines describing what was removed
+    '''
+    body = _GcBody.format(root=_QuotePath(remote_root))
+    for name in orphans:
+        if not name or '/' in name or name.startswith('.'):
+            raise ValueError('Invalid repository name: {0!r}'.format(name))
+        body += _OrphanLine.format(_Quote(name))
+    return _Run(machine, _Script(retention, hg, body))
@@ -0,0 +1,196 @@
+'''
+This module provides the events that a sync reports as it runs.  Events are
+emitted on an :class:`EventBus`, which passes them to each of it's
+subscribers.  :class:`ConsoleSubscriber` prints the familiar synchg output,
+and :class:`JsonLinesSubscriber` writes each event as a line of JSON for
+other programs to consume.
+'''
+
+import sys
+import json
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+__all__ = [
+        'SyncStarted', 'SyncFinished', 'PhaseStarted', 'PhaseFinished',
+        'Notice', 'ChangesetsStripped', 'ChangesetsPushed', 'PatchApplied',
+        'BytesSent', 'CommandRun', 'EventBus', 'ConsoleSubscriber',
+        'JsonLinesSubscriber'
+        ]
+
+# A sync of a project to a host has started
+SyncStarted = namedtuple('SyncStarted', ['host', 'name'])
+
+# A sync has finished.  Outcome is one of ok, coalesced (skipped as a newer
+# sync of the same repository was queued), abort (the user chose not to
+# continue), error (a SyncError) or failed (any other exception)
+SyncFinished = namedtuple(
+        'SyncFinished', ['host', 'name', 'duration', 'outcome']
+        )
+
+# A phase of a sync has started
+PhaseStarted = namedtuple('PhaseStarted', ['phase'])
+
+# A phase of a sync has finished.  ok is False if it raised an exception
+PhaseFinished = namedtuple('PhaseFinished', ['phase', 'duration', 'ok'])
+
+# An informational message
+Notice = namedtuple('Notice', ['text'])
+
+# Changesets were removed from the remote.  If obsolete is True they were
+# hidden with obsolescence markers rather than stripped
+ChangesetsStripped = namedtuple(
+        'ChangesetsStripped', ['changesets', 'obsolete']
+        )
+
+# Changesets were pushed to the remote
+ChangesetsPushed = namedtuple('ChangesetsPushed', ['changesets'])
+
+# An mq patch was applied on the remote
+PatchApplied = namedtuple('PatchApplied', ['patch'])
+
+# Data was sent to the remote by synchg itself.  What describes the data
+BytesSent = namedtuple('BytesSent', ['what', 'size'])
+
+# A command was run by a repository
+#   argv:       The command line, as a list of strings
+#   machine:    local, or the name of the remote machine
+#   cwd:        The working directory of the command
+#   duration:   How long the command took to run, in seconds
+#   retcode:    The exit code of the command
+#   outputSize: The number of bytes the command wrote to stdout, or None if
+#               this isn't known
+#   remote:     True if the command ran on, or connected to, a remote machine
+CommandRun = namedtuple(
+        'CommandRun',
+        ['argv', 'machine', 'cwd', 'duration', 'retcode', 'outputSize',
+         'remote']
+        )
+
+
+class EventBus(object):
+    '''
+    Passes events to subscribers
+    '''
+
+    def __init__(self, subscribers=None):
+        '''
+        :param subscribers: An optional list of functions that take an event
+        '''
+        self._subscribers = list(subscribers or [])
+
+    def Subscribe(self, subscriber):
+        '''
+        Adds a subscriber
+
+        :param subscriber:  A function that takes an event
+        '''
+        self._subscribers.append(subscriber)
+
+    def Emit(self, event):
+        '''
+        Passes an event to every subscriber, in the order they subscribed
+        '''
+        for subscriber in self._subscribers:
+            subscriber(event)
+
+    @contextmanager
+    def Phase(self, phase):
+        '''
+        A context manager that emits :class:`PhaseStarted` on entry and
+        :class:`PhaseFinished` on exit
+
+        :param phase:   The name of the phase
+        '''
+        self.Emit(PhaseStarted(phase))
+        start = time.time()
+        try:
+            yield
+        except:
+            self.Emit(PhaseFinished(phase, time.time() - start, False))
+            raise
+        self.Emit(PhaseFinished(phase, time.time() - start, True))
+
+
+class ConsoleSubscriber(object):
+    '''
+    Prints events for a person to read
+    '''
+
+    # What is printed when each phase starts.  Other phases are silent
+    PhaseMessages = {
+            'clone': 'Cloning repository to remote',
+            'sparse': 'Applying sparse profile to remote',
+            'push': 'Pushing to remote',
+            'update': 'Updating remote',
+            'mq-delta': 'Syncing mq patches',
+            'mq-repo': 'Syncing mq repos',
+            'mq-update': 'Updating remote mq repo',
+            'uncommitted': 'Applying uncommitted changes to remote',
+            }
+
+    def __init__(self, stream=None):
+        '''
+        :param stream:  The stream to print to.  Defaults to stdout
+        '''
+        self._stream = stream or sys.stdout
+
+    def __call__(self, event):
+        line = self.Format(event)
+        if line is not None:
+            self._stream.write(line + '\n')
+
+    def Format(self, event):
+        '''
+        Formats an event
+
+        :param event:   The event
+        :returns:       A line of text, or None if the event isn't printed
+        '''
+        if isinstance(event, SyncStarted):
+            return 'Sync {0} -> {1}'.format(event.name, event.host)
+        if isinstance(event, SyncFinished):
+            return 'Ok!' if event.outcome == 'ok' else None
+        if isinstance(event, PhaseStarted):
+            return self.PhaseMessages.get(event.phase)
+        if isinstance(event, Notice):
+            return event.text
+        if isinstance(event, ChangesetsStripped):
+            return '{0} {1} changesets on remote'.format(
+                    'Hid' if event.obsolete else 'Stripped',
+                    len(event.changesets)
+                    )
+        return None
+
+
+def _JsonValue(value):
+    ''' Converts the fields of an event to something JSON serialisable '''
+    if hasattr(value, 'hash'):
+        # Changesets are identified by their hash
+        return value.hash
+    if isinstance(value, (list, tuple)):
+        return [_JsonValue(item) for item in value]
+    return value
+
+
+class JsonLinesSubscriber(object):
+    '''
+    Writes each event as a line of JSON, containing the name of the event,
+    the time it was emitted and it's fields
+    '''
+
+    def __init__(self, stream, clock=time.time):
+        '''
+        :param stream:  The stream to write to
+        :param clock:   The function used to get the time
+        '''
+        self._stream = stream
+        self._clock = clock
+
+    def __call__(self, event):
+        record = {'event': type(event).__name__, 'time': self._clock()}
+        for name, value in event._asdict().iteritems():
+            record[name] = _JsonValue(value)
+        self._stream.write(json.dumps(record, sort_keys=True) + '\n')
+        self._stream.flush()
@@ -0,0 +1,377 @@
+'''
+This module syncs a repository to a fleet of hosts at once.  A fleet is
+listed in a ``fleet:<name>`` section of config.ini::
+
+    [fleet:ci]
+    hosts = ci01 ci02 ci03
+    concurrency = 8
+
+Each host is synced in it's own process, so that a host that hangs can be
+killed once it's deadline passes.  A killed sync is first asked to stop, so
+that it releases it's lease and locks, and then it's killed along with the
+hg & ssh processes it started.  Hosts that fail with an ssh error are
+retried with backoff, and the outcome of each host is reported in a table
+at the end.  Hosts are synced without prompting: any questions their policy
+says to ask are asked once for the whole fleet, before the syncs start.
+
+The syncs take turns to read & change the mq state of the local working
+copy (see :meth:`synchg.repo.Repo.LockWorkingCopy`), so one host's sync
+doesn't refresh or commit patches from under another's.  Nothing pops the
+local patches, so discovery, pushes and remote updates run in parallel.
+'''
+
+import os
+import re
+import sys
+import time
+import signal
+import socket
+import multiprocessing
+from collections import namedtuple, deque
+from plumbum import local
+from plumbum.commands import ProcessExecutionError
+from plumbum.session import ShellSessionError
+from sync import SyncRemote, SyncError, AbortException
+from events import EventBus, ConsoleSubscriber, SyncFinished
+from repo import RepoConfig
+from policy import Policy, PolicyError, AskUpFront
+
+__all__ = ['FleetResult', 'FleetHosts', 'SyncFleet', 'FormatSummary']
+
+# The number of hosts synced at once, unless the fleet sets concurrency
+DefaultConcurrency = 8
+
+# The number of seconds between checks on running syncs
+_PollInterval = 0.2
+
+# The number of seconds a killed sync has to clean up before it's killed
+# outright
+_KillGrace = 10
+
+# Matches the errors ssh reports when it can't connect to a host, or loses
+# the connection.  hg reports these with a "remote: " prefix
+_SshErrorRegexp = re.compile(
+        r'ssh: connect to host|ssh: Could not resolve hostname|'
+        r'Connection (timed out|refused|reset|closed)|'
+        r'Network is unreachable|No route to host'
+        )
+
+# The policy questions that a sync can ask, and so are asked up front
+_SyncQuestions = ('clone', 'refresh', 'ignore-changes', 'strip')
+
+# The result of syncing a host
+#   outcome:    ok, coalesced, abort, error (a SyncError), failed (any
+#               other exception) or timeout
+#   attempts:   The number of times the host was tried
+#   duration:   The number of seconds from the first attempt to the end
+#   message:    A description of the error, if any
+FleetResult = namedtuple(
+        'FleetResult', ['host', 'outcome', 'attempts', 'duration', 'message']
+        )
+
+
+def FleetHosts(config, fleet):
+    '''
+    Reads a fleet from the config
+
+    :param config:  A ConfigParser of config.ini
+    :param fleet:   The name of the fleet
+    :returns:       A tuple of the list of hosts, and the concurrency
+    :raises:        ValueError if there's no such fleet
+    '''
+    section = 'fleet:' + fleet
+    if not config.has_section(section) or \
+            not config.has_option(section, 'hosts'):
+        raise ValueError(
+                'No hosts for fleet {0} in [{1}]'.format(fleet, section)
+                )
+    concurrency = DefaultConcurrency
+    if config.has_option(section, 'concurrency'):
+        concurrency = config.getint(section, 'concurrency')
+    return config.get(section, 'hosts').split(), concurrency
+
+
+def _IsTransient(error):
+    '''
+    Checks if an exception is an ssh failure that may go away if retried
+    '''
+    if isinstance(error, (EOFError, socket.error, ShellSessionError)):
+        return True
+    paramiko = sys.modules.get('paramiko')
+    if paramiko and isinstance(error, paramiko.SSHException):
+        return True
+    # ssh exits with 255 when it can't connect, but so does hg whenever it
+    # aborts (even when run over ssh), so check what went wrong
+    return isinstance(error, ProcessExecutionError) and \
+            error.retcode == 255 and \
+            _SshErrorRegexp.search(error.stderr or '') is not None
+
+
+class _PrefixedStream(object):
+    '''
+    A stream that prefixes each line with the host it came from
+    '''
+
+    def __init__(self, host, stream):
+        self._prefix = host + ': '
+        self._stream = stream
+
+    def write(self, data):
+        lines = data.splitlines(True)
+        self._stream.write(''.join(self._prefix + line for line in lines))
+        self._stream.flush()
+
+    def flush(self):
+        self._stream.flush()
+
+
+class _Killed(BaseException):
+    '''
+    Raised in a worker when it's asked to stop.  It isn't an Exception, so
+    that it's only caught by the cleanup on the way out.
+    '''
+    pass
+
+
+def _Stop(signum, frame):
+    raise _Killed()
+
+
+def _RunWorker(target, *args):
+    '''
+    Runs a worker in a child process.  The worker gets it's own process
+    group, so that it can be killed along with the processes it starts, and
+    SIGTERM unwinds it rather than killing it outright.
+    '''
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    signal.signal(signal.SIGTERM, _Stop)
+    try:
+        target(*args)
+    except _Killed:
+        pass
+
+
+def _Worker(conn, host, name, localpath, remote_root, options):
+    '''
+    Syncs a single host, in a child process.  Sends a tuple of the outcome
+    and a message down a pipe.
+    '''
+    outcomes = []
+
+    def Record(event):
+        if isinstance(event, SyncFinished):
+            outcomes.append(event.outcome)
+
+    events = EventBus([
+            ConsoleSubscriber(_PrefixedStream(host, sys.stdout)), Record
+            ])
+    try:
+        SyncRemote(
+                host, name, local.path(localpath), remote_root, options,
+                None, events
+                )
+        result = (outcomes[-1] if outcomes else 'ok', '')
+    except SyncError as e:
+        result = ('error', str(e))
+    except AbortException:
+        result = ('abort', '')
+    except Exception as e:
+        outcome = 'transient' if _IsTransient(e) else 'failed'
+        result = (outcome, str(e) or type(e).__name__)
+    conn.send(result)
+    conn.close()
+
+
+class _Process(object):
+    '''
+    A sync of one host, running in a child process
+    '''
+
+    def __init__(self, host, name, localpath, remote_root, options,
+                 worker=_Worker):
+        self._conn, child = multiprocessing.Pipe(False)
+        self._process = multiprocessing.Process(
+                target=_RunWorker,
+                args=(worker, child, host, name, str(localpath), remote_root,
+                      options)
+                )
+        self._process.daemon = True
+        self._process.start()
+
+    def Done(self):
+        return not self._process.is_alive()
+
+    def Result(self):
+        ''' Gets the (outcome, message) of a finished sync '''
+        if self._conn.poll():
+            return self._conn.recv()
+        return ('failed', 'exited with {0}'.format(self._process.exitcode))
+
+    def Kill(self, grace=_KillGrace):
+        '''
+        Stops the sync.  It's asked to stop first, and given grace seconds
+        to clean up, then it and everything in it's process group are
+        killed.
+        '''
+        self._process.terminate()
+        self._process.join(grace)
+        if hasattr(os, 'killpg'):
+            try:
+                os.killpg(self._process.pid, signal.SIGKILL)
+            except OSError:
+                # Everything in the group has already exited
+                pass
+        self._process.join()
+
+
+class _Host(object):
+    ''' The progress of one host in a fleet sync '''
+
+    def __init__(self, host, options):
+        self.host = host
+        self.options = options
+        self.attempts = 0
+        self.started = None
+        self.nextTry = 0
+        self.process = None
+
+
+def SyncFleet(hosts, name, localpath, remote_root, optionsFor,
+              concurrency=DefaultConcurrency, ask=None, start=_Process,
+              clock=time.time, sleep=time.sleep):
+    '''
+    Syncs a repository to a fleet of hosts
+
+    :param hosts:       The list of hostnames to sync to
+    :param name:        The name of the project being synced
+    :param localpath:   A plumbum path to the local repository
+    :param remote_root: The path to the parent directory of the remote
+                        repositories
+    :param optionsFor:  A function that takes a hostname and returns the
+                        :class:`SyncOptions` for it
+    :param concurrency: The maximum number of hosts to sync at once
+    :param ask:         The function used to ask questions up front, as
+                        :func:`synchg.utils.yn`.  If None, questions the
+                        policy says to ask are errors
+    :param start:       The function used to start syncing a host
+    :param clock:       The function used to get the time
+    :param sleep:       The function used to wait
+    :returns:           A list of :class:`FleetResult`, in the order of
+                        hosts
+    '''
+    waiting = deque(_Host(host, optionsFor(host)) for host in hosts)
+    try:
+        policies = dict(
+                (entry.host, Policy(
+                    entry.options.policy, entry.options.interactive
+                    ))
+                for entry in waiting
+                )
+    except PolicyError as e:
+        raise SyncError(str(e))
+    if ask:
+        AskUpFront(policies, ask, _SyncQuestions)
+    for entry in waiting:
+        entry.options.policy = policies[entry.host].Rules()
+        entry.options.interactive = False
+    _AddRemotes(hosts, name, localpath, remote_root)
+    running = []
+    results = {}
+
+    def Finish(entry, outcome, message):
+        results[entry.host] = FleetResult(
+                entry.host, outcome, entry.attempts,
+                clock() - entry.started, message
+                )
+
+    while waiting or running:
+        now = clock()
+        for entry in list(waiting):
+            if len(running) >= concurrency:
+                break
+            if entry.nextTry > now:
+                continue
+            waiting.remove(entry)
+            if entry.started is None:
+                entry.started = now
+            entry.attempts += 1
+            entry.process = start(
+                    entry.host, name, localpath, remote_root, entry.options
+                    )
+            running.append(entry)
+        for entry in list(running):
+            options = entry.options
+            deadline = None
+            if options.sync_timeout:
+                deadline = entry.started + options.sync_timeout
+            if entry.process.Done():
+                running.remove(entry)
+                outcome, message = entry.process.Result()
+                if outcome != 'transient':
+                    Finish(entry, outcome, message)
+                    continue
+                backoff = options.retry_backoff * 2 ** (entry.attempts - 1)
+                retryAt = clock() + backoff
+                if entry.attempts > options.retries or \
+                        (deadline is not None and retryAt >= deadline):
+                    Finish(entry, 'failed', message)
+                else:
+                    entry.nextTry = retryAt
+                    waiting.append(entry)
+            elif deadline is not None and clock() >= deadline:
+                running.remove(entry)
+                entry.process.Kill()
+                Finish(
+                        entry, 'timeout',
+                        'Gave up after {0}s'.format(options.sync_timeout)
+                        )
+        if waiting or running:
+            sleep(_PollInterval)
+    return [results[host] for host in hosts]
+
+
+def _AddRemotes(hosts, name, localpath, remote_root):
+    '''
+    Adds every host as a remote of the local repositories, in one write per
+    hgrc.  The syncs would otherwise each add their own host, and overwrite
+    each other's changes.
+    '''
+    configs = [(RepoConfig(localpath), '')]
+    if (localpath / '.hg' / 'patches' / '.hg').exists():
+        configs.append(
+                (RepoConfig(localpath / '.hg' / 'patches'), '/.hg/patches')
+                )
+    for config, suffix in configs:
+        with config.Batch():
+            for host in hosts:
+                if host not in config.remotes:
+                    config.AddRemote(host, 'ssh://{0}/{1}/{2}{3}'.format(
+                        host, remote_root, name, suffix
+                        ))
+
+
+def FormatSummary(results):
+    '''
+    Formats the results of a fleet sync as a table
+
+    :param results: A list of :class:`FleetResult`
+    :returns:       A list of lines of text
+    '''
+    width = max([len('host')] + [len(result.host) for result in results])
+    row = '{0:<' + str(width) + '}  {1:<9}  {2:>8}  {3:>9}  {4}'
+    lines = [row.format('host', 'outcome', 'attempts', 'duration', '')]
+    for result in results:
+        lines.append(row.format(
+                result.host, result.outcome, result.attempts,
+                '{0:.1f}s'.format(result.duration), result.message
+                ).rstrip())
+    counts = {}
+    for result in results:
+        counts[result.outcome] = counts.get(result.outcome, 0) + 1
+    lines.append('')
+    lines.append(', '.join(
+            '{0} {1}'.format(count, outcome)
+            for outcome, count in sorted(counts.iteritems())
+            ))
+    return [line.rstrip() for line in lines]
@@ -0,0 +1,265 @@
+'''
+This module caches details of the environment on a remote host: the resolved
+paths of the commands synchg runs, the version of mercurial and the
+extensions it has enabled.  Looking these up on an ``SshMachine`` requires a
+remote round trip each time, so they are stored in the :class:`HostState`
+for the host and only looked up again when they expire, or when a cached
+command can no longer be found.
+'''
+
+import re
+import errno
+from plumbum.commands import ProcessExecutionError
+
+__all__ = ['HostEnvironment', 'ResolvedCommand', 'ReadConfig']
+
+# The default number of seconds that cached details are trusted for
+DefaultTtl = 24 * 60 * 60
+
+# The return code a shell uses when a command can't be found
+_NotFoundRetcode = 127
+
+_VersionRegexp = re.compile(r'\(version (?P<version>[^)]+)\)')
+
+
+def _NotFound(error):
+    '''
+    Checks if an exception means that a command couldn't be found
+    '''
+    if isinstance(error, ProcessExecutionError):
+        return error.retcode == _NotFoundRetcode
+    return isinstance(error, OSError) and error.errno == errno.ENOENT
+
+
+def ReadConfig(hg, section):
+    '''
+    Reads a section of mercurial's configuration
+
+    :param hg:      The hg command to use
+    :param section: The name of the section
+    :returns:       A dictionary of ``section.name`` to value
+    '''
+    try:
+        output = hg('config', section)
+    except ProcessExecutionError as e:
+        if e.retcode != 1:
+            raise
+        # 1 means the section is empty
+        return {}
+    config = {}
+    for line in output.splitlines():
+        if '=' in line:
+            name, value = line.split('=', 1)
+            config[name.strip()] = value
+    return config
+
+
+def _ParseVersion(text):
+    '''
+    Parses the output of ``hg version -q``
+
+    :returns:   A tuple of integers, or an empty tuple if the version couldn't
+                be parsed
+    '''
+    match = _VersionRegexp.search(text)
+    if not match:
+        return ()
+    version = []
+    for part in match.group('version').split('.'):
+        digits = re.match(r'\d+', part)
+        if not digits:
+            break
+        version.append(int(digits.group()))
+    return tuple(version)
+
+
+def _EnabledExtensions(config):
+    '''
+    Gets the enabled extensions from the extensions section of the config
+
+    :param config:  A dictionary returned by :func:`ReadConfig`
+    :returns:       A sorted list of the names of enabled extensions
+    '''
+    names = []
+    for key, value in config.iteritems():
+        if key.startswith('extensions.') and not value.startswith('!'):
+            # Extensions can be enabled as hgext.name or hgext/name
+            names.append(re.split(r'[./]', key)[-1])
+    return sorted(names)
+
+
+class HostEnvironment(object):
+    '''
+    Cached details of the environment on a host
+    '''
+
+    def __init__(self, machine, state, ttl=DefaultTtl):
+        '''
+        :param machine: The plumbum machine for the host
+        :param state:   The :class:`synchg.state.HostState` for the host
+        :param ttl:     The number of seconds that cached details can be
+                        used for.  If 0, nothing will be cached
+        '''
+        self.machine = machine
+        self._state = state
+        self._ttl = ttl
+
+    def _Cached(self, key, lookup):
+        '''
+        Gets a value from the cache, looking it up if it's missing or expired
+
+        :param key:     The key of the value in the host state
+        :param lookup:  A function that looks up the value
+        '''
+        if not self._ttl:
+            return lookup()
+        value = self._state.Get(key, ttl=self._ttl)
+        if value is None:
+            value = lookup()
+            self._state.Set(key, value)
+        return value
+
+    def Resolve(self, name):
+        '''
+        Gets the path of a command on the host
+
+        :param name:    The name of the command
+        :returns:       The path to the command as a string
+        '''
+        return self._Cached(
+                'path:' + name, lambda: str(self.machine.which(name))
+                )
+
+    def Invalidate(self, name):
+        '''
+        Removes the cached path of a command, and everything that was found
+        out by running it.
+
+        :param name:    The name of the command
+        '''
+        self._state.Delete('path:' + name)
+        if name == 'hg':
+            self._state.Delete('hg:version')
+            self._state.Delete('hg:extensions')
+            self._state.Delete('hg:ui')
+
+    def __getitem__(self, name):
+        '''
+        Gets a command on the host, using it's cached path
+
+        :param name:    The name of the command
+        :returns:       A :class:`ResolvedCommand`
+        '''
+        return ResolvedCommand(self, name)
+
+    @property
+    def hgVersion(self):
+        '''
+        Gets the version of mercurial on the host
+
+        :returns:   A tuple of integers, e.g. (4, 5, 3)
+        '''
+        return tuple(self._Cached(
+                'hg:version',
+                lambda: list(_ParseVersion(self['hg']('version', '-q')))
+                ))
+
+    @property
+    def hgExtensions(self):
+        '''
+        Gets the mercurial extensions that the user & system configuration
+        enable on the host
+
+        :returns:   A sorted list of extension names
+        '''
+        def Lookup():
+            return _EnabledExtensions(ReadConfig(self['hg'], 'extensions'))
+        return self._Cached('hg:extensions', Lookup)
+
+    def HasExtension(self, name, hg=None):
+        '''
+        Checks if an extension is enabled on the host.  If the cached
+        extensions don't include it they're forgotten, and the extension is
+        looked for again, as it may have been enabled since they were cached.
+
+        :param name:    The name of the extension
+        :param hg:      An optional hg command that runs in a repository.
+                        If given, the extension is looked for with it, so
+                        that extensions enabled in the repository's own hgrc
+                        are found too
+        '''
+        if name in self.hgExtensions:
+            return True
+        self._state.Delete('hg:extensions')
+        if hg is None:
+            return name in self.hgExtensions
+        return name in _EnabledExtensions(ReadConfig(hg, 'extensions'))
+
+    @property
+    def hgUiConfig(self):
+        '''
+        Gets the ui section of the user & system configuration on the host
+
+        :returns:   A dictionary of ``ui.name`` to value
+        '''
+        return self._Cached('hg:ui', lambda: ReadConfig(self['hg'], 'ui'))
+
+
+class ResolvedCommand(object):
+    '''
+    A command that is run from it's cached path.  If the command can't be found
+    the path is looked up again, and the command retried once.
+
+    This supports the parts of the plumbum command interface that synchg uses:
+    binding arguments with ``[]``, redirecting stdin with ``<<``, calling and
+    ``popen``.  ``popen`` can only be retried if starting the process fails
+    locally, as a remote command not being found isn't reported until the
+    process has finished.
+    '''
+
+    def __init__(self, env, name, args=(), stdin=None):
+        self._env = env
+        self._name = name
+        self._args = args
+        self._stdin = stdin
+
+    def _Command(self):
+        ''' Builds the plumbum command '''
+        command = self._env.machine[self._env.Resolve(self._name)]
+        if self._args:
+            command = command[self._args]
+        if self._stdin is not None:
+            command = command << self._stdin
+        return command
+
+    def _Run(self, func):
+        '''
+        Runs func with the plumbum command, retrying with a freshly resolved
+        command if it can't be found
+        '''
+        try:
+            return func(self._Command())
+        except (ProcessExecutionError, OSError) as e:
+            if not _NotFound(e):
+                raise
+        self._env.Invalidate(self._name)
+        return func(self._Command())
+
+    def __getitem__(self, args):
+        if not isinstance(args, tuple):
+            args = (args,)
+        return ResolvedCommand(
+                self._env, self._name, self._args + args, self._stdin
+                )
+
+    def __lshift__(self, data):
+        return ResolvedCommand(self._env, self._name, self._args, data)
+
+    def __call__(self, *args, **kwargs):
+        return self._Run(lambda command: command(*args, **kwargs))
+
+    def popen(self, args=(), **kwargs):
+        return self._Run(lambda command: command.popen(args, **kwargs))
+
+    def __str__(self):
+        return ' '.join([self._name] + [str(arg) for arg in self._args])
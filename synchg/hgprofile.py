@@ -0,0 +1,102 @@
+'''
+This module provides the lean profile for running hg.  Normally each hg
+command loads the user's full configuration, including extensions, pager and
+colour, which can be a large part of the startup time of a command.  The lean
+profile runs hg with ``HGPLAIN`` set and no configuration files other than the
+repository's own ``.hg/hgrc``, enabling only the extensions synchg needs and
+carrying over the few settings that affect what synchg does.
+'''
+
+__all__ = ['LeanProfile', 'ProfiledCommand']
+
+
+class LeanProfile(object):
+    '''
+    A controlled environment for running hg in
+    '''
+
+    # The environment variables set for each command.  An empty HGRCPATH
+    # stops hg reading any system or user configuration
+    Environment = {'HGPLAIN': '1', 'HGRCPATH': ''}
+
+    # The extensions synchg needs for every repository
+    Extensions = ['mq', 'strip']
+
+    # Settings that are carried over from the user's configuration
+    CarriedSettings = ['ui.username', 'ui.ssh', 'ui.remotecmd']
+
+    def __init__(self, uiConfig=None):
+        '''
+        :param uiConfig:    The ui section of the user's configuration, as
+                            returned by :func:`synchg.hgenv.ReadConfig`.  Any
+                            :attr:`CarriedSettings` it contains will be passed
+                            on to hg.
+        '''
+        uiConfig = uiConfig or {}
+        self.settings = [
+                (name, uiConfig[name])
+                for name in self.CarriedSettings if uiConfig.get(name)
+                ]
+
+    @property
+    def configArgs(self):
+        '''
+        Gets the ``--config`` arguments passed to every hg command
+
+        :returns:   A tuple of strings
+        '''
+        args = []
+        for name in self.Extensions:
+            args += ['--config', 'extensions.{0}='.format(name)]
+        for name, value in self.settings:
+            args += ['--config', '{0}={1}'.format(name, value)]
+        return tuple(args)
+
+    def Wrap(self, machine, hg):
+        '''
+        Makes an hg command run with this profile
+
+        :param machine: The plumbum machine the command runs on
+        :param hg:      The hg command
+        :returns:       A :class:`ProfiledCommand`
+        '''
+        return ProfiledCommand(machine, hg[self.configArgs], self.Environment)
+
+
+class ProfiledCommand(object):
+    '''
+    A command that is run with some extra environment variables set.  This
+    supports binding arguments with ``[]``, redirecting stdin with ``<<``,
+    calling and ``popen``, like the plumbum commands it wraps.
+    '''
+
+    def __init__(self, machine, command, environment):
+        '''
+        :param machine:     The plumbum machine the command runs on
+        :param command:     The command to wrap
+        :param environment: A dictionary of environment variables
+        '''
+        self._machine = machine
+        self._command = command
+        self._environment = environment
+
+    def __getitem__(self, args):
+        return ProfiledCommand(
+                self._machine, self._command[args], self._environment
+                )
+
+    def __lshift__(self, data):
+        return ProfiledCommand(
+                self._machine, self._command << data, self._environment
+                )
+
+    def __call__(self, *args, **kwargs):
+        with self._machine.env(**self._environment):
+            return self._command(*args, **kwargs)
+
+    def popen(self, args=(), **kwargs):
+        with self._machine.env(**self._environment):
+            return self._command.popen(args, **kwargs)
+
+    def __str__(self):
+        return str(self._command)
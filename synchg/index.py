@@ -0,0 +1,244 @@
+'''
+This module provides a persistent index of the changesets that are known to be
+present on each remote.  As synchg regards remotes as slaves that only it
+writes to, the index allows outgoing and incoming changesets to be calculated
+locally rather than by running discovery against the remote each time.
+'''
+
+import os
+import sqlite3
+from contextlib import closing
+from repo import Repo
+
+__all__ = ['RemoteIndex']
+
+
+class RemoteIndex(object):
+    '''
+    An index of the changesets present on a single remote repository.  The
+    index is stored as an sqlite database under ``.hg/synchg`` in the local
+    repository.
+
+    The index is only trusted if the heads it recorded match the current heads
+    of the remote repository, so it should be checked with :meth:`IsCurrent`
+    before use.
+    '''
+
+    FileName = 'index.sqlite'
+
+    Schema = [
+        '''CREATE TABLE IF NOT EXISTS changesets (
+               remote TEXT, node TEXT, p1 TEXT, p2 TEXT,
+               branch TEXT, desc TEXT,
+               PRIMARY KEY (remote, node)
+           )''',
+        '''CREATE TABLE IF NOT EXISTS heads (
+               remote TEXT, node TEXT,
+               PRIMARY KEY (remote, node)
+           )'''
+        ]
+
+    def __init__(self, localpath, remote):
+        '''
+        :param localpath:   A plumbum path to the local repository
+        :param remote:      The name of the remote that this index is for
+        '''
+        self.remote = remote
+        self._dir = str(localpath / '.hg' / 'synchg')
+        self._path = os.path.join(self._dir, self.FileName)
+        self._db = None
+
+    def _Connect(self):
+        ''' Returns a connection to the index database, creating if needed '''
+        if not self._db:
+            if not os.path.exists(self._dir):
+                os.makedirs(self._dir)
+            self._db = sqlite3.connect(self._path)
+            self._db.text_factory = str
+            with self._db:
+                for statement in self.Schema:
+                    self._db.execute(statement)
+        return self._db
+
+    def Close(self):
+        ''' Closes the index database '''
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    @property
+    def heads(self):
+        '''
+        Gets the remote heads that were recorded in the index
+
+        :returns:   A set of changeset hash strings
+        '''
+        with closing(self._Connect().execute(
+                'SELECT node FROM heads WHERE remote = ?', (self.remote,)
+                )) as cursor:
+            return set(row[0] for row in cursor)
+
+    def IsCurrent(self, remoteHeads):
+        '''
+        Checks if the index is up to date with the remote
+
+        :param remoteHeads: A list of the current remote head hashes
+        :returns:           True if the index can be used for discovery
+        '''
+        heads = self.heads
+        return bool(heads) and heads == set(remoteHeads)
+
+    def Changesets(self):
+        '''
+        Gets all the changesets recorded for the remote
+
+        :returns:   A dictionary of hash to :class:`Repo.ChangesetNodeInfo`
+        '''
+        with closing(self._Connect().execute(
+                'SELECT node, p1, p2, branch, desc FROM changesets '
+                'WHERE remote = ?', (self.remote,)
+                )) as cursor:
+            return dict(
+                    (row[0], Repo.ChangesetNodeInfo(*row)) for row in cursor
+                    )
+
+    def Rebuild(self, heads, changesets):
+        '''
+        Replaces the contents of the index
+
+        :param heads:       A list of the current remote head hashes
+        :param changesets:  A list of :class:`Repo.ChangesetNodeInfo` for every
+                            changeset on the remote
+        '''
+        db = self._Connect()
+        with db:
+            db.execute(
+                    'DELETE FROM changesets WHERE remote = ?', (self.remote,)
+                    )
+            self._Store(db, heads, changesets)
+
+    def Update(self, heads, added, removed):
+        '''
+        Updates the index after changesets have been pushed & stripped
+
+        :param heads:   A list of the current remote head hashes
+        :param added:   A list of :class:`Repo.ChangesetNodeInfo` that were
+                        pushed to the remote
+        :param removed: A list of hashes that were removed from the remote
+        '''
+        db = self._Connect()
+        with db:
+            db.executemany(
+                    'DELETE FROM changesets WHERE remote = ? AND node = ?',
+                    [(self.remote, node) for node in removed]
+                    )
+            self._Store(db, heads, added)
+
+    def Clear(self):
+        ''' Removes everything recorded for the remote '''
+        db = self._Connect()
+        with db:
+            db.execute(
+                    'DELETE FROM changesets WHERE remote = ?', (self.remote,)
+                    )
+            db.execute('DELETE FROM heads WHERE remote = ?', (self.remote,))
+
+    def _Store(self, db, heads, changesets):
+        db.execute('DELETE FROM heads WHERE remote = ?', (self.remote,))
+        db.executemany(
+                'INSERT INTO heads VALUES (?, ?)',
+                [(self.remote, node) for node in heads]
+                )
+        db.executemany(
+                'INSERT OR REPLACE INTO changesets VALUES (?, ?, ?, ?, ?, ?)',
+                [(self.remote,) + tuple(cs) for cs in changesets]
+                )
+
+    def FindChanges(self, local, revs, branches, incomingBranches=None):
+        '''
+        Calculates outgoing & incoming changesets using only the index and the
+        local repository.  This should only be called if :meth:`IsCurrent`
+        returns True.
+
+        :param local:       The local :class:`Repo`
+        :param revs:        The revisions (or revsets) that will be pushed
+        :param branches:    The branches that will be pushed.
+        :param incomingBranches: The branches to look for incoming changesets
+                            on.  Defaults to branches.
+        :returns:           A tuple of (outgoings, incomings).  Outgoings is a
+                            list of :class:`Repo.ChangesetNodeInfo`, incomings
+                            a list of :class:`Repo.ChangesetInfo`
+        '''
+        if incomingBranches is None:
+            incomingBranches = branches
+        known = self.Changesets()
+        heads = self.heads
+        present = _Present(local, heads)
+        common = _Ancestors(known, present)
+
+        # Anything not descended from a common head may have been stripped
+        # or rebased locally, so needs it's presence checked.
+        candidates = [
+                cs for cs in known.itervalues()
+                if cs.branch in incomingBranches and cs.hash not in common
+                ]
+        present |= _Present(local, [cs.hash for cs in candidates])
+        incomings = [
+                Repo.ChangesetInfo(cs.hash, cs.desc)
+                for cs in candidates if cs.hash not in present
+                ]
+
+        revset = '::({0})'.format(_PushRevset(revs, branches))
+        if present:
+            revset += ' and not ::({0})'.format(_IdRevset(present))
+        outgoings = [cs for cs in local.Log(revset) if cs.hash not in known]
+        return outgoings, incomings
+
+
+def _PushRevset(revs, branches):
+    '''
+    Builds a revset matching the heads that ``hg push`` would push for some
+    revisions and branches
+    '''
+    targets = ['({0})'.format(rev) for rev in revs]
+    if branches:
+        targets.append('head() and ({0})'.format(
+            ' or '.join('branch({0!r})'.format(b) for b in branches)
+            ))
+    return ' or '.join(targets)
+
+
+def _IdRevset(hashes):
+    ''' Builds a revset matching a collection of hashes '''
+    return ' or '.join('id({0})'.format(h) for h in hashes)
+
+
+def _Present(local, hashes):
+    '''
+    Finds which of a set of hashes are present in the local repository
+
+    :returns:   A set of hashes
+    '''
+    if not hashes:
+        return set()
+    return set(cs.hash for cs in local.Log(_IdRevset(hashes)))
+
+
+def _Ancestors(known, heads):
+    '''
+    Finds all the ancestors (inclusive) of some heads using the graph stored
+    in the index
+
+    :param known:   A dictionary of hash to :class:`Repo.ChangesetNodeInfo`
+    :param heads:   An iterable of head hashes
+    :returns:       A set of hashes
+    '''
+    ancestors = set()
+    pending = list(heads)
+    while pending:
+        node = pending.pop()
+        if node in ancestors or node not in known:
+            continue
+        ancestors.add(node)
+        pending.extend((known[node].p1, known[node].p2))
+    return ancestors
@@ -0,0 +1,206 @@
+'''
+This module provides a backend for local repositories that reads state
+through Mercurial's python API rather than running an ``hg`` process for each
+query.  It's only available if the ``mercurial`` package can be imported by
+the python running synchg.
+'''
+
+import os
+from repo import Repo
+from mqdelta import _ParseSeries, _ParseStatus
+
+try:
+    from mercurial import hg as hglib
+    from mercurial import ui as uilib
+    from mercurial import discovery, scmutil
+    from mercurial.node import hex as hexnode, short
+    Available = True
+except ImportError:
+    Available = False
+
+__all__ = ['InProcessRepo', 'Available']
+
+
+def _PatchDir(hgDir):
+    '''
+    Gets the directory of the active mq patch queue
+
+    :param hgDir:   The path to the ``.hg`` directory of a repository
+    :returns:       A path string
+    '''
+    queue = 'patches'
+    queueFile = os.path.join(hgDir, 'patches.queue')
+    if os.path.exists(queueFile):
+        with open(queueFile) as f:
+            name = f.read().strip()
+        if name and name != 'patches':
+            queue = 'patches-' + name
+    return os.path.join(hgDir, queue)
+
+
+def _ReadQueue(patchDir):
+    '''
+    Reads the series & applied patches of an mq patch queue
+
+    :param patchDir:    The path to the patch queue directory
+    :returns:           A tuple of (series, applied).  Series is a list of
+                        patch names, applied a list of (hash, name) tuples
+    '''
+    def Read(name):
+        path = os.path.join(patchDir, name)
+        if not os.path.exists(path):
+            return ''
+        with open(path) as f:
+            return f.read()
+
+    status = Read('status')
+    hashes = [
+            line.split(':', 1)[0]
+            for line in status.splitlines() if ':' in line
+            ]
+    return _ParseSeries(Read('series')), zip(hashes, _ParseStatus(status))
+
+
+class InProcessRepo(Repo):
+    '''
+    A local :class:`Repo` that answers queries through Mercurial's python
+    API.  Commands that change the repository are still run with ``hg``.
+
+    Unlike :class:`Repo` this doesn't need to pop mq patches to find the
+    current revision or the outgoing changesets.
+    '''
+
+    def _Open(self):
+        '''
+        Opens the repository.  This is done for each query, as hg commands
+        run by other methods may have changed the repository.  The ui is set
+        up as hg commands would be: with the lean profile (if any) and the
+        settings passed with ``--config``, so that connections to the remote
+        go through the same ssh command.
+        '''
+        settings = list(self.hgConfig)
+        if self.profile:
+            # Like HGRCPATH='', only the carried over settings are used
+            ui = uilib.ui()
+            settings = self.profile.settings + settings
+        elif hasattr(uilib.ui, 'load'):
+            ui = uilib.ui.load()
+        else:
+            ui = uilib.ui()
+        ui.setconfig('ui', 'quiet', 'true')
+        for name, value in settings:
+            section, key = name.split('.', 1)
+            ui.setconfig(section, key, value, 'synchg')
+        return hglib.repository(ui, str(self._path))
+
+    @property
+    def summary(self):
+        '''
+        Gets the same information as :attr:`Repo.summary`.  Modified counts
+        every modified, added, removed or missing file and unapplied counts
+        every unapplied patch in the series, whether it's guarded or not.
+
+        :return:    A :class:`SummaryInfo`
+        '''
+        repo = self._Open()
+        status = repo.status(unknown=True)
+        modified = sum(len(files) for files in status[:4])
+        commitData = Repo.CommitChangeInfo(modified, len(status[4]))
+        series, applied = _ReadQueue(_PatchDir(repo.path))
+        mqData = Repo.MqAppliedInfo(len(applied), len(series) - len(applied))
+        return Repo.SummaryInfo(commitData, mqData)
+
+    def WorkingChanges(self, unknown=False):
+        '''
+        Gets the same information as :meth:`Repo.WorkingChanges`
+        '''
+        status = self._Open().status(unknown=unknown)
+        files = []
+        for changed in status[:5 if unknown else 4]:
+            files.extend(changed)
+        return files
+
+    @property
+    def lastAppliedPatch(self):
+        '''
+        Gets the last applied mq patch (if there is one)
+
+        :returns: A single mq patch name (or None)
+        '''
+        _, applied = _ReadQueue(_PatchDir(str(self._path / '.hg')))
+        if applied:
+            return applied[-1][1]
+        return None
+
+    def _CheckCurrentRev(self):
+        '''
+        Gets the revision and branch that would be current with all patches
+        popped, and stores them
+        '''
+        repo = self._Open()
+        _, applied = _ReadQueue(_PatchDir(repo.path))
+        if applied:
+            ctx = repo[applied[0][0]].p1()
+        else:
+            ctx = repo['.']
+        self._currentRev = short(ctx.node())
+        self._branch = ctx.branch()
+
+    def FindOutgoings(self, revs=None, branches=None):
+        '''
+        Gets the changesets that would be pushed to `self.remote` for a set
+        of revisions and branches
+
+        :param revs:        A list of revisions (or revsets) to push.
+                            Defaults to the current revision.
+        :param branches:    A list of branches to push.
+                            Defaults to the current branch.
+        :returns:           A list containing :class:`ChangesetInfo`
+        '''
+        assert self.remote
+        if revs is None:
+            revs = [self.currentRev]
+        if branches is None:
+            branches = [self.branch]
+        repo = self._Open()
+        _, applied = _ReadQueue(_PatchDir(repo.path))
+        patches = set(node for node, _ in applied)
+        heads = set(repo[rev].node() for rev in scmutil.revrange(repo, revs))
+        branchmap = repo.branchmap()
+        for branch in branches:
+            if branch in branchmap:
+                heads.update(branchmap.branchheads(branch))
+        if not heads:
+            return []
+        other = hglib.peer(repo, {}, repo.ui.expandpath(self.remote))
+        try:
+            outgoing = discovery.findcommonoutgoing(
+                    repo, other, onlyheads=list(heads)
+                    )
+        finally:
+            other.close()
+        infos = []
+        for node in outgoing.missing:
+            if hexnode(node) in patches:
+                # Branch heads include applied patches, which aren't pushed
+                continue
+            lines = repo[node].description().splitlines()
+            desc = lines[0] if lines else ''
+            infos.append(Repo.ChangesetInfo(hexnode(node), desc))
+        return infos
+
+    def FindIncomings(self, branches=None):
+        '''
+        Gets the changesets on some branches of `self.remote` that are not
+        present locally.  The descriptions of incoming changesets have to be
+        fetched from the remote, so this still runs ``hg incoming``, but
+        without popping any patches.
+
+        :param branches:    A list of branches to check.
+                            Defaults to the current branch.
+        :returns:           A list containing :class:`ChangesetInfo`
+        '''
+        assert self.remote
+        if branches is None:
+            branches = [self.branch]
+        return self._Incomings(branches)
@@ -0,0 +1,107 @@
+'''
+This module reports the commands that synchg runs.  An
+:class:`InstrumentedCommand` wraps a plumbum command and calls a report
+function each time it's run, with the full command line, how long it took,
+it's exit code and the size of it's output.
+'''
+
+import time
+from plumbum.commands import ProcessExecutionError
+
+__all__ = ['InstrumentedCommand']
+
+
+class InstrumentedCommand(object):
+    '''
+    A command that reports each run.  This supports binding arguments with
+    ``[]``, redirecting stdin with ``<<``, calling and ``popen``, like the
+    plumbum commands it wraps.  Commands started with ``popen`` are reported
+    when they're waited for.
+    '''
+
+    def __init__(self, command, argv, report):
+        '''
+        :param command: The command to wrap
+        :param argv:    The command line of the command, as a list of strings
+        :param report:  A function that is called with the command line,
+                        duration, exit code & output size of each run.  The
+                        output size is None if it isn't known
+        '''
+        self._command = command
+        self._argv = argv
+        self._report = report
+
+    def __getitem__(self, args):
+        if not isinstance(args, tuple):
+            args = (args,)
+        return InstrumentedCommand(
+                self._command[args],
+                self._argv + [str(arg) for arg in args],
+                self._report
+                )
+
+    def __lshift__(self, data):
+        return InstrumentedCommand(
+                self._command << data, self._argv, self._report
+                )
+
+    def __call__(self, *args, **kwargs):
+        argv = self._argv + [str(arg) for arg in args]
+        start = time.time()
+        try:
+            output = self._command(*args, **kwargs)
+        except ProcessExecutionError as e:
+            self._report(
+                    argv, time.time() - start, e.retcode, len(e.stdout or '')
+                    )
+            raise
+        size = len(output) if isinstance(output, basestring) else None
+        self._report(argv, time.time() - start, 0, size)
+        return output
+
+    def popen(self, args=(), **kwargs):
+        if not isinstance(args, (tuple, list)):
+            args = (args,)
+        argv = self._argv + [str(arg) for arg in args]
+        proc = self._command.popen(args, **kwargs)
+        return _ReportingPopen(proc, argv, self._report)
+
+    def __str__(self):
+        return str(self._command)
+
+
+class _ReportingPopen(object):
+    '''
+    Wraps a ``Popen`` object, reporting the command when it has finished
+    '''
+
+    def __init__(self, proc, argv, report):
+        self.__dict__.update(
+                _proc=proc, _argv=argv, _report=report,
+                _start=time.time(), _reported=False
+                )
+
+    def __getattr__(self, name):
+        return getattr(self._proc, name)
+
+    def __setattr__(self, name, value):
+        # Callers set attributes such as stdin on the real Popen
+        setattr(self._proc, name, value)
+
+    def _Finished(self, size):
+        if not self._reported:
+            self.__dict__['_reported'] = True
+            self._report(
+                    self._argv, time.time() - self._start,
+                    self._proc.returncode, size
+                    )
+
+    def wait(self, *args, **kwargs):
+        code = self._proc.wait(*args, **kwargs)
+        self._Finished(None)
+        return code
+
+    def communicate(self, *args, **kwargs):
+        stdout, stderr = self._proc.communicate(*args, **kwargs)
+        self._Finished(len(stdout or ''))
+        return stdout, stderr
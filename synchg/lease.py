@@ -0,0 +1,240 @@
+'''
+This module provides leases on remote repositories, so that syncs to the
+same repository (from different machines, or a watcher & a manual sync) take
+turns rather than colliding on hg's repository lock halfway through.
+
+A :class:`Lease` is a directory on the remote, created atomically with
+``mkdir``, that records who holds it.  Syncs waiting for a lease join a local
+:class:`SyncQueue`.  A sync only ever pushes the local state as it is when
+the sync gets the lease, so a queued sync that has been overtaken by a newer
+sync of the same repository can give up: the newer sync will push
+everything it would have.
+'''
+
+import os
+import json
+import errno
+import time
+import uuid
+import socket
+import getpass
+from cleanup import _Quote, _QuotePath
+
+__all__ = ['Lease', 'LeaseBusy', 'SyncQueue', 'AcquireLease']
+
+# Acquires a lease in a single remote command.  Prints acquired if it was,
+# otherwise the time on the remote, the time the lease was acquired and the
+# lease's owner.  Times are all taken from the remote's clock
+_AcquireScript = '''
+lease={lease}
+mkdir -p "$(dirname "$lease")" || exit 1
+if mkdir "$lease" 2>/dev/null; then
+    echo {owner} > "$lease/owner"
+    date +%s > "$lease/time"
+    echo acquired
+else
+    date +%s
+    cat "$lease/time" "$lease/owner" 2>/dev/null
+fi
+'''
+
+# Releases a lease, if it's still held by the given token
+_ReleaseScript = '''
+lease={lease}
+if grep -q {token} "$lease/owner" 2>/dev/null; then
+    rm -rf "$lease"
+fi
+'''
+
+# Breaks a stale lease, if it's still the lease that was seen (its time &
+# owner still match).  It's renamed first so that only one sync breaks it.
+# If another sync broke it & took a new lease between the check and the
+# rename, the new lease is put back
+_BreakScript = '''
+lease={lease}
+stale="$lease.stale.$$"
+[ "$(cat "$lease/time" "$lease/owner" 2>/dev/null)" = {seen} ] || exit 0
+mv "$lease" "$stale" 2>/dev/null || exit 0
+if [ "$(cat "$stale/time" "$stale/owner" 2>/dev/null)" = {seen} ]; then
+    rm -rf "$stale"
+elif [ ! -e "$lease" ]; then
+    mv "$stale" "$lease"
+fi
+'''
+
+
+class LeaseBusy(Exception):
+    '''
+    Raised when a lease is held by another sync for longer than we're
+    prepared to wait
+    '''
+    pass
+
+
+class Lease(object):
+    '''
+    A lease on a remote repository
+    '''
+
+    def __init__(self, machine, path, ttl):
+        '''
+        :param machine: The plumbum machine the repository is on
+        :param path:    The path of the lease directory on the remote
+        :param ttl:     The number of seconds after which a lease is
+                        considered stale, and can be broken.  This protects
+                        against syncs that died without releasing it
+        '''
+        self._machine = machine
+        self._path = path
+        self._ttl = ttl
+        self.token = uuid.uuid4().hex
+        self.holder = None
+
+    def _Run(self, script, **kwargs):
+        script = script.format(lease=_QuotePath(self._path), **kwargs)
+        return (self._machine['sh'] << script)()
+
+    def TryAcquire(self):
+        '''
+        Tries to acquire the lease.  If it's held by someone else,
+        :attr:`holder` describes who.
+
+        :returns:   True if the lease was acquired
+        '''
+        owner = json.dumps({
+            'token': self.token,
+            'owner': getpass.getuser() + '@' + socket.gethostname(),
+            'pid': os.getpid(),
+            })
+        lines = self._Run(_AcquireScript, owner=_Quote(owner)).splitlines()
+        if lines and lines[0] == 'acquired':
+            self.holder = None
+            return True
+        try:
+            now, acquired = int(lines[0]), int(lines[1])
+            held = json.loads(lines[2])
+        except (IndexError, ValueError):
+            # The owner file hasn't been written yet, or is corrupt.  Either
+            # way we can't tell how old it is
+            self.holder = 'another sync'
+            return False
+        self.holder = '{0} (pid {1})'.format(held['owner'], held['pid'])
+        if now - acquired > self._ttl:
+            self._Break('\n'.join(lines[1:3]))
+            return self.TryAcquire()
+        return False
+
+    def _Break(self, seen):
+        '''
+        Breaks a stale lease, unless it has changed since it was seen
+
+        :param seen:    The time & owner lines of the lease when it was seen
+        '''
+        self._Run(_BreakScript, seen=_Quote(seen))
+
+    def Release(self):
+        ''' Releases the lease, if we still hold it '''
+        self._Run(_ReleaseScript, token=_Quote(self.token))
+
+
+class SyncQueue(object):
+    '''
+    The local syncs waiting for a lease.  Each sync joins the queue with a
+    ticket, which is a file named after the time it joined.
+    '''
+
+    def __init__(self, directory):
+        '''
+        :param directory:   The directory to keep the tickets in.  There
+                            should be one per local & remote repository
+        '''
+        self._dir = directory
+        self._ticket = None
+
+    def Join(self):
+        ''' Joins the queue '''
+        if not os.path.exists(self._dir):
+            try:
+                os.makedirs(self._dir)
+            except OSError:
+                # Another sync created it first
+                pass
+        self._ticket = '{0:017.6f}-{1}'.format(time.time(), os.getpid())
+        open(os.path.join(self._dir, self._ticket), 'w').close()
+
+    def Leave(self):
+        ''' Leaves the queue '''
+        if self._ticket:
+            try:
+                os.remove(os.path.join(self._dir, self._ticket))
+            except OSError:
+                pass
+            self._ticket = None
+
+    def Superseded(self):
+        '''
+        Checks if a sync that joined the queue after this one is still
+        waiting or running.  Tickets of processes that have died are removed.
+        '''
+        for ticket in sorted(os.listdir(self._dir), reverse=True):
+            if ticket <= self._ticket:
+                return False
+            if _Alive(int(ticket.rsplit('-', 1)[1])):
+                return True
+            try:
+                os.remove(os.path.join(self._dir, ticket))
+            except OSError:
+                pass
+        return False
+
+
+def _Alive(pid):
+    ''' Checks if a local process is running '''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM means it's running as someone else
+        return e.errno == errno.EPERM
+    return True
+
+
+def AcquireLease(lease, queue, wait, onWait=None, poll=2,
+                 clock=time.time, sleep=time.sleep):
+    '''
+    Waits in a queue for a lease
+
+    :param lease:   The :class:`Lease` to acquire
+    :param queue:   The :class:`SyncQueue` to wait in.  The caller should
+                    have joined it
+    :param wait:    The maximum number of seconds to wait.  0 means don't
+                    wait
+    :param onWait:  An optional function, called with the holder of the
+                    lease when we start waiting for it
+    :param poll:    The number of seconds between attempts
+    :returns:       True if the lease was acquired, False if a newer sync
+                    in the queue will do our work
+    :raises:        :class:`LeaseBusy` if the lease is still held after
+                    waiting
+    '''
+    deadline = clock() + wait
+    waiting = False
+    while True:
+        if queue.Superseded():
+            return False
+        if lease.TryAcquire():
+            if queue.Superseded():
+                # A newer sync joined while we were acquiring.  Let it go
+                # first rather than pushing stale state
+                lease.Release()
+                return False
+            return True
+        if clock() >= deadline:
+            raise LeaseBusy(
+                    'The remote repository is being synced by {0}'.format(
+                        lease.holder
+                        )
+                    )
+        if not waiting and onWait:
+            onWait(lease.holder)
+        waiting = True
+        sleep(poll)
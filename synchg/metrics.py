@@ -0,0 +1,313 @@
+'''
+This module exports metrics about syncs in the Prometheus text format.  A
+:class:`MetricsSink` subscribes to the events of a sync, and when the sync
+finishes adds what it saw to a :class:`MetricsStore`.  The store keeps the
+totals for every host & repository in a JSON file, and writes them to a
+textfile that node-exporter's textfile collector can read.  They can also be
+served over HTTP by running::
+
+    python -m synchg.metrics FILE [PORT]
+'''
+
+import os
+import sys
+import json
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from events import PhaseFinished, SyncFinished, CommandRun, BytesSent
+from state import LockFile, WriteFile
+
+# The port metrics are served on by default.  node-exporter uses 9100, so
+# this is one that's free alongside it
+DefaultPort = 9745
+
+__all__ = ['MetricsStore', 'MetricsSink', 'MetricsServer']
+
+# The upper bounds (in seconds) of the buckets of duration histograms
+Buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# The help text & type of each metric
+_Metrics = [
+        ('synchg_syncs_total', 'counter',
+         'Syncs run, by outcome (ok, coalesced, abort, error or failed)'),
+        ('synchg_sync_duration_seconds', 'histogram',
+         'How long syncs took'),
+        ('synchg_phase_duration_seconds', 'histogram',
+         'How long each phase of a sync took'),
+        ('synchg_hg_commands_total', 'counter',
+         'hg commands run'),
+        ('synchg_round_trips_total', 'counter',
+         'Commands that ran on, or connected to, the remote'),
+        ('synchg_bytes_sent_total', 'counter',
+         'Bytes sent to the remote by synchg itself'),
+        ]
+
+_ContentType = 'text/plain; version=0.0.4'
+
+
+def _Key(name, labels):
+    ''' Builds the key that a series is stored under '''
+    return json.dumps([name, sorted(labels.items())])
+
+
+def _FormatLabels(labels):
+    def Escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"') \
+                .replace('\n', '\\n')
+    return '{' + ','.join(
+            '{0}="{1}"'.format(name, Escape(str(value)))
+            for name, value in sorted(labels)
+            ) + '}'
+
+
+def _FormatNumber(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsStore(object):
+    '''
+    The totals of every metric, kept in a JSON file alongside the textfile
+    '''
+
+    def __init__(self, path):
+        '''
+        :param path:    The path of the textfile to write.  The totals are
+                        kept in ``<path>.json``
+        '''
+        self.path = path
+        self._statePath = path + '.json'
+        self.counters = {}
+        self.histograms = {}
+
+    def Load(self):
+        ''' Reads the totals from disk '''
+        self.counters, self.histograms = {}, {}
+        if os.path.exists(self._statePath):
+            try:
+                with open(self._statePath) as f:
+                    state = json.load(f)
+                self.counters = state['counters']
+                self.histograms = state['histograms']
+            except (ValueError, KeyError):
+                # Corrupt totals are no worse than starting again
+                pass
+
+    def Increment(self, name, labels, amount=1):
+        '''
+        Increases a counter
+
+        :param name:    The name of the metric
+        :param labels:  A dictionary of labels
+        :param amount:  The amount to add
+        '''
+        key = _Key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def Observe(self, name, labels, value):
+        '''
+        Adds an observation to a histogram
+
+        :param name:    The name of the metric
+        :param labels:  A dictionary of labels
+        :param value:   The observed value
+        '''
+        key = _Key(name, labels)
+        histogram = self.histograms.setdefault(
+                key, {'buckets': [0] * len(Buckets), 'sum': 0, 'count': 0}
+                )
+        for index, bound in enumerate(Buckets):
+            if value <= bound:
+                histogram['buckets'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def Render(self):
+        '''
+        Renders the totals in the Prometheus text format
+
+        :returns:   A string
+        '''
+        series = {}
+        for key, value in self.counters.iteritems():
+            name, labels = json.loads(key)
+            series.setdefault(name, []).append(
+                    '{0}{1} {2}'.format(
+                        name, _FormatLabels(labels), _FormatNumber(value)
+                        )
+                    )
+        for key, histogram in self.histograms.iteritems():
+            name, labels = json.loads(key)
+            lines = series.setdefault(name, [])
+            bounds = list(Buckets) + [float('inf')]
+            counts = histogram['buckets'] + [histogram['count']]
+            for bound, count in zip(bounds, counts):
+                bucketLabels = labels + [['le', _FormatNumber(bound)]]
+                lines.append('{0}_bucket{1} {2}'.format(
+                        name, _FormatLabels(bucketLabels), count
+                        ))
+            lines.append('{0}_sum{1} {2}'.format(
+                    name, _FormatLabels(labels),
+                    _FormatNumber(histogram['sum'])
+                    ))
+            lines.append('{0}_count{1} {2}'.format(
+                    name, _FormatLabels(labels), histogram['count']
+                    ))
+        output = []
+        for name, kind, help in _Metrics:
+            if name in series:
+                output.append('# HELP {0} {1}'.format(name, help))
+                output.append('# TYPE {0} {1}'.format(name, kind))
+                output.extend(sorted(series[name]))
+        return '\n'.join(output) + '\n'
+
+    def Save(self):
+        '''
+        Atomically writes the totals and the textfile.  Other syncs may be
+        updating the store, so this should be called with :meth:`Lock` held
+        since the totals were loaded.
+        '''
+        state = {'counters': self.counters, 'histograms': self.histograms}
+        WriteFile(self._statePath, json.dumps(state))
+        WriteFile(self.path, self.Render())
+
+    def Lock(self):
+        '''
+        Gets a context manager that holds a lock on the store, shared with
+        other processes
+        '''
+        return LockFile(self.path)
+
+
+class MetricsSink(object):
+    '''
+    An event subscriber that records the metrics of a sync, and adds them
+    to a :class:`MetricsStore` when it finishes
+    '''
+
+    def __init__(self, path, host, repo):
+        '''
+        :param path:    The path of the metrics textfile
+        :param host:    The host being synced to
+        :param repo:    The name of the repository being synced
+        '''
+        self._path = path
+        self._labels = {'host': host, 'repo': repo}
+        self._pending = []
+
+    def _Labels(self, **extra):
+        labels = dict(self._labels)
+        labels.update(extra)
+        return labels
+
+    def __call__(self, event):
+        if isinstance(event, PhaseFinished):
+            self._pending.append((
+                'Observe', 'synchg_phase_duration_seconds',
+                self._Labels(phase=event.phase), event.duration
+                ))
+        elif isinstance(event, CommandRun):
+            if event.argv and event.argv[0] == 'hg':
+                self._pending.append((
+                    'Increment', 'synchg_hg_commands_total', self._Labels(), 1
+                    ))
+            if event.remote:
+                self._pending.append((
+                    'Increment', 'synchg_round_trips_total', self._Labels(), 1
+                    ))
+        elif isinstance(event, BytesSent):
+            self._pending.append((
+                'Increment', 'synchg_bytes_sent_total',
+                self._Labels(), event.size
+                ))
+        elif isinstance(event, SyncFinished):
+            self._pending.append((
+                'Increment', 'synchg_syncs_total',
+                self._Labels(outcome=event.outcome), 1
+                ))
+            self._pending.append((
+                'Observe', 'synchg_sync_duration_seconds',
+                self._Labels(), event.duration
+                ))
+            self.Flush()
+
+    def Flush(self):
+        '''
+        Adds the recorded metrics to the store on disk.  This is called as
+        a sync finishes, so errors are written to stderr rather than
+        raised in place of the sync's own exception.
+        '''
+        pending, self._pending = self._pending, []
+        store = MetricsStore(self._path)
+        try:
+            with store.Lock():
+                store.Load()
+                for method, name, labels, value in pending:
+                    getattr(store, method)(name, labels, value)
+                store.Save()
+        except EnvironmentError as e:
+            sys.stderr.write(
+                    'Could not write metrics to {0}: {1}\n'.format(
+                        self._path, e
+                        )
+                    )
+
+
+class MetricsServer(object):
+    '''
+    Serves the totals in a metrics store over HTTP.  The totals are read
+    from disk for each request, so syncs run by other processes are seen.
+    '''
+
+    def __init__(self, path, port, address=''):
+        '''
+        :param path:    The path of the metrics textfile
+        :param port:    The port to listen on.  0 picks a free port
+        :param address: The address to listen on
+        '''
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                store = MetricsStore(path)
+                store.Load()
+                body = store.Render()
+                handler.send_response(200)
+                handler.send_header('Content-Type', _ContentType)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self._server = HTTPServer((address, port), Handler)
+        self.port = self._server.server_address[1]
+
+    def Start(self):
+        ''' Starts serving on a background thread '''
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def Serve(self):
+        ''' Serves until interrupted '''
+        self._server.serve_forever()
+
+    def Close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if not 1 <= len(args) <= 2:
+        sys.stderr.write('usage: python -m synchg.metrics FILE [PORT]\n')
+        return 2
+    port = int(args[1]) if len(args) == 2 else DefaultPort
+    MetricsServer(args[0], port).Serve()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,229 @@
+'''
+This module provides the delta strategy for syncing mq patch queues.  Rather
+than committing the local patches repository and pushing it to the remote,
+each file in the patch queue is hashed on both sides and only the files that
+differ are sent.  Patches at the bottom of the queue that haven't changed are
+left applied on the remote.
+'''
+
+import os
+import hashlib
+from collections import namedtuple
+from transfer import BuildArchive, SendData
+
+__all__ = ['PatchState', 'LocalPatchState', 'RemotePatchState', 'MqDelta']
+
+
+# The state of an mq patch queue
+#   hashes:     A dictionary of file path (relative to the patch directory)
+#               to sha1 hex digest
+#   series:     A list of the patch names in the series file
+#   applied:    A list of the applied patch names, in order
+PatchState = namedtuple('PatchState', ['hashes', 'series', 'applied'])
+
+# Files in the patch directory that shouldn't be synced.  status describes
+# the patches applied to a particular working copy
+_ExcludedFiles = ['status']
+
+_RemoteStateScript = r'''
+cd .hg/patches 2>/dev/null || exit 0
+if command -v sha1sum >/dev/null 2>&1; then
+    SUM=sha1sum
+else
+    SUM='shasum -a 1'
+fi
+find . -path ./.hg -prune -o -type f ! -path ./status -print |
+    sed 's|^\./||' |
+    while read -r f; do $SUM "$f"; done
+echo '#series'
+cat series 2>/dev/null
+echo '#status'
+cat status 2>/dev/null
+'''
+
+
+def _ParseSeries(text):
+    ''' Gets the patch names from the contents of a series file '''
+    names = []
+    for line in text.splitlines():
+        name = line.split('#', 1)[0].strip()
+        if name:
+            names.append(name)
+    return names
+
+
+def _ParseStatus(text):
+    ''' Gets the applied patch names from the contents of a status file '''
+    return [
+            line.split(':', 1)[1]
+            for line in text.splitlines() if ':' in line
+            ]
+
+
+def LocalPatchState(patchDir):
+    '''
+    Reads the state of a patch queue on the local machine
+
+    :param patchDir:    The path to the patch directory
+    :returns:           A :class:`PatchState`
+    '''
+    patchDir = str(patchDir)
+    hashes = {}
+    for root, dirs, files in os.walk(patchDir):
+        if root == patchDir:
+            dirs[:] = [d for d in dirs if d != '.hg']
+            files = [f for f in files if f not in _ExcludedFiles]
+        for name in files:
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, patchDir).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                hashes[relative] = hashlib.sha1(f.read()).hexdigest()
+
+    def Read(name):
+        path = os.path.join(patchDir, name)
+        if not os.path.exists(path):
+            return ''
+        with open(path) as f:
+            return f.read()
+
+    return PatchState(
+            hashes,
+            _ParseSeries(Read('series')),
+            _ParseStatus(Read('status'))
+            )
+
+
+def RemotePatchState(repo):
+    '''
+    Reads the state of the patch queue of a (usually remote) repository,
+    with a single invocation of sh on it's machine.
+
+    :param repo:    A :class:`synchg.repo.Repo`
+    :returns:       A :class:`PatchState`
+    '''
+    with repo.machine.cwd(repo.path):
+        output = (repo.Command('sh') << _RemoteStateScript)()
+    hashes = {}
+    sections = {'#series': [], '#status': []}
+    current = None
+    for line in output.splitlines():
+        if line in sections:
+            current = sections[line]
+        elif current is not None:
+            current.append(line)
+        elif line.strip():
+            digest, path = line.split(None, 1)
+            hashes[path.lstrip('*')] = digest
+    return PatchState(
+            hashes,
+            _ParseSeries('\n'.join(sections['#series'])),
+            _ParseStatus('\n'.join(sections['#status']))
+            )
+
+
+class MqDelta(object):
+    '''
+    Syncs an mq patch queue by sending only the files that have changed
+    '''
+
+    def __init__(self, local, remote):
+        '''
+        Reads the patch queue state of both repositories
+
+        :param local:   The local :class:`synchg.repo.Repo`
+        :param remote:  The remote :class:`synchg.repo.Repo`
+        '''
+        self.local = local
+        self.remote = remote
+        self._patchDir = local.path / '.hg' / 'patches'
+        self.localState = LocalPatchState(self._patchDir)
+        self.remoteState = RemotePatchState(remote)
+
+    @property
+    def changedFiles(self):
+        '''
+        Gets the files that differ between the local & remote queues
+
+        :returns:   A sorted list of paths relative to the patch directory
+        '''
+        remoteHashes = self.remoteState.hashes
+        return sorted(
+                path for path, digest in self.localState.hashes.iteritems()
+                if remoteHashes.get(path) != digest
+                )
+
+    @property
+    def removedFiles(self):
+        '''
+        Gets the files that are in the remote queue but not the local one
+
+        :returns:   A sorted list of paths relative to the patch directory
+        '''
+        localHashes = self.localState.hashes
+        return sorted(
+                path for path in self.remoteState.hashes
+                if path not in localHashes
+                )
+
+    def UnchangedPrefix(self, target):
+        '''
+        Works out how many of the patches currently applied on the remote can
+        be left applied
+
+        :param target:  The name of the patch that should be the top of the
+                        remote queue, or None
+        :returns:       The number of patches to leave applied
+        '''
+        changed = set(self.changedFiles)
+        if 'guards' in changed or 'guards' in self.removedFiles:
+            return 0
+        series = self.localState.series
+        wanted = series[:series.index(target) + 1] if target else []
+        count = 0
+        for name, applied in zip(wanted, self.remoteState.applied):
+            if name != applied or name in changed:
+                break
+            count += 1
+        return count
+
+    def Sync(self, target, remoteClean=False):
+        '''
+        Syncs the remote patch queue and applies patches up to target
+
+        :param target:      The name of the patch that should be applied on
+                            the remote, or None for no patches
+        :param remoteClean: Should be set if all patches have been popped on
+                            the remote since this object was created
+        :returns:           The number of bytes sent to the remote
+        '''
+        keep = 0 if remoteClean else self.UnchangedPrefix(target)
+        applied = [] if remoteClean else self.remoteState.applied
+        if len(applied) > keep:
+            if keep:
+                self.remote.PopPatch(applied[keep - 1])
+            else:
+                self.remote.PopPatch()
+
+        destination = str(self.remote.path / '.hg' / 'patches')
+        removed = self.removedFiles
+        if removed:
+            with self.remote.machine.cwd(destination):
+                self.remote.Command('rm')('-f', *removed)
+
+        sent = 0
+        changed = self.changedFiles
+        if changed:
+            archive = BuildArchive(
+                    self._patchDir, changed,
+                    level=self.local.compressionLevel
+                    )
+            tar = self.remote.Command('tar')
+            SendData(
+                    tar['xzf', '-', '-C', destination], archive,
+                    self.remote.rateLimit, self.remote.progress
+                    )
+            sent = len(archive)
+
+        if target and (keep == 0 or applied[keep - 1] != target):
+            self.remote.PushPatch(target)
+        return sent
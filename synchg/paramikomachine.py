@@ -0,0 +1,323 @@
+'''
+This module provides a plumbum remote machine that runs over a single
+paramiko SSH transport.  ``SshMachine`` starts a new ``ssh`` process (and
+connection) for every command it runs, whereas this machine runs each command
+on a new channel of one transport, so commands are cheap to start and can be
+run in parallel.  It can also forward local ports over the transport, which
+lets hg's own ``ssh://`` operations connect through it.
+
+This requires the ``paramiko`` package.
+'''
+
+import os
+import socket
+import select
+import threading
+import paramiko
+from subprocess import PIPE
+from plumbum.commands import BaseCommand
+from plumbum.remote_machine import BaseRemoteMachine
+from plumbum.session import ShellSession
+
+__all__ = ['ParamikoMachine', 'ParamikoTunnel']
+
+# The size of the buffers used when copying data between sockets & channels
+_BufferSize = 32 * 1024
+
+
+class _ChannelStdin(object):
+    '''
+    The stdin of a :class:`ChannelPopen`.  Closing it sends EOF to the remote
+    command.
+    '''
+
+    def __init__(self, channel):
+        self._channel = channel
+        self._file = channel.makefile('wb', -1)
+
+    def write(self, data):
+        self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._channel.closed:
+            self._file.flush()
+            self._channel.shutdown_write()
+
+
+class ChannelPopen(object):
+    '''
+    A ``Popen``-like object for a command running on a paramiko channel
+    '''
+
+    def __init__(self, channel, argv, encoding, stdin=None):
+        '''
+        :param channel:     The channel the command was started on
+        :param argv:        The command line, for error messages
+        :param encoding:    The encoding of the command's output
+        :param stdin:       PIPE, a file to send to the command's stdin, or
+                            None to close it's stdin immediately
+        '''
+        self.channel = channel
+        self.argv = argv
+        self.encoding = encoding
+        self.returncode = None
+        self.stdin = _ChannelStdin(channel)
+        self.stdout = channel.makefile('rb', -1)
+        self.stderr = channel.makefile_stderr('rb', -1)
+        if stdin != PIPE:
+            if stdin is not None:
+                for chunk in iter(lambda: stdin.read(_BufferSize), ''):
+                    self.stdin.write(chunk)
+            self.stdin.close()
+            self.stdin = None
+
+    def poll(self):
+        ''' Returns the exit code, or None if the command is still running '''
+        if self.returncode is None and self.channel.exit_status_ready():
+            self.returncode = self.channel.recv_exit_status()
+        return self.returncode
+
+    def wait(self):
+        ''' Waits for the command to finish and returns it's exit code '''
+        self.returncode = self.channel.recv_exit_status()
+        return self.returncode
+
+    def communicate(self, input=None):
+        '''
+        Sends input to the command, then reads all of it's output
+
+        :returns:   A tuple of (stdout, stderr)
+        '''
+        if self.stdin is not None:
+            if input:
+                self.stdin.write(input)
+            self.stdin.close()
+            self.stdin = None
+        # stderr is read on another thread, so a command that writes a lot to
+        # it can't fill the channel window and block while we read stdout
+        stderr = []
+        reader = threading.Thread(
+                target=lambda: stderr.append(self.stderr.read())
+                )
+        reader.daemon = True
+        reader.start()
+        stdout = self.stdout.read()
+        reader.join()
+        self.wait()
+        return stdout, stderr[0] if stderr else ''
+
+    def kill(self):
+        ''' Stops the command by closing it's channel '''
+        self.channel.close()
+
+    terminate = kill
+
+
+class ParamikoTunnel(object):
+    '''
+    A local port that is forwarded to a port reachable from the remote machine.
+    Each connection to the local port is carried on it's own channel of the
+    transport.  Can be used as a context manager.
+    '''
+
+    def __init__(self, transport, lport, dport, lhost, dhost):
+        self._transport = transport
+        self._dest = (dhost, dport)
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((lhost, lport))
+        self._server.listen(5)
+        self.host, self.port = self._server.getsockname()
+        thread = threading.Thread(target=self._Accept)
+        thread.daemon = True
+        thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, tb):
+        self.close()
+
+    def close(self):
+        ''' Stops accepting connections on the local port '''
+        if self._server:
+            self._server.close()
+            self._server = None
+
+    def _Accept(self):
+        while self._server:
+            try:
+                sock, address = self._server.accept()
+            except (socket.error, AttributeError):
+                # The server socket has been closed
+                return
+            try:
+                channel = self._transport.open_channel(
+                        'direct-tcpip', self._dest, address
+                        )
+            except paramiko.SSHException:
+                sock.close()
+                continue
+            thread = threading.Thread(target=_Pump, args=(sock, channel))
+            thread.daemon = True
+            thread.start()
+
+
+def _Pump(sock, channel):
+    '''
+    Copies data between a socket and a channel until one of them closes
+    '''
+    try:
+        while True:
+            readable, _, _ = select.select([sock, channel], [], [])
+            if sock in readable:
+                data = sock.recv(_BufferSize)
+                if not data:
+                    break
+                channel.sendall(data)
+            if channel in readable:
+                data = channel.recv(_BufferSize)
+                if not data:
+                    break
+                sock.sendall(data)
+    except (socket.error, EOFError):
+        pass
+    finally:
+        channel.close()
+        sock.close()
+
+
+class ParamikoMachine(BaseRemoteMachine):
+    '''
+    A plumbum remote machine that runs every command over one paramiko
+    transport.  Settings for the host (hostname, user, port & identity file)
+    are read from ``~/.ssh/config`` unless given explicitly.
+    '''
+
+    def __init__(self, host, user=None, port=None, keyfile=None,
+                 password=None, missing_host_policy=None, encoding='utf8',
+                 timeout=None):
+        '''
+        :param host:                The host to connect to
+        :param user:                The user to connect as
+        :param port:                The port sshd is listening on
+        :param keyfile:             The path to a private key file
+        :param password:            The password to authenticate with
+        :param missing_host_policy: A paramiko policy for hosts that aren't
+                                    in known_hosts.  Defaults to rejecting
+                                    them, like ssh does.
+        :param encoding:            The remote machine's encoding
+        :param timeout:             The number of seconds to wait for the
+                                    connection, or None to wait forever
+        '''
+        self.host = host
+        config = self._SshConfig(host)
+        self._client = paramiko.SSHClient()
+        self._client.load_system_host_keys()
+        self._client.set_missing_host_key_policy(
+                missing_host_policy or paramiko.RejectPolicy()
+                )
+        keyfile = keyfile or config.get('identityfile')
+        self.port = int(port or config.get('port', 22))
+        self._client.connect(
+                config.get('hostname', host),
+                port=self.port,
+                username=user or config.get('user'),
+                key_filename=keyfile,
+                password=password,
+                timeout=timeout
+                )
+        self._transport = self._client.get_transport()
+        self._tunnels = []
+        BaseRemoteMachine.__init__(self, encoding)
+
+    @staticmethod
+    def _SshConfig(host):
+        ''' Looks up the settings for a host in ~/.ssh/config '''
+        path = os.path.expanduser('~/.ssh/config')
+        if not os.path.exists(path):
+            return {}
+        config = paramiko.SSHConfig()
+        with open(path) as f:
+            config.parse(f)
+        return config.lookup(host)
+
+    def __str__(self):
+        return 'paramiko://{0}'.format(self.host)
+
+    def close(self):
+        for tunnel in self._tunnels:
+            tunnel.close()
+        BaseRemoteMachine.close(self)
+        self._client.close()
+
+    def session(self, isatty=False):
+        '''
+        Starts a shell session on a new channel
+        '''
+        channel = self._transport.open_session()
+        if isatty:
+            channel.get_pty()
+        channel.invoke_shell()
+        proc = ChannelPopen(channel, ['<shell>'], self.encoding, PIPE)
+        return ShellSession(proc, self.encoding, isatty)
+
+    def popen(self, args, stdin=None, **kwargs):
+        '''
+        Starts a command on a new channel, in the current working directory
+        and environment of the machine.  ``stdout`` & ``stderr`` are always
+        pipes.
+        '''
+        if isinstance(args, BaseCommand):
+            argv = args.formulate(1)
+        elif isinstance(args, (tuple, list)):
+            argv = list(args)
+        else:
+            argv = [args]
+        cmdline = ['cd', str(self.cwd), '&&']
+        envdelta = self.env.getdelta()
+        if envdelta:
+            cmdline.append('env')
+            cmdline.extend('%s=%s' % item for item in envdelta.items())
+        cmdline.extend(argv)
+        channel = self._transport.open_session()
+        channel.exec_command(' '.join(cmdline))
+        return ChannelPopen(channel, argv, self.encoding, stdin)
+
+    def tunnel(self, lport, dport, lhost='localhost', dhost='localhost'):
+        '''
+        Forwards a local port to a port reachable from the remote machine.
+
+        :param lport:   The local port.  0 picks a free port.
+        :param dport:   The destination port
+        :param lhost:   The local address to listen on
+        :param dhost:   The destination host, as seen from the remote machine
+        :returns:       A :class:`ParamikoTunnel`.  This will be closed
+                        along with the machine.
+        '''
+        tunnel = ParamikoTunnel(self._transport, lport, dport, lhost, dhost)
+        self._tunnels.append(tunnel)
+        return tunnel
+
+    def SshTunnel(self):
+        '''
+        Forwards a free local port to the remote machine's sshd
+
+        :returns:   A :class:`ParamikoTunnel`
+        '''
+        return self.tunnel(0, self.port)
+
+    def HgSshCommand(self, tunnel):
+        '''
+        Gets an ssh command that makes hg connect through a tunnel to the
+        remote machine's sshd
+
+        :param tunnel:  A :class:`ParamikoTunnel` from :meth:`SshTunnel`
+        :returns:       A string suitable for hg's ``ui.ssh`` setting
+        '''
+        return 'ssh -o HostName={0} -o Port={1} -o HostKeyAlias={2}'.format(
+                tunnel.host, tunnel.port, self.host
+                )
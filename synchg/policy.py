@@ -0,0 +1,156 @@
+'''
+This module decides the questions that a sync would otherwise ask, so that
+syncs can run unattended from cron, CI or a fleet sync.  A policy is a list
+of rules of the form ``name=value``, read from the ``policy`` option and the
+``--policy`` flag.  The questions are:
+
+    clone           Create a clone when the remote repository is missing
+    refresh         Refresh the current mq patch when the local repository
+                    has uncommitted changes
+    ignore-changes  Sync anyway when the local repository has uncommitted
+                    changes that won't be synced
+    strip           Strip remote changesets that aren't in the local
+                    repository
+    delete-orphans  Delete remote repositories whose local repository no
+                    longer exists
+
+The value of a rule is always, never, ask or auto.  auto does whatever is
+safe without anyone watching: it creates clones & ignores uncommitted
+changes, but never refreshes, strips or deletes.
+'''
+
+from utils import yn
+
+__all__ = ['Policy', 'PolicyError', 'AskUpFront', 'Questions']
+
+# The name of each question, it's auto answer, and how it's asked up front
+Questions = [
+        ('clone', True,
+         'Create clones of remote repositories that are missing?'),
+        ('refresh', False,
+         'Refresh the current mq patch if there are uncommitted changes?'),
+        ('ignore-changes', True,
+         'Sync anyway if there are uncommitted changes?'),
+        ('strip', False,
+         "Strip remote changesets that aren't in the local repository?"),
+        ('delete-orphans', False,
+         "Delete remote repositories whose local repository is gone?"),
+        ]
+
+_Values = ('always', 'never', 'ask', 'auto')
+
+# The auto answer of each question
+_Auto = dict((name, auto) for name, auto, _ in Questions)
+
+
+class PolicyError(Exception):
+    '''
+    Raised for invalid rules, and for questions that need asking when
+    prompts aren't allowed
+    '''
+    pass
+
+
+class Policy(object):
+    '''
+    Decides the questions asked during a sync
+    '''
+
+    def __init__(self, rules=(), interactive=True, ask=yn):
+        '''
+        :param rules:       A list of rules, as ``name=value`` strings.  Later
+                            rules override earlier ones
+        :param interactive: If False, questions with the rule ask raise a
+                            :class:`PolicyError` rather than prompting
+        :param ask:         The function used to prompt, as
+                            :func:`synchg.utils.yn`
+        :raises:            :class:`PolicyError` if a rule is invalid
+        '''
+        self.interactive = interactive
+        self._ask = ask
+        self._rules = {}
+        for rule in rules:
+            name, _, value = rule.partition('=')
+            self.Set(name, value)
+
+    def Set(self, name, value):
+        '''
+        Sets the rule for a question
+
+        :param name:    The name of the question
+        :param value:   always, never, ask or auto
+        '''
+        if name not in _Auto:
+            raise PolicyError('Unknown policy question: {0}'.format(name))
+        if value not in _Values:
+            raise PolicyError(
+                    'Invalid policy for {0}: {1} (expected {2})'.format(
+                        name, value, ', '.join(_Values)
+                        )
+                    )
+        self._rules[name] = value
+
+    def Rule(self, name):
+        ''' Gets the rule for a question.  Unset rules are ask '''
+        return self._rules.get(name, 'ask')
+
+    def Rules(self):
+        ''' Gets the rules that have been set, as ``name=value`` strings '''
+        return [
+                '{0}={1}'.format(name, self._rules[name])
+                for name, _, _ in Questions if name in self._rules
+                ]
+
+    def Decide(self, name, prompt, default='y'):
+        '''
+        Decides a question, prompting if the policy says to ask
+
+        :param name:    The name of the question
+        :param prompt:  The question to ask
+        :param default: The default answer to the prompt, y or n
+        :returns:       True if the answer is yes
+        :raises:        :class:`PolicyError` if the question needs asking
+                        and prompts aren't allowed
+        '''
+        rule = self.Rule(name)
+        if rule == 'auto':
+            return _Auto[name]
+        if rule != 'ask':
+            return rule == 'always'
+        if not self.interactive:
+            raise PolicyError(
+                    '{0} (set policy = {1}=always, never or auto to '
+                    'answer this without a prompt)'.format(prompt, name)
+                    )
+        return self._ask(prompt, default=default)
+
+
+def AskUpFront(policies, ask=yn, names=None):
+    '''
+    Asks every question that the policies would ask, once, before any syncs
+    start, and records the answers as rules.  Syncs run in parallel can then
+    run without prompting.  Policies that aren't interactive are left as they
+    are.
+
+    :param policies:    A dictionary mapping a label (such as a hostname) to
+                        the :class:`Policy` of it's sync
+    :param ask:         The function used to prompt, as
+                        :func:`synchg.utils.yn`
+    :param names:       The names of the questions that the syncs can ask.
+                        If None, every question is asked
+    '''
+    for name, auto, question in Questions:
+        if names is not None and name not in names:
+            continue
+        labels = sorted(
+                label for label, policy in policies.iteritems()
+                if policy.interactive and policy.Rule(name) == 'ask'
+                )
+        if not labels:
+            continue
+        answer = ask(
+                '{0} ({1})'.format(question, ', '.join(labels)),
+                default='y' if auto else 'n'
+                )
+        for label in labels:
+            policies[label].Set(name, 'always' if answer else 'never')
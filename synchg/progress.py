@@ -0,0 +1,253 @@
+'''
+This module reports the progress of long running transfers: hg pushes and
+clones, and the data synchg sends itself.  hg is made to write it's progress
+output to stderr, which is parsed as the command runs.  Each update is passed
+to a progress callback as a :class:`Progress`, with the current throughput
+and an estimate of the time remaining.  :class:`ConsoleProgress` is a
+callback that renders a status line on the terminal.
+'''
+
+import os
+import re
+import sys
+import time
+import threading
+from collections import namedtuple
+from plumbum.commands import ProcessExecutionError
+
+__all__ = [
+        'Progress', 'ProgressTracker', 'ProgressParser', 'ConsoleProgress',
+        'RunWithProgress'
+        ]
+
+# An update on the progress of a transfer
+#   topic:  What is being done, e.g. bundling or sending
+#   pos:    The number of units done
+#   total:  The total number of units, or None if unknown
+#   unit:   The unit of pos & total, e.g. changesets, files or bytes
+#   rate:   The average units per second so far, or None if unknown
+#   eta:    The estimated number of seconds remaining, or None if unknown
+#   done:   True for the final update of a topic
+Progress = namedtuple(
+        'Progress', ['topic', 'pos', 'total', 'unit', 'rate', 'eta', 'done']
+        )
+
+# Config that makes hg write simple progress lines to stderr, even though
+# it's not attached to a terminal
+HgProgressArgs = (
+        '--config', 'progress.assume-tty=true',
+        '--config', 'progress.disable=false',
+        '--config', 'progress.delay=0',
+        '--config', 'progress.refresh=0.2',
+        '--config', 'progress.format=topic number unit',
+        )
+
+# HGPLAIN turns off progress output unless it's excepted
+_ProgressEnvironment = {'HGPLAINEXCEPT': 'progress'}
+
+# Matches a progress line written with HgProgressArgs, e.g.
+# "bundling  3/10 changesets"
+_ProgressRegexp = re.compile(
+        r'^(?P<topic>\S.*?)\s+(?P<pos>\d+)(?:/(?P<total>\d+))?'
+        r'(?:\s+(?P<unit>\S+))?\s*$'
+        )
+
+_ReadSize = 4096
+
+
+class ProgressTracker(object):
+    '''
+    Works out the throughput & time remaining of transfers, and passes
+    updates on to a progress callback
+    '''
+
+    def __init__(self, callback, clock=time.time):
+        '''
+        :param callback:    A function taking a :class:`Progress`
+        :param clock:       The function used to get the time
+        '''
+        self._callback = callback
+        self._clock = clock
+        # (topic, unit) -> [start time, last Progress], and the order they
+        # were first reported in
+        self._topics = {}
+        self._order = []
+
+    def Update(self, topic, pos, total=None, unit=None):
+        '''
+        Reports progress on a topic
+
+        :param topic:   What is being done
+        :param pos:     The number of units done
+        :param total:   The total number of units, or None if unknown
+        :param unit:    The unit of pos & total
+        '''
+        now = self._clock()
+        key = (topic, unit)
+        if key not in self._topics:
+            self._topics[key] = [now, None]
+            self._order.append(key)
+        start = self._topics[key][0]
+        elapsed = now - start
+        rate = eta = None
+        if elapsed > 0 and pos:
+            rate = pos / elapsed
+            if total is not None:
+                eta = max(total - pos, 0) / rate
+        progress = Progress(topic, pos, total, unit, rate, eta, False)
+        self._topics[key][1] = progress
+        self._callback(progress)
+
+    def Finish(self):
+        '''
+        Sends a final update for each topic & unit that has been reported,
+        in the order they were first reported
+        '''
+        for key in self._order:
+            last = self._topics[key][1]
+            self._callback(last._replace(eta=0, done=True))
+        self._topics = {}
+        self._order = []
+
+
+class ProgressParser(object):
+    '''
+    Parses hg's progress output.  Lines that aren't progress are kept, so
+    that errors can be reported.
+    '''
+
+    def __init__(self, tracker):
+        '''
+        :param tracker: The :class:`ProgressTracker` to report progress to
+        '''
+        self._tracker = tracker
+        self._partial = ''
+        self.other = []
+
+    def Feed(self, data):
+        '''
+        Parses some output.  Partial lines are kept until the rest arrives.
+
+        :param data:    A string of hg's stderr
+        '''
+        lines = re.split(r'[\r\n]', self._partial + data)
+        self._partial = lines.pop()
+        for line in lines:
+            self._Line(line)
+
+    def Close(self):
+        ''' Parses any remaining partial line '''
+        if self._partial:
+            self._Line(self._partial)
+            self._partial = ''
+
+    def _Line(self, line):
+        if not line.strip():
+            return
+        match = _ProgressRegexp.match(line)
+        if match:
+            total = match.group('total')
+            self._tracker.Update(
+                    match.group('topic').strip(),
+                    int(match.group('pos')),
+                    int(total) if total is not None else None,
+                    match.group('unit')
+                    )
+        else:
+            self.other.append(line)
+
+
+def RunWithProgress(machine, hg, args, callback):
+    '''
+    Runs an hg command, passing it's progress to a callback.  stdout is read
+    on another thread, so that a command writing a lot of output can't
+    block.
+
+    :param machine:     The plumbum machine the command runs on
+    :param hg:          The hg command to run
+    :param args:        The arguments to pass to hg
+    :param callback:    A function taking a :class:`Progress`
+    :returns:           The stdout of the command
+    '''
+    tracker = ProgressTracker(callback)
+    parser = ProgressParser(tracker)
+    with machine.env(**_ProgressEnvironment):
+        proc = hg[HgProgressArgs].popen(args)
+    stdout = []
+    reader = threading.Thread(
+            target=lambda: stdout.append(proc.stdout.read())
+            )
+    reader.daemon = True
+    reader.start()
+    for data in iter(lambda: os.read(proc.stderr.fileno(), _ReadSize), ''):
+        parser.Feed(data)
+    parser.Close()
+    reader.join()
+    proc.wait()
+    tracker.Finish()
+    stdout = stdout[0] if stdout else ''
+    if proc.returncode != 0:
+        raise ProcessExecutionError(
+                args, proc.returncode, stdout, '\n'.join(parser.other)
+                )
+    return stdout
+
+
+def _FormatAmount(amount, unit):
+    ''' Formats an amount of a unit, scaling bytes to KB or MB '''
+    if unit == 'bytes':
+        for scale, suffix in ((1024 * 1024, 'MB'), (1024, 'KB')):
+            if amount >= scale:
+                return '{0:.1f}{1}'.format(amount / float(scale), suffix)
+        return '{0}B'.format(int(amount))
+    if isinstance(amount, float):
+        return '{0:.1f}'.format(amount)
+    return str(amount)
+
+
+class ConsoleProgress(object):
+    '''
+    A progress callback that renders the latest update as a single status
+    line on a terminal
+    '''
+
+    def __init__(self, stream=None):
+        '''
+        :param stream:  The stream to write to.  Defaults to stdout
+        '''
+        self._stream = stream or sys.stdout
+        self._width = 0
+
+    def Format(self, progress):
+        '''
+        Formats an update as a line of text
+
+        :param progress:    A :class:`Progress`
+        :returns:           A string
+        '''
+        unit = progress.unit or ''
+        amount = _FormatAmount(progress.pos, unit)
+        if progress.total is not None:
+            amount += '/' + _FormatAmount(progress.total, unit)
+        parts = [progress.topic, amount]
+        if unit != 'bytes':
+            parts.append(unit)
+        if progress.rate:
+            parts.append('({0}{1}/s)'.format(
+                    _FormatAmount(progress.rate, unit),
+                    '' if unit == 'bytes' else ' ' + unit
+                    ))
+        if progress.eta is not None and not progress.done:
+            minutes, seconds = divmod(int(progress.eta), 60)
+            parts.append('ETA {0}:{1:02}'.format(minutes, seconds))
+        return '  ' + ' '.join(part for part in parts if part)
+
+    def __call__(self, progress):
+        line = self.Format(progress)
+        padding = ' ' * max(self._width - len(line), 0)
+        self._stream.write('\r' + line + padding)
+        self._width = len(line)
+        if progress.done:
+            self._stream.write('\n')
+            self._width = 0
+        self._stream.flush()
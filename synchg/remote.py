@@ -9,10 +9,27 @@ def RemoteMachine(*pargs, **kwargs):
     Remote machine constructor function.  Forwards all arguments on to the
     appropriate constructor for this platform.  On windows this is
     ``plumbum.PuttyMachine`` and on other platforms `plumbum.SshMachine`
+
+    If the ``backend`` keyword argument is ``paramiko``, a
+    :class:`synchg.paramikomachine.ParamikoMachine` is returned instead.
+
+    The ``connect_timeout`` keyword argument sets the number of seconds to
+    wait for the connection.  It's ignored by ``PuttyMachine``, as plink has
+    no such setting.
     '''
+    backend = kwargs.pop('backend', 'ssh')
+    timeout = kwargs.pop('connect_timeout', None)
+    if backend == 'paramiko':
+        # Imported here so paramiko is only needed by those that use it
+        from paramikomachine import ParamikoMachine
+        if timeout:
+            kwargs['timeout'] = timeout
+        return ParamikoMachine(*pargs, **kwargs)
     if _WIN32:
         return PuttyMachine(*pargs, **kwargs)
     else:
+        if timeout:
+            kwargs['ssh_opts'] = tuple(kwargs.get('ssh_opts', ())) + (
+                    '-o', 'ConnectTimeout={0}'.format(timeout)
+                    )
         return SshMachine(*pargs, **kwargs)
-
-
@@ -1,10 +1,19 @@
+import os
 import re
 import functools
 import copy
 from collections import namedtuple
 from ConfigParser import ConfigParser
+from StringIO import StringIO
 from contextlib import contextmanager
 from plumbum import ProcessExecutionError
+from plumbum.local_machine import LocalMachine
+from transfer import BuildArchive, SendData
+from cleanup import StaleMqRevset
+from progress import RunWithProgress
+from instrument import InstrumentedCommand
+from events import CommandRun
+from state import LockFile, WriteFile
 
 __all__ = ['Repo']
 
@@ -30,18 +39,82 @@ class Repo(object):
     ChangesetInfo = namedtuple('ChangesetInfo', ['hash', 'desc'])
     ChangesetInfoRegexp = re.compile(r'^(?P<hash>\w+)\t(?P<desc>.*)$')
 
+    # Matches a line of hg bookmarks output
+    BookmarkRegexp = re.compile(
+            r'^\s*\*?\s*(?P<name>.+?)'
+            r'\s+-?\d+:(?P<hash>\w+)'
+            )
+
+    # Template Parameter for hg log-style commands that need graph details
+    HgNodeTemplateParam = (
+            '{node}\\t{p1node}\\t{p2node}\\t{branch}\\t{desc|firstline}\\n'
+            )
+
+    # Contains details of a changeset along with it's parents and branch
+    ChangesetNodeInfo = namedtuple(
+            'ChangesetNodeInfo',
+            ['hash', 'p1', 'p2', 'branch', 'desc']
+            )
+    ChangesetNodeInfoRegexp = re.compile(
+            r'^(?P<hash>\w+)\t(?P<p1>\w+)\t(?P<p2>\w+)\t'
+            r'(?P<branch>[^\t]*)\t(?P<desc>.*)$'
+            )
+
+    # The commit message used when committing the mq repository
+    MqCommitMessage = 'synchg-commit'
+
+    # Revset matching the linear (merge free) history leading to the working
+    # directory.  This is the part of the history that histedit can rewrite
+    LinearRevset = '::. and not ::(merge() and ::.)'
+
+    # Config that enables the histedit extension
+    HisteditConfigParam = 'extensions.histedit='
+
+    # Config that enables creation of obsolescence markers
+    ObsoleteConfigParam = 'experimental.evolution=createmarkers'
+
+    # A shell alias that marks every changeset it's given obsolete in one hg
+    # invocation (and so one round trip to a remote)
+    ObsoleteAliasParam = (
+            'alias.synchg-obsolete=!'
+            'for node in $@; do '
+            '"$HG" --config ' + ObsoleteConfigParam + ' '
+            'debugobsolete "$node" || exit 1; '
+            'done'
+            )
+
+    # Config that enables the sparse extension
+    SparseConfigParam = 'extensions.sparse='
+
+    # Paths (relative to .hg) of the files used to apply uncommitted
+    # changes to a remote working copy
+    WorkingDiffPath = 'synchg/wcdiff.patch'
+    WorkingFilesPath = 'synchg/wcdiff.files'
+
     # Should be set to true during tests.
     Testing = False
 
-    def __init__(self, machine, remote=None):
+    def __init__(self, machine, remote=None, env=None, profile=None):
         '''
         :param machine:     The plumbum machine object to use
                             (can be a local machine or remote machine)
         :param remote:      The name of the remote repo to be used by
                             push, pull and other operations.
+        :param env:         An optional :class:`HostEnvironment` for the
+                            machine.  If set, commands will be run from their
+                            cached paths rather than being looked up.
+        :param profile:     An optional :class:`LeanProfile` to run hg with
         '''
         self.machine = machine
-        self.hg = self.machine['hg']
+        self.env = env
+        self.profile = profile
+        # The (name, value) pairs of the settings passed to hg with
+        # --config, for backends that don't run hg to pass them to
+        self.hgConfig = []
+        self._listener = None
+        self.hg = self.Command('hg')
+        if profile:
+            self.hg = profile.Wrap(machine, self.hg)
         self.remote = remote
         try:
             self._path = copy.copy(self.machine.cwd)
@@ -52,20 +125,118 @@ class Repo(object):
             else:
                 raise
         self._currentRev = self._branch = None
+        self._supportsObsolescence = None
         self.prevLevel = None
+        # If set, patches will be pushed & popped with --keep-changes
+        self.keepChanges = False
+        # The gzip level of archives sent to other repositories, and the
+        # number of changesets to push at a time (0 for all at once)
+        self.compressionLevel = 9
+        self.pushBatch = 0
+        # The rate (bytes per second) data is sent to this repository at by
+        # synchg itself.  0 means no limit
+        self.rateLimit = 0
+        # An optional callback for the progress of pushes, clones & data sent
+        # to this repository
+        self.progress = None
         self._config = self._mqconfig = None
 
+    def Command(self, name):
+        '''
+        Gets a command on the machine this repository is on
+
+        :param name:    The name of the command
+        :returns:       A plumbum command (or :class:`ResolvedCommand`)
+        '''
+        command = self.env[name] if self.env else self.machine[name]
+        if self._listener:
+            command = InstrumentedCommand(command, [name], self._Report)
+        return command
+
+    def Instrument(self, listener):
+        '''
+        Reports every command this repository runs from now on
+
+        :param listener:    A function that is passed a
+                            :class:`synchg.events.CommandRun` for each
+                            command
+        '''
+        self._listener = listener
+        self.hg = InstrumentedCommand(self.hg, ['hg'], self._Report)
+
+    def _Report(self, argv, duration, retcode, outputSize):
+        ''' Passes a finished command on to the listener '''
+        if isinstance(self.machine, LocalMachine):
+            machine = 'local'
+            # Local commands connect to the remote when they're given it's
+            # name or an ssh url
+            remote = any(
+                    arg == self.remote or arg.startswith('ssh://')
+                    for arg in argv
+                    )
+        else:
+            machine = str(self.machine)
+            remote = True
+        self._listener(CommandRun(
+                argv, machine, str(self.machine.cwd), duration, retcode,
+                outputSize, remote
+                ))
+
+    def UseSsh(self, command):
+        '''
+        Sets the ssh command that hg uses to connect to remote repositories
+
+        :param command: The ssh command line, as for hg's ``ui.ssh``
+        '''
+        self.hgConfig.append(('ui.ssh', command))
+        self.hg = self.hg['--config', 'ui.ssh=' + command]
+
+    def UseLockTimeout(self, timeout):
+        '''
+        Sets how long hg waits for the repository lock before giving up
+
+        :param timeout: The timeout in seconds, as for hg's ``ui.timeout``.
+                        0 fails straight away if the lock is held
+        '''
+        self.hgConfig.append(('ui.timeout', str(timeout)))
+        self.hg = self.hg['--config', 'ui.timeout={0}'.format(timeout)]
+
+    def _Transfer(self, *args):
+        '''
+        Runs an hg command that transfers changesets, reporting it's progress
+        to :attr:`progress` if set
+
+        :returns:   The stdout of the command
+        '''
+        if self.progress:
+            return RunWithProgress(self.machine, self.hg, args, self.progress)
+        return self.hg(*args)
+
     @contextmanager
     def CleanMq(self):
         '''
         Returns a context manager that keeps the mq repository clean
-        for it's lifetime
+        for it's lifetime.  The patches are pushed again afterwards, even if
+        an exception is raised.
         '''
         revertTo = self.lastAppliedPatch
         self.PopPatch()
-        yield
-        if revertTo:
-            self.PushPatch(revertTo)
+        try:
+            yield
+        finally:
+            if revertTo:
+                self.PushPatch(revertTo)
+
+    def LockWorkingCopy(self):
+        '''
+        Locks the working copy of a local repository against other syncs.
+        Syncs read & change the mq state of the working copy (refreshing and
+        committing patches), so syncs of it to several hosts at once, such
+        as a fleet sync, must take turns while they do.
+
+        :returns:   A context manager that holds the lock
+        '''
+        return LockFile(str(self._path / '.hg' / 'synchg-working-copy'))
 
     def _CleanMq(func):
         '''
@@ -75,9 +246,9 @@ class Repo(object):
         :params func:   The function to decorate
         '''
         @functools.wraps(func)
-        def InnerFunc(self, *pargs):
+        def InnerFunc(self, *pargs, **kwargs):
             with self.CleanMq():
-                return func(self, *pargs)
+                return func(self, *pargs, **kwargs)
         return InnerFunc
 
     @property
@@ -134,6 +305,28 @@ class Repo(object):
             self._CheckCurrentRev()
         return self._branch
 
+    @property
+    def path(self):
+        '''
+        Gets the path to the repository
+
+        :returns:   A plumbum path
+        '''
+        return self._path
+
+    @property
+    def baseRev(self):
+        '''
+        Gets the revision that the applied mq patches are based on, or the
+        current revision if no patches are applied.  Unlike
+        :attr:`currentRev` this does not need any patches popped, and is
+        not cached.
+
+        :returns:   A string containing the revision hash
+        '''
+        rev = 'qparent' if self.lastAppliedPatch else '.'
+        return self.hg('log', '-r', rev, '--template', '{node|short}').strip()
+
     @property
     def config(self):
         '''
@@ -156,6 +349,58 @@ class Repo(object):
             self._mqconfig = RepoConfig(self._path / '.hg' / 'patches')
         return self._mqconfig
 
+    @property
+    def sparseRules(self):
+        '''
+        Gets the sparse checkout rules for the working copy
+
+        :returns:   A tuple of (includes, excludes) lists.  Both will be empty
+                    if the working copy is not sparse.
+        '''
+        rules = {'include': [], 'exclude': []}
+        path = self._path / '.hg' / 'sparse'
+        if path.exists():
+            section = None
+            for line in path.read().splitlines():
+                line = line.strip()
+                if line.startswith('[') and line.endswith(']'):
+                    section = rules.get(line[1:-1])
+                elif line and not line.startswith('#') and section is not None:
+                    section.append(line)
+        return rules['include'], rules['exclude']
+
+    def SetSparse(self, includes, excludes):
+        '''
+        Sets the sparse checkout rules for the working copy, and enables the
+        sparse extension in the repository hgrc so that later updates only
+        write files that match the rules.  The rules are replaced in one go
+        and applied with a single refresh, so the working copy never passes
+        through a full checkout.  Nothing is done if the rules are unchanged.
+        If there are no rules, the rules are cleared so that the working copy
+        is full again.
+
+        :param includes:    A list of patterns to include
+        :param excludes:    A list of patterns to exclude
+        '''
+        includes, excludes = list(includes), list(excludes)
+        if includes or excludes:
+            if self.config.Get('extensions', 'sparse') is None:
+                self.config.Set('extensions', 'sparse', '')
+        if self.sparseRules == (includes, excludes):
+            return
+        contents = ''
+        if includes or excludes:
+            lines = ['[include]'] + includes + ['[exclude]'] + excludes
+            contents = '\n'.join(lines) + '\n'
+        SendData(
+                self.Command('sh')[
+                    '-c', RepoConfig._RemoteWriteScript,
+                    self._path / '.hg' / 'sparse'
+                    ],
+                contents
+                )
+        self.hg('--config', self.SparseConfigParam, 'debugsparse', '--refresh')
+
     @_CleanMq
     def _CheckCurrentRev( self ):
         ''' Gets the current revision and branch and stores it '''
@@ -202,7 +447,6 @@ class Repo(object):
         return [self.ChangesetInfo(**match.groupdict()) for match in matches]
 
     @property
-    @_CleanMq
     def outgoings(self):
         '''
         Gets the outgoing changesets to `self.remote`
@@ -210,16 +454,9 @@ class Repo(object):
         :returns:   A list containing :class:`ChangesetInfo` that represent
                     the current outgoing changesets
         '''
-        assert self.remote
-        return self._GetChangesetInfoList(
-                self.hg[ 'outgoing', '-b', self.branch, '-r', self.currentRev,
-                         '--template', self.HgTemplateParam, self.remote
-                         ],
-                headerLines=2
-                )
+        return self.FindOutgoings()
 
     @property
-    @_CleanMq
     def incomings(self):
         '''
         Gets the incoming changesets from `self.remote`
@@ -227,14 +464,124 @@ class Repo(object):
         :returns:   A list containing :class:`ChangesetInfo` that represent
                     the current incoming changesets
         '''
+        return self.FindIncomings()
+
+    @staticmethod
+    def _TargetArgs(revs, branches):
+        ''' Builds the -b & -r arguments for push-like commands '''
+        args = []
+        for branch in branches:
+            args += ['-b', branch]
+        for rev in revs:
+            args += ['-r', rev]
+        return args
+
+    def FindOutgoings(self, revs=None, branches=None):
+        '''
+        Gets the changesets that would be pushed to `self.remote` for a set
+        of revisions and branches.  Applied mq patches are only popped if
+        the branches aren't given, so the revisions given shouldn't include
+        them.
+
+        :param revs:        A list of revisions (or revsets) to push.
+                            Defaults to the current revision.
+        :param branches:    A list of branches to push.
+                            Defaults to the current branch.
+        :returns:           A list containing :class:`ChangesetInfo`
+        '''
         assert self.remote
-        return self._GetChangesetInfoList(
-                self.hg[ 'incoming', '-b', self.branch,
-                         '--template', self.HgTemplateParam, self.remote
-                         ],
-                headerLines=2
+        if branches is None:
+            # The heads of the current branch include any applied patches
+            with self.CleanMq():
+                return self.FindOutgoings(revs, [self.branch])
+        if revs is None:
+            revs = [self.currentRev]
+        args = ['outgoing'] + self._TargetArgs(revs, branches)
+        args += ['--template', self.HgTemplateParam, self.remote]
+        return self._GetChangesetInfoList(self.hg[tuple(args)], headerLines=2)
+
+    def FindIncomings(self, branches=None):
+        '''
+        Gets the changesets on some branches of `self.remote` that are not
+        present locally
+
+        :param branches:    A list of branches to check.
+                            Defaults to the current branch.
+        :returns:           A list containing :class:`ChangesetInfo`
+        '''
+        assert self.remote
+        if branches is None:
+            branches = [self.branch]
+        return self._Incomings(branches)
+
+    def _Incomings(self, branches):
+        ''' Runs hg incoming for some branches of `self.remote` '''
+        args = ['incoming'] + self._TargetArgs([], branches)
+        args += ['--template', self.HgTemplateParam, self.remote]
+        return self._GetChangesetInfoList(self.hg[tuple(args)], headerLines=2)
+
+    @property
+    def bookmarks(self):
+        '''
+        Gets the bookmarks in the repository
+
+        :returns:   A dictionary of bookmark name to short changeset hash
+        '''
+        bookmarks = {}
+        for line in self.hg('bookmarks').splitlines():
+            match = self.BookmarkRegexp.match(line)
+            if match:
+                bookmarks[match.group('name')] = match.group('hash')
+        return bookmarks
+
+    def BranchesOf(self, revs):
+        '''
+        Gets the branches that some revisions are on
+
+        :param revs:    A list of revisions (or revsets)
+        :returns:       A set of branch names
+        '''
+        if not revs:
+            return set()
+        revset = ' or '.join('({0})'.format(rev) for rev in revs)
+        return set(self._RunListCommand(
+                self.hg['log', '-r', revset, '--template', '{branch}\\n']
+                ))
+
+    @property
+    def heads(self):
+        '''
+        Gets the topological heads of the repository.  Note that this includes
+        any applied mq patches
+
+        :returns:   A list of changeset hash strings
+        '''
+        return self._RunListCommand(
+                self.hg['log', '-r', 'heads(all())', '--template', '{node}\\n']
                 )
 
+    def Log(self, revset=None, mq=False):
+        '''
+        Gets graph information for a set of changesets
+
+        :param revset:  A revset specifying the changesets to return.
+                        If None, all changesets will be returned
+        :param mq:      If True, the changesets will be read from the mq
+                        repository
+        :returns:       A list of :class:`ChangesetNodeInfo`
+        '''
+        args = ['log', '--template', self.HgNodeTemplateParam]
+        if mq:
+            args.insert(1, '--mq')
+        if revset:
+            args += ['-r', revset]
+        lines = self._RunListCommand(self.hg[tuple(args)])
+        matches = (self.ChangesetNodeInfoRegexp.match(line) for line in lines)
+        return [
+                self.ChangesetNodeInfo(**match.groupdict())
+                for match in matches if match
+                ]
+
     @property
     def lastAppliedPatch(self):
         '''
@@ -251,17 +598,50 @@ class Repo(object):
                 raise
         return None
 
-    @_CleanMq
-    def PushToRemote(self):
-        ''' Pushes to the remote repository at `self.remote`'''
+    def PushToRemote(self, revs=None, branches=None, bookmarks=None):
+        '''
+        Pushes to the remote repository at `self.remote`.  Like
+        :meth:`FindOutgoings`, applied mq patches are only popped if the
+        branches aren't given.
+
+        :param revs:        A list of revisions (or revsets) to push.
+                            Defaults to the current revision.
+        :param branches:    A list of branches to push.
+                            Defaults to the current branch.
+        :param bookmarks:   A list of bookmarks to push.  These will all be
+                            moved on the remote in the same transaction as
+                            the push.
+        '''
         assert self.remote
-        self.hg('push', '-b', self.branch, '-r', self.currentRev, self.remote)
+        if branches is None:
+            with self.CleanMq():
+                return self.PushToRemote(revs, [self.branch], bookmarks)
+        if revs is None:
+            revs = [self.currentRev]
+        args = ['push'] + self._TargetArgs(revs, branches)
+        for bookmark in bookmarks or []:
+            args += ['-B', bookmark]
+        try:
+            self._Transfer(*(args + [self.remote]))
+        except ProcessExecutionError as e:
+            if e.retcode != 1 or not bookmarks:
+                # 1 means there were no changesets to push, which is
+                # expected if we were just moving bookmarks
+                raise
+
+    def PushMqToRemote(self, force=False):
+        '''
+        Pushes the mq repo to the remote at `self.remote`
 
-    def PushMqToRemote(self):
-        ''' Pushes the mq repo to the remote at `self.remote` '''
+        :param force:   If True, the push will be forced.  This is needed
+                        after the mq history has been rewritten
+        '''
         assert self.remote
+        args = ['push', '--mq', self.remote]
+        if force:
+            args.insert(2, '-f')
         try:
-            self.hg('push', '--mq', self.remote)
+            self._Transfer(*args)
         except ProcessExecutionError as e:
             if e.retcode != 1:
                 #1 just means there's no outgoings
@@ -279,7 +659,7 @@ class Repo(object):
         if level:
             if patch is None:
                 patch = '-a'
-            self.hg('qpop', patch)
+            self.hg('qpop', *self._KeepChangesArgs(patch))
 
     def PushPatch(self, patch=None):
         '''
@@ -290,17 +670,167 @@ class Repo(object):
         '''
         if patch is None:
             patch = '-a'
-        self.hg('qpush', patch)
+        self.hg('qpush', *self._KeepChangesArgs(patch))
+
+    def _KeepChangesArgs(self, patch):
+        ''' Builds the arguments for qpush & qpop '''
+        if self.keepChanges:
+            return ['--keep-changes', patch]
+        return [patch]
+
+    def WorkingChanges(self, unknown=False):
+        '''
+        Gets the files with uncommitted changes in the working copy.  Unlike
+        :attr:`summary` this includes files that have only been added,
+        removed or deleted.
+
+        :param unknown: If True, untracked files are included
+        :returns:       A list of paths relative to the repository root
+        '''
+        return self._StatusList('-mardu' if unknown else '-mard')
+
+    def _StatusList(self, flag):
+        '''
+        Gets a list of files from hg status
+
+        :param flag:    The hg status flag for the files to list
+        :returns:       A list of paths relative to the repository root
+        '''
+        return self._RunListCommand(self.hg['status', flag, '--no-status'])
+
+    def _RunRaw(self, *args):
+        '''
+        Runs an hg command, returning it's output without decoding it.
+
+        :returns:   The stdout of the command as a string
+        '''
+        proc = self.hg.popen(args)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            raise ProcessExecutionError(args, proc.returncode, stdout, stderr)
+        return stdout
+
+    def WorkingCopyArchive(self):
+        '''
+        Builds an archive of the uncommitted changes in the working copy.
+        This contains a git format diff of the changes to tracked files, any
+        untracked files, and a list of the files that would need deleted to
+        undo the changes.
+
+        :returns:   The archive as a string, for passing to
+                    :meth:`ApplyWorkingCopyArchive` on another repository
+        '''
+        unknown = self._StatusList('--unknown')
+        added = self._StatusList('--added')
+        diff = self._RunRaw('diff', '--git')
+        return BuildArchive(self._path, unknown, {
+            '.hg/' + self.WorkingDiffPath: diff,
+            '.hg/' + self.WorkingFilesPath: '\n'.join(unknown + added)
+            }, level=self.compressionLevel)
+
+    def ApplyWorkingCopyArchive(self, archive):
+        '''
+        Applies uncommitted changes from another working copy.  The changes
+        can be removed again with :meth:`ResetWorkingCopy`
+
+        :param archive: An archive from :meth:`WorkingCopyArchive`
+        '''
+        tar = self.Command('tar')['xzf', '-', '-C', str(self._path)]
+        SendData(tar, archive, self.rateLimit, self.progress)
+        diff = self._path / '.hg' / self.WorkingDiffPath
+        if diff.stat().st_size:
+            self.hg('import', '--no-commit', str(diff))
+
+    def ResetWorkingCopy(self):
+        '''
+        Removes any uncommitted changes that were added by
+        :meth:`ApplyWorkingCopyArchive`
+
+        :returns:   True if there were changes to remove
+        '''
+        files = self._path / '.hg' / self.WorkingFilesPath
+        if not files.exists():
+            return False
+        paths = [
+                str(self._path / path)
+                for path in files.read().splitlines() if path
+                ]
+        self.hg('revert', '--all', '--no-backup')
+        if paths:
+            self.Command('rm')('-f', *paths)
+        files.delete()
+        (self._path / '.hg' / self.WorkingDiffPath).delete()
+        return True
 
     @_CleanMq
-    def Strip(self, changesets):
+    def Strip(self, changesets, backup=True):
         '''
         Strips changesets from this repository
 
         :param changesets:  A list of :class:`ChangesetInfo`
                             representing the changesets to strip
+        :param backup:      If False, no backup bundle will be written
+        '''
+        args = [cs.hash for cs in changesets]
+        if not backup:
+            args.insert(0, '--no-backup')
+        self.hg('strip', *args)
+
+    @property
+    def supportsObsolescence(self):
+        '''
+        Checks whether this repository supports obsolescence markers
+        This property is cached
+
+        :returns:   True if markers are supported
+        '''
+        if self._supportsObsolescence is None:
+            try:
+                self.hg('debugobsolete')
+                self._supportsObsolescence = True
+            except ProcessExecutionError:
+                self._supportsObsolescence = False
+        return self._supportsObsolescence
+
+    @_CleanMq
+    def Obsolete(self, changesets):
+        '''
+        Hides changesets in this repository by marking them obsolete with
+        no successors.  Unlike :meth:`Strip` this does not rewrite any
+        revlogs.  The changesets can be physically removed later by calling
+        :meth:`Compact`
+
+        :param changesets:  A list of :class:`ChangesetInfo`
+                            representing the changesets to hide
+        '''
+        if changesets:
+            hashes = [cs.hash for cs in changesets]
+            # Markers don't hide public changesets, and changesets pushed to
+            # a publishing remote are public, so make them draft first
+            self.hg('phase', '--draft', '--force', *hashes)
+            self.hg(
+                    '--config', self.ObsoleteAliasParam, 'synchg-obsolete',
+                    *hashes
+                    )
+
+    @_CleanMq
+    def Compact(self, backup=True):
         '''
-        self.hg('strip', *[cs.hash for cs in changesets])
+        Strips any obsolete changesets from this repository
+
+        :param backup:  If False, no backup bundle will be written
+        :returns:       The number of changesets that were stripped
+        '''
+        obsolete = self._RunListCommand(
+                self.hg['--hidden', 'log', '-r', 'obsolete()',
+                        '--template', '{node}\\n']
+                )
+        if obsolete:
+            args = ['--hidden', 'strip', '-r', 'obsolete()']
+            if not backup:
+                args.append('--no-backup')
+            self.hg(*args)
+        return len(obsolete)
 
     @_CleanMq
     def Update(self, changeset):
@@ -315,11 +845,18 @@ class Repo(object):
             changeset = changeset.hash
         self.hg('update', changeset)
 
-    def UpdateMq(self):
+    def UpdateMq(self, rev=None):
         '''
-        Updates the mq repository to tip
+        Updates the mq repository to tip, or to a revision
+
+        :param rev:     The revision to update to.  This can be on another
+                        line of history, such as one pushed with force, and
+                        any uncommitted changes to the patches are discarded.
         '''
-        self.hg('update', '--mq')
+        if rev:
+            self.hg('update', '--mq', '-C', rev)
+        else:
+            self.hg('update', '--mq')
 
     def RefreshMq(self):
         '''
@@ -334,7 +871,7 @@ class Repo(object):
         :param msg:     An optional commit message
         '''
         if not msg:
-            msg = 'synchg-commit'
+            msg = self.MqCommitMessage
         try:
             self.hg('commit', '--mq', '-m', msg)
         except ProcessExecutionError as e:
@@ -342,6 +879,103 @@ class Repo(object):
                 #1 just means there's no changes
                 raise
 
+    @property
+    def mqRev(self):
+        '''
+        Gets the revision of the mq repository's working directory
+
+        :returns:   A string containing the revision hash
+        '''
+        return self.hg(
+                'log', '--mq', '-r', '.', '--template', '{node}'
+                ).strip()
+
+    @property
+    def mqCommitCount(self):
+        '''
+        Gets the number of synchg-commit changesets in the history of the mq
+        repository
+
+        :returns:   An integer
+        '''
+        return len([
+                cs for cs in self.Log('::.', mq=True)
+                if cs.desc == self.MqCommitMessage
+                ])
+
+    def SquashMq(self):
+        '''
+        Collapses each run of consecutive synchg-commit changesets in the mq
+        repository into a single changeset, using histedit.  Only the linear
+        history leading to the mq working directory is rewritten.  The mq
+        repository should have no uncommitted changes.
+
+        :returns:   True if any changesets were squashed
+        '''
+        history = self.Log(self.LinearRevset, mq=True)
+        rules = self._SquashRules(history, self.MqCommitMessage)
+        if not rules:
+            return False
+        root = rules[0][1]
+        # Changesets that have been pushed to the remote will be public,
+        # which histedit would refuse to change
+        self.hg(
+                'phase', '--mq', '--draft', '--force',
+                '-r', '{0}::.'.format(root)
+                )
+        commands = ''.join('{0} {1}\n'.format(*rule) for rule in rules)
+        histedit = self.hg[
+                '--config', self.HisteditConfigParam,
+                'histedit', '--mq', '--commands', '-', root
+                ]
+        (histedit << commands)()
+        return True
+
+    @staticmethod
+    def _SquashRules(history, message):
+        '''
+        Builds the histedit rules that squash runs of changesets with a
+        particular message
+
+        :param history: A linear list of :class:`ChangesetNodeInfo`, oldest
+                        first
+        :param message: The commit message of changesets to squash
+        :returns:       A list of (action, hash) tuples starting at the first
+                        changeset that needs rewritten, or an empty list if
+                        there is nothing to squash
+        '''
+        rules = []
+        previous = None
+        for cs in history:
+            squash = (
+                    previous is not None and
+                    previous.desc == message and cs.desc == message
+                    )
+            if squash and not rules:
+                rules.append(('pick', previous.hash))
+            if rules:
+                rules.append(('roll' if squash else 'pick', cs.hash))
+            previous = cs
+        return rules
+
+    def StripStaleMq(self, backup=True):
+        '''
+        Strips synchg-commit changesets from the mq repository that are not
+        ancestors of it's working directory.  These are left behind when the
+        mq history has been squashed elsewhere.  The working directory should
+        be moved to the new history first (see :meth:`UpdateMq`).
+
+        :param backup:  If False, no backup bundle will be written
+        :returns:       The number of changesets that were stripped
+        '''
+        stale = self.Log(StaleMqRevset, mq=True)
+        if stale:
+            args = ['strip', '--mq', '-r', StaleMqRevset]
+            if not backup:
+                args.insert(1, '--no-backup')
+            self.hg(*args)
+        return len(stale)
+
     def InitMq(self):
         '''
         Initialises the mq repository
@@ -388,26 +1022,146 @@ class Repo(object):
         :param destination:     The destination clone path
         :param remoteName:      The name of the remote to create (if any)
         '''
-        self.hg('clone', '.', destination)
+        self._Transfer('clone', '.', destination)
         if remoteName:
             config.AddRemote(remoteName, destination)
 
 
+def _CopyConfig(config):
+    '''
+    Copies a ConfigParser.  They can't be deep copied, as they hold compiled
+    regular expressions.
+    '''
+    result = ConfigParser()
+    result._defaults = copy.deepcopy(config._defaults)
+    result._sections = copy.deepcopy(config._sections)
+    return result
+
+
 class RepoConfig(object):
     '''
-    This class provides an abstraction around repository configuration files
+    This class provides an abstraction around repository configuration files.
+
+    Parsed local files are cached until their modification time, size,
+    inode or change time changes.  Edits are written as soon as they're made,
+    unless they're made inside :meth:`Batch`, in which case they're written
+    together at the end.
+    Writes replace the file atomically, and remote files are written with a
+    single remote command.
     '''
 
+    # Maps the paths of local config files to a tuple of their stamp (see
+    # _Stamp) when they were parsed, and the parsed ConfigParser
+    _Cache = {}
+
+    # Writes a remote config file from stdin, via a temporary file so that
+    # the file is replaced atomically.  The path is passed as $0
+    _RemoteWriteScript = 'cat > "$0.tmp.$$" && mv -f "$0.tmp.$$" "$0"'
+
     def __init__(self, path):
         '''
         :param path:    Plumbum path to the repository
         '''
-        self._config = ConfigParser()
         self._path = path / '.hg' / 'hgrc'
+        self._batching = 0
+        self._dirty = False
+        self._config = self._Load()
+
+    def _Load(self):
+        ''' Reads the config file, making sure it has a paths section '''
+        config = self._Read()
+        if not config.has_section('paths'):
+            config.add_section('paths')
+        return config
+
+    def _IsLocal(self):
+        return hasattr(self._path, 'open')
+
+    def _Stamp(self):
+        '''
+        Gets the (mtime, size, inode, ctime) of a local config file, or None
+        if it can't be found.  The inode & ctime catch rewrites that keep
+        the same size within the resolution of mtime.
+        '''
+        try:
+            stat = os.stat(str(self._path))
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size, stat.st_ino, stat.st_ctime)
+
+    def _Read(self):
+        '''
+        Reads the config file.  Remote plumbum paths can't be opened, so
+        their contents are read with a single remote command instead.
+        '''
+        config = ConfigParser()
+        if not self._IsLocal():
+            retcode, stdout, _ = self._path.remote['cat'][self._path].run(
+                    retcode=None
+                    )
+            if retcode == 0:
+                config.readfp(StringIO(stdout))
+            return config
+        key = str(self._path)
+        stamp = self._Stamp()
+        cached = self._Cache.get(key)
+        if stamp is not None and cached and cached[0] == stamp:
+            return _CopyConfig(cached[1])
         if self._path.exists():
-            self._config.readfp(self._path.open())
-        else:
-            self._config.add_section('paths')
+            with self._path.open() as f:
+                config.readfp(f)
+            if stamp is not None:
+                self._Cache[key] = (stamp, _CopyConfig(config))
+        return config
+
+    def _Write(self):
+        ''' Atomically writes the config file '''
+        data = StringIO()
+        self._config.write(data)
+        if not self._IsLocal():
+            remote = self._path.remote
+            SendData(
+                    remote['sh']['-c', self._RemoteWriteScript, self._path],
+                    data.getvalue()
+                    )
+            return
+        path = str(self._path)
+        WriteFile(path, data.getvalue())
+        stamp = self._Stamp()
+        if stamp is not None:
+            self._Cache[path] = (stamp, _CopyConfig(self._config))
+
+    def _Changed(self):
+        ''' Writes the config file, unless edits are being batched '''
+        self._dirty = True
+        if not self._batching:
+            self._Write()
+            self._dirty = False
+
+    @contextmanager
+    def Batch(self):
+        '''
+        A context manager that writes all the edits made within it at once,
+        when it exits.  Local configs are re-read when the outermost batch
+        starts, so the edits are made to the latest file.  If an exception
+        is raised the edits are discarded, and nothing is written.
+        '''
+        if not self._batching:
+            if self._IsLocal() and not self._dirty:
+                self._config = self._Load()
+            saved = (_CopyConfig(self._config), self._dirty)
+        self._batching += 1
+        try:
+            yield self
+        except:
+            if self._batching == 1:
+                self._config, self._dirty = saved
+            raise
+        finally:
+            self._batching -= 1
+        if not self._batching and self._dirty:
+            self._Write()
+            self._dirty = False
 
     def AddRemote(self, name, destination):
         '''
@@ -417,7 +1171,32 @@ class RepoConfig(object):
         :param destination: The destination path of the remote
         '''
         self._config.set('paths', name, destination)
-        self._config.write(self._path.open('w'))
+        self._Changed()
+
+    def Get(self, section, name, default=None):
+        '''
+        Gets a config value
+
+        :param section: The section of the config file
+        :param name:    The name of the value
+        :param default: The value to return if it's not set
+        '''
+        if self._config.has_option(section, name):
+            return self._config.get(section, name)
+        return default
+
+    def Set(self, section, name, value):
+        '''
+        Sets a config value, or overwrites it if it already exists
+
+        :param section: The section of the config file
+        :param name:    The name of the value
+        :param value:   The value to set
+        '''
+        if not self._config.has_section(section):
+            self._config.add_section(section)
+        self._config.set(section, name, value)
+        self._Changed()
 
     @property
     def remotes(self):
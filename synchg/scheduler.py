@@ -0,0 +1,191 @@
+'''
+This module provides a scheduler for programs that request syncs often, such
+as file watchers & editor hooks.  Requests are coalesced: for each host &
+repository there is at most one sync running and one pending.  A burst of
+requests becomes a single sync, once the requests have stopped for the
+``min_interval`` option, or once the first request has waited for the
+``max_staleness`` option.  Syncs always push the local state as it is when
+they start, so nothing requested is lost.
+
+Syncs run one at a time, even for different hosts & repositories: a sync
+changes the working directory & environment of the whole process, so syncs
+on separate threads would run in each other's directories.
+'''
+
+import sys
+import time
+import threading
+from collections import namedtuple
+from sync import SyncRemote, SyncOptions
+
+__all__ = ['SyncScheduler']
+
+# The arguments of a requested sync, as passed to :func:`SyncRemote`
+_SyncArgs = namedtuple(
+        '_SyncArgs',
+        ['host', 'name', 'localpath', 'remote_root', 'options', 'progress',
+         'events']
+        )
+
+
+class _Slot(object):
+    '''
+    The syncs of one host & repository
+    '''
+
+    def __init__(self):
+        self.pending = None
+        self.firstRequest = self.lastRequest = None
+        self.running = False
+
+
+class SyncScheduler(object):
+    '''
+    Coalesces requests to sync.  Syncs can either be run one at a time on a
+    background thread, by calling :meth:`Start`, or by calling
+    :meth:`RunPending` periodically.
+    '''
+
+    def __init__(self, sync=SyncRemote, onError=None, clock=time.time):
+        '''
+        :param sync:    The function that runs a sync
+        :param onError: An optional function called with the (host, name)
+                        of a sync & the exception it raised.  By default
+                        errors are written to stderr
+        :param clock:   The function used to get the time
+        '''
+        self._sync = sync
+        self._onError = onError or _ReportError
+        self._clock = clock
+        self._slots = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def Request(self, host, name, localpath, remote_root, options=None,
+                progress=None, events=None):
+        '''
+        Requests a sync.  The arguments are those of :func:`SyncRemote`.
+        If a sync of the same host & repository is already pending, this
+        request replaces it.
+        '''
+        if options is None:
+            options = SyncOptions()
+        args = _SyncArgs(
+                host, name, localpath, remote_root, options, progress, events
+                )
+        now = self._clock()
+        with self._cond:
+            slot = self._slots.setdefault((host, name), _Slot())
+            if slot.pending is None:
+                slot.firstRequest = now
+            slot.pending = args
+            slot.lastRequest = now
+            self._cond.notifyAll()
+
+    def _Due(self, slot):
+        ''' Gets the time that a slot's pending sync should start '''
+        options = slot.pending.options
+        return min(
+                slot.lastRequest + options.min_interval,
+                slot.firstRequest + options.max_staleness
+                )
+
+    def _TakeDue(self, now):
+        '''
+        Finds the pending syncs that are due, and marks them as running.
+        Should be called with the condition held.
+
+        :returns:   A tuple of a list of (key, args) of the syncs to run, and
+                    the number of seconds until the next sync is due (or
+                    None if there are none pending)
+        '''
+        due, wait = [], None
+        for key, slot in self._slots.iteritems():
+            if slot.pending is None or slot.running:
+                continue
+            start = self._Due(slot)
+            if start <= now:
+                due.append((key, slot.pending))
+                slot.pending = None
+                slot.running = True
+            elif wait is None or start - now < wait:
+                wait = start - now
+        return due, wait
+
+    def _Run(self, key, args):
+        ''' Runs a sync, and marks it's slot as free afterwards '''
+        try:
+            self._sync(*args)
+        except Exception as e:
+            self._onError(key, e)
+        finally:
+            with self._cond:
+                self._slots[key].running = False
+                self._cond.notifyAll()
+
+    def RunPending(self):
+        '''
+        Runs the pending syncs that are due, one after another on this
+        thread
+
+        :returns:   The number of seconds until the next sync is due, or None
+                    if there are none pending
+        '''
+        while True:
+            with self._cond:
+                due, wait = self._TakeDue(self._clock())
+            if not due:
+                return wait
+            for key, args in due:
+                self._Run(key, args)
+
+    def Start(self):
+        '''
+        Starts running syncs on a background thread, one at a time, as they
+        become due
+        '''
+        self._stopping = False
+        self._thread = threading.Thread(target=self._Dispatch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Stop(self):
+        '''
+        Stops starting syncs, and waits for the running syncs to finish.
+        Pending syncs are dropped.
+        '''
+        with self._cond:
+            self._stopping = True
+            self._cond.notifyAll()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        with self._cond:
+            while any(slot.running for slot in self._slots.itervalues()):
+                self._cond.wait()
+
+    def _Dispatch(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                due, wait = self._TakeDue(self._clock())
+                if not due:
+                    self._cond.wait(wait)
+                    continue
+            for key, args in due:
+                if self._stopping:
+                    # Drop the syncs that haven't started
+                    with self._cond:
+                        self._slots[key].running = False
+                        self._cond.notifyAll()
+                    continue
+                self._Run(key, args)
+
+
+def _ReportError(key, error):
+    host, name = key
+    sys.stderr.write(
+            'Error syncing {0} to {1}: {2}\n'.format(name, host, error)
+            )
@@ -1,9 +1,9 @@
 import os
+import sys
 import synchg
 from ConfigParser import ConfigParser, Error as ConfigParserError
 from plumbum import cli, local
-from clint import resources
-from .sync import SyncRemote, AbortException, SyncError
+from .userdir import UserDirectory
 
 
 class SyncHg(cli.Application):
@@ -21,15 +21,14 @@ class SyncHg(cli.Application):
         '''
         Reads the configuration
         '''
-        resources.init('obmarg', 'synchg')
         self.config = ConfigParser()
-        contents = resources.user.read(self.ConfigFileName)
-        if not contents:
+        if not self.config.read(self._config_path()):
             if not in_do_config:
                 print "Could not find config file"
                 self.do_config()
-        else:
-            self.config.readfp(resources.user.open(self.ConfigFileName))
+
+    def _config_path(self):
+        return os.path.join(UserDirectory(), self.ConfigFileName)
 
     name = cli.SwitchAttr(
             ['n', '--name'],
@@ -37,6 +36,60 @@ class SyncHg(cli.Application):
                  'Uses the local directory name by default'
             )
 
+    compact = cli.Flag(
+            ['--compact'],
+            help='Strip changesets that were hidden on the remote by '
+                 'strip_mode = obsolete, rather than syncing'
+            )
+
+    gc = cli.Flag(
+            ['--gc'],
+            help='Prune strip backups, stale mq commits and orphaned '
+                 'repositories on the remote, rather than syncing'
+            )
+
+    squash_mq = cli.Flag(
+            ['--squash-mq'],
+            help='Squash runs of synchg-commit changesets in the local & '
+                 'remote mq repositories, rather than syncing'
+            )
+
+    background = cli.Flag(
+            ['--background'],
+            help='Run at a lower priority, for syncs started by watchers '
+                 'or cron'
+            )
+
+    event_log = cli.SwitchAttr(
+            ['--event-log'],
+            help='Append the events of the sync to this file, as lines of '
+                 'JSON'
+            )
+
+    fleet = cli.Flag(
+            ['--fleet'],
+            help='Treat remote_host as the name of a fleet of hosts in '
+                 'config.ini, and sync to all of them'
+            )
+
+    policy = cli.SwitchAttr(
+            ['--policy'], list=True,
+            help='How to answer a question rather than asking, as '
+                 'NAME=always|never|ask|auto'
+            )
+
+    unattended = cli.Flag(
+            ['--unattended'],
+            help='Never prompt: questions the policy says to ask are '
+                 'errors'
+            )
+
+    trace = cli.SwitchAttr(
+            ['--trace'],
+            help='Write a transcript of the commands run to this file, and '
+                 'a profile of synchg to FILE.prof'
+            )
+
     @cli.switch(['-c', '--config'])
     def do_config(self):
         '''
@@ -56,12 +109,20 @@ class SyncHg(cli.Application):
                     "Remote source directory? [{0}] ".format(default)
                     )
         self.config.set('config', 'hgroot', srcdir)
-        if not os.path.exists(resources.user.path):
-            os.makedirs(resources.user.path)
-        self.config.write(resources.user.open(self.ConfigFileName, 'w'))
+        if not os.path.exists(UserDirectory()):
+            os.makedirs(UserDirectory())
+        with open(self._config_path(), 'w') as f:
+            self.config.write(f)
         pass
 
     def main(self, remote_host, local_path=None):
+        # These are imported here rather than at the top of the module so
+        # that --help & --version don't pay for them
+        from .sync import SyncRemote
+        from .sync import CompactRemote, CollectRemoteGarbage, SquashRemoteMq
+        from .progress import ConsoleProgress
+        from .events import EventBus, ConsoleSubscriber, JsonLinesSubscriber
+
         self._get_config()
         if local_path:
             local_path = local.cwd / local_path
@@ -71,15 +132,95 @@ class SyncHg(cli.Application):
         if not self.name:
             self.name = local_path.basename
 
-        SyncRemote(remote_host, self.name, local_path,
-                   self.config.get('config', 'hgroot'))
+        remote_root = self.config.get('config', 'hgroot')
+        if self.fleet:
+            return self._sync_fleet(remote_host, local_path, remote_root)
+        options = self._options(remote_host)
+        if self.gc:
+            CollectRemoteGarbage(remote_host, remote_root, options)
+            return
+        if self.compact:
+            CompactRemote(remote_host, self.name, remote_root, options)
+            return
+        if self.squash_mq:
+            SquashRemoteMq(
+                    remote_host, self.name, local_path, remote_root, options
+                    )
+            return
+
+        # Progress lines are redrawn in place, which only makes sense on a
+        # terminal
+        progress = ConsoleProgress() if sys.stdout.isatty() else None
+        events = EventBus([ConsoleSubscriber()])
+        eventLog = None
+        if self.event_log:
+            eventLog = open(self.event_log, 'a')
+            events.Subscribe(JsonLinesSubscriber(eventLog))
+        sync = lambda: SyncRemote(
+                remote_host, self.name, local_path, remote_root, options,
+                progress, events
+                )
+        try:
+            if self.trace:
+                from .trace import Tracer
+                tracer = Tracer(self.trace)
+                events.Subscribe(tracer)
+                with tracer:
+                    sync()
+            else:
+                sync()
+        finally:
+            if eventLog:
+                eventLog.close()
+
+    def _options(self, host):
+        '''
+        Reads the sync options for a host from the config, and applies the
+        command line switches to them
+        '''
+        from .sync import SyncOptions
+        options = SyncOptions.FromConfig(self.config, host, self.name)
+        if self.background:
+            options.background = True
+        # Policies from the command line override those in the config
+        options.policy += self.policy or []
+        if self.unattended:
+            options.interactive = False
+        return options
+
+    def _sync_fleet(self, fleet, local_path, remote_root):
+        '''
+        Syncs to every host in a fleet, and prints a summary
+
+        :returns:   The exit code
+        '''
+        from .sync import SyncError
+        from .fleet import FleetHosts, SyncFleet, FormatSummary
+        from .utils import yn
+
+        try:
+            hosts, concurrency = FleetHosts(self.config, fleet)
+        except ValueError as e:
+            raise SyncError(str(e))
+        results = SyncFleet(
+                hosts, self.name, local_path, remote_root, self._options,
+                concurrency, yn
+                )
+        print
+        for line in FormatSummary(results):
+            print line
+        if any(r.outcome not in ('ok', 'coalesced') for r in results):
+            return 1
+        return 0
 
 
 def run():
     try:
         SyncHg.run()
-    except AbortException:
-        pass
-    except SyncError as e:
-        # TODO: Colour would be nice here..
-        print "Error: {0}".format(e)
+    except Exception as e:
+        from .sync import AbortException, SyncError
+        if isinstance(e, SyncError):
+            # TODO: Colour would be nice here..
+            print "Error: {0}".format(e)
+        elif not isinstance(e, AbortException):
+            raise
@@ -0,0 +1,210 @@
+'''
+This module provides persistent state that synchg keeps about each remote
+host.  The state is stored as a JSON file per host in the synchg user
+resources directory.  Several syncs can use the state of a host at once, so
+it's re-read under a lock whenever it's changed.
+'''
+
+import os
+import sys
+import json
+import time
+import tempfile
+from userdir import UserDirectory
+
+__all__ = ['HostState', 'LockFile', 'WriteFile']
+
+
+def StateDirectory():
+    '''
+    Gets the directory that host state is stored in
+
+    :returns:   A path string
+    '''
+    return os.path.join(UserDirectory(), 'hosts')
+
+
+class LockFile(object):
+    '''
+    A context manager that holds an exclusive lock on a local file, shared
+    with other processes & threads.  The lock is taken on ``<path>.lock``,
+    so that the file itself can be replaced while it's held.
+    '''
+
+    def __init__(self, path):
+        '''
+        :param path:    The path of the file to lock
+        '''
+        self._path = path + '.lock'
+        self._file = None
+
+    def __enter__(self):
+        directory = os.path.dirname(os.path.abspath(self._path))
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process created it first
+                pass
+        self._file = open(self._path, 'a')
+        if sys.platform.startswith('win'):
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    # LK_LOCK only retries for 10 seconds
+                    pass
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if sys.platform.startswith('win'):
+            import msvcrt
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+def WriteFile(path, contents):
+    '''
+    Atomically replaces the contents of a local file.  The contents are
+    written to a uniquely named temporary file in the same directory, so
+    that concurrent writers don't clobber each other's temporary files.
+    The file keeps it's permissions if it exists, and is otherwise given the
+    permissions of a newly created file (mkstemp would make it private).
+
+    :param path:        The path of the file
+    :param contents:    A string to write to it
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    try:
+        mode = os.stat(path).st_mode & 07777
+    except OSError:
+        mode = 0666 & ~_Umask()
+    fd, temp = tempfile.mkstemp(
+            dir=directory, prefix=os.path.basename(path) + '.'
+            )
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp, mode)
+        if sys.platform.startswith('win') and os.path.exists(path):
+            # rename won't replace an existing file on windows
+            os.remove(path)
+        os.rename(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def _Umask():
+    ''' Gets the umask of this process '''
+    # The umask can only be read by setting it
+    umask = os.umask(022)
+    os.umask(umask)
+    return umask
+
+
+class HostState(object):
+    '''
+    Persistent state for a single remote host.  Each entry is stored along
+    with the time it was set, so that callers can treat old entries as
+    expired.
+    '''
+
+    def __init__(self, host, directory=None):
+        '''
+        :param host:        The hostname that this state is for
+        :param directory:   The directory to store state in.  If None,
+                            :func:`StateDirectory` will be used
+        '''
+        self.host = host
+        if directory is None:
+            directory = StateDirectory()
+        self._dir = directory
+        self._path = os.path.join(directory, host + '.json')
+        self._entries = None
+
+    def _Load(self, reload=False):
+        if self._entries is None or reload:
+            self._entries = {}
+            if os.path.exists(self._path):
+                try:
+                    with open(self._path) as f:
+                        self._entries = json.load(f)
+                except ValueError:
+                    # A corrupt state file is no worse than an empty one
+                    pass
+        return self._entries
+
+    def Get(self, key, default=None, ttl=None):
+        '''
+        Gets an entry
+
+        :param key:     The name of the entry
+        :param default: The value to return if the entry is missing
+        :param ttl:     If set, entries older than this many seconds are
+                        treated as missing
+        '''
+        entry = self._Load().get(key)
+        if entry is None:
+            return default
+        if ttl is not None and time.time() - entry['time'] > ttl:
+            return default
+        return entry['value']
+
+    def Set(self, key, value):
+        '''
+        Sets an entry and saves the state
+
+        :param key:     The name of the entry
+        :param value:   A JSON serialisable value
+        '''
+        self.Update(key, lambda old: value)
+
+    def Update(self, key, update, default=None):
+        '''
+        Changes an entry and saves the state.  The change is made under a
+        lock to the latest state on disk, so changes made by other syncs
+        aren't lost.
+
+        :param key:     The name of the entry
+        :param update:  A function that's passed the current value of the
+                        entry (or default if it's missing), and returns the
+                        new value
+        :param default: The value to pass to update if the entry is missing
+        :returns:       The new value
+        '''
+        with LockFile(self._path):
+            entries = self._Load(reload=True)
+            entry = entries.get(key)
+            value = update(default if entry is None else entry['value'])
+            entries[key] = {'time': time.time(), 'value': value}
+            self._Save()
+        return value
+
+    def Delete(self, key):
+        '''
+        Deletes an entry (if present) and saves the state
+
+        :param key:     The name of the entry
+        '''
+        with LockFile(self._path):
+            if self._Load(reload=True).pop(key, None) is not None:
+                self._Save()
+
+    def _Save(self):
+        ''' Atomically writes the state to disk.  Needs the lock held '''
+        WriteFile(self._path, json.dumps(self._Load()))
@@ -4,10 +4,29 @@ functions can be called by imported and called by other libraries if they wish
 to make use of SyncHg functionality.
 '''
 
+import os
+import re
+import json
+import time
+import hashlib
 import plumbum
+from collections import namedtuple
 from remote import RemoteMachine
 from repo import Repo
-from utils import yn
+from index import RemoteIndex
+from mqdelta import MqDelta
+from state import HostState
+from hgenv import HostEnvironment, ReadConfig
+from hgprofile import LeanProfile
+from tuning import TuneTransfers
+from throttle import ThrottledSsh
+from events import EventBus, ConsoleSubscriber, SyncStarted, SyncFinished
+from events import Notice, ChangesetsStripped, ChangesetsPushed
+from events import PatchApplied, BytesSent
+from cleanup import BackupRetention, CollectGarbage, PruneBackups
+from lease import Lease, LeaseBusy, SyncQueue, AcquireLease
+from userdir import UserDirectory
+from policy import Policy, PolicyError
 
 
 class AbortException(Exception):
@@ -28,7 +47,213 @@ class SyncError(Exception):
     pass
 
 
-def SyncRemote(host, name, localpath, remote_root):
+# The niceness that background syncs lower their priority to
+BackgroundNiceness = 10
+
+# The key that the fingerprints of successful sanity checks are stored under
+# in the host state
+_SanityStateKey = 'sanity'
+
+# Matches the errors of commands run in (or on) a remote repository that
+# has moved or been deleted
+_PathErrorRegexp = re.compile(
+        r'No such file or directory|no Mercurial repository here|'
+        r'repository .* not found'
+        )
+
+# Matches the errors of hg commands that gave up waiting for a repository
+# lock
+_LockErrorRegexp = re.compile(r'waiting for lock|lock held by')
+
+# The directory under the remote source directory that leases are kept in
+_LeaseDirectory = '.synchg-leases'
+
+
+class SyncOptions(object):
+    '''
+    Options that control how a sync is performed.  Any options that are not
+    passed to the constructor take their value from :attr:`Defaults`
+    '''
+
+    Defaults = {
+        # Whether to use a local index of remote changesets to avoid
+        # running discovery against the remote
+        'index': True,
+        # How to remove remote changesets that aren't present locally.
+        # Either strip or obsolete (falls back to strip if the remote
+        # doesn't support obsolescence markers).  Obsolete changesets are
+        # made draft, so they're hidden even on a publishing remote
+        'strip_mode': 'strip',
+        # Whether strip should write backup bundles on the remote
+        'strip_backup': True,
+        # Limits on the number, age (days) and total size (MB) of
+        # strip backups kept on the remote.  0 means no limit
+        'backup_keep': 0,
+        'backup_max_age': 0,
+        'backup_max_size': 0,
+        # Patterns of files to include in or exclude from a sparse checkout
+        # of the remote working copy.  If both are empty the remote will
+        # have a full working copy
+        'sparse_include': [],
+        'sparse_exclude': [],
+        # Extra branches and bookmarks to push on every sync, and whether
+        # to push all draft heads.  The current branch & revision are
+        # always pushed
+        'branches': [],
+        'bookmarks': [],
+        'draft_heads': False,
+        # What to do with uncommitted local changes.  Either ask (prompt
+        # to refresh the current patch or ignore the changes) or transfer
+        # (apply the changes to the remote working copy without committing)
+        'uncommitted': 'ask',
+        # How to sync mq patch queues.  Either repo (commit the patches
+        # repository and push it) or delta (send only changed patch files)
+        'mq_strategy': 'repo',
+        # Squash the synchg-commit history of the mq repository when it has
+        # more than this many synchg-commit changesets.  0 means never
+        'mq_squash_threshold': 0,
+        # How long (in seconds) resolved command paths and details of the
+        # remote mercurial are cached for.  0 disables caching
+        'env_cache_ttl': 24 * 60 * 60,
+        # How hg is run.  Either full (with the user's configuration) or
+        # lean (with HGPLAIN set, and only the configuration synchg needs)
+        'hg_profile': 'full',
+        # How the local repository is queried.  Either auto (through
+        # mercurial's python API if it can be imported) or hg (by running hg)
+        'local_backend': 'auto',
+        # How commands are run on the remote machine.  Either ssh (a new
+        # ssh process for each command) or paramiko (channels of a single
+        # connection, which hg also connects through)
+        'ssh_backend': 'ssh',
+        # How data is transferred to the remote.  Each is either auto
+        # (chosen from the measured speed of the link) or a fixed value:
+        # whether hg's ssh connections are compressed, the gzip level (0-9)
+        # of archives synchg sends, and the number of changesets to push at
+        # a time (0 for all at once)
+        'ssh_compression': 'auto',
+        'compression_level': 'auto',
+        'push_batch': 'auto',
+        # How long (in seconds) the measured speed of the link to a host is
+        # used for.  0 measures it on every sync
+        'link_probe_ttl': 60 * 60,
+        # The maximum rate (in KB/s) that data is sent to the remote at,
+        # by hg and by synchg itself.  0 means no limit
+        'rate_limit': 0,
+        # Whether this is a background sync, which runs at a lower priority
+        # so it yields to interactive work
+        'background': False,
+        # The path of a Prometheus textfile to add the metrics of each sync
+        # to.  If empty, no metrics are recorded
+        'metrics_file': '',
+        # How long to wait, in seconds, for another sync of the same remote
+        # repository to finish.  0 fails straight away
+        'lease_wait': 600,
+        # How old a lease has to be, in seconds, before it's assumed that the
+        # sync holding it died and it's broken
+        'lease_ttl': 3600,
+        # How long hg waits for a lock on the remote repository, in seconds.
+        # 0 reports a held lock straight away rather than after hg's default
+        # of 10 minutes.  The local repository always uses hg's default
+        'hg_lock_timeout': 0,
+        # Used by synchg.scheduler: how long, in seconds, requests for a sync
+        # have to stop for before it starts
+        'min_interval': 2.0,
+        # Used by synchg.scheduler: the longest, in seconds, that a requested
+        # sync is put off by further requests
+        'max_staleness': 30.0,
+        # How long to wait, in seconds, to connect to the remote.  0 uses the
+        # ssh default
+        'connect_timeout': 0,
+        # How to answer the questions synchg asks, as a list of name=value.
+        # See synchg.policy for the names & values
+        'policy': [],
+        # If false, questions the policy says to ask are errors rather than
+        # prompts
+        'interactive': True,
+        # Used by fleet syncs: how long, in seconds, a host has to sync
+        # (including retries) before it's given up on.  0 means no limit
+        'sync_timeout': 0,
+        # Used by fleet syncs: how many times to retry a host after an ssh
+        # failure, and how long to wait before the first retry.  The wait
+        # doubles with each retry
+        'retries': 2,
+        'retry_backoff': 5.0,
+        }
+
+    # The values allowed for options that are one of a fixed set
+    Choices = {
+        'strip_mode': ('strip', 'obsolete'),
+        'uncommitted': ('ask', 'transfer'),
+        'mq_strategy': ('repo', 'delta'),
+        'hg_profile': ('full', 'lean'),
+        'local_backend': ('auto', 'hg'),
+        'ssh_backend': ('ssh', 'paramiko'),
+        }
+
+    def __init__(self, **kwargs):
+        unknown = set(kwargs) - set(self.Defaults)
+        if unknown:
+            raise TypeError(
+                    'Unknown sync options: {0}'.format(', '.join(unknown))
+                    )
+        for name, default in self.Defaults.iteritems():
+            if isinstance(default, list):
+                default = list(default)
+            value = kwargs.get(name, default)
+            if name in self.Choices and value not in self.Choices[name]:
+                raise SyncError(
+                        'Invalid {0}: {1} (expected {2})'.format(
+                            name, value, ' or '.join(self.Choices[name])
+                            )
+                        )
+            setattr(self, name, value)
+
+    @classmethod
+    def FromConfig(cls, config, host, name):
+        '''
+        Reads options from a synchg configuration file.  Options are read
+        from the ``config`` section, then overridden by any ``host:<host>``
+        and ``project:<name>`` sections.
+
+        :param config:  A ``ConfigParser`` containing the configuration
+        :param host:    The hostname that is being synced to
+        :param name:    The name of the project being synced
+        '''
+        options = {}
+        sections = ['config', 'host:' + host, 'project:' + name]
+        for section in sections:
+            if not config.has_section(section):
+                continue
+            for option, default in cls.Defaults.iteritems():
+                if not config.has_option(section, option):
+                    continue
+                if isinstance(default, bool):
+                    value = config.getboolean(section, option)
+                elif isinstance(default, int):
+                    value = config.getint(section, option)
+                elif isinstance(default, float):
+                    value = config.getfloat(section, option)
+                elif isinstance(default, list):
+                    value = config.get(section, option).split()
+                else:
+                    value = config.get(section, option)
+                options[option] = value
+        return cls(**options)
+
+    @property
+    def retention(self):
+        '''
+        Gets the strip backup retention policy
+
+        :returns:   A :class:`synchg.cleanup.BackupRetention`
+        '''
+        return BackupRetention(
+                self.backup_keep, self.backup_max_age, self.backup_max_size
+                )
+
+
+def SyncRemote(host, name, localpath, remote_root, options=None,
+               progress=None, events=None):
     '''
     Syncs a remote repository.  This function should be called to kick off a
     sync
@@ -40,18 +265,366 @@ def SyncRemote(host, name, localpath, remote_root):
     :param localpath:   A plumbum path to the local repository
     :param remote_root: The path to the parent directory of the
                         remote repository
+    :param options:     A :class:`SyncOptions`.  If None, the defaults
+                        will be used.
+    :param progress:    An optional callback for the progress of pushes,
+                        clones and other transfers.  It's passed a
+                        :class:`synchg.progress.Progress` for each update.
+    :param events:      An optional :class:`synchg.events.EventBus` to
+                        report the sync's events on.  If None, they will be
+                        printed to stdout.
     '''
-    print "Sync {0} -> {1}".format(name, host)
-    with RemoteMachine(host) as remote:
-        with plumbum.local.cwd(localpath):
-            local = Repo(plumbum.local, host)
-            remote_path = remote_root + '/' + name
-            _SanityCheckRepos(local, host, remote_path, remote)
+    if options is None:
+        options = SyncOptions()
+    # Questions are only decided when they come up, so check the policy
+    # before anything is done rather than part way through the sync
+    _Policy(options)
+    if events is None:
+        events = EventBus([ConsoleSubscriber()])
+    if options.metrics_file:
+        from metrics import MetricsSink
+        sink = MetricsSink(
+                os.path.expanduser(options.metrics_file), host, name
+                )
+        events = EventBus([events.Emit, sink])
+    events.Emit(SyncStarted(host, name))
+    start = time.time()
+    outcome = 'failed'
+    try:
+        synced = _SyncRemote(
+                host, name, localpath, remote_root, options, progress, events
+                )
+        outcome = 'ok' if synced else 'coalesced'
+    except AbortException:
+        outcome = 'abort'
+        raise
+    except SyncError:
+        outcome = 'error'
+        raise
+    finally:
+        events.Emit(SyncFinished(host, name, time.time() - start, outcome))
+
+
+def _SyncRemote(host, name, localpath, remote_root, options, progress,
+                events):
+    '''
+    Does the work of :func:`SyncRemote`
+
+    :returns:   False if the sync was skipped because a newer sync of the
+                same repository is queued, True otherwise
+    '''
+    _SetPriority(options)
+    state = HostState(host)
+    remote_path = remote_root + '/' + name
+    queue = SyncQueue(_QueueDirectory(host, remote_path, localpath))
+    queue.Join()
+    try:
+        with _Connect(host, options) as remote:
+            with events.Phase('tuning'):
+                try:
+                    transfer = TuneTransfers(remote, state, options)
+                except ValueError as e:
+                    raise SyncError(str(e))
+            lease = Lease(
+                    remote, remote_root + '/' + _LeaseDirectory + '/' + name,
+                    options.lease_ttl
+                    )
+            with events.Phase('lease'):
+                try:
+                    acquired = AcquireLease(
+                            lease, queue, options.lease_wait,
+                            lambda holder: events.Emit(Notice(
+                                'Waiting for the sync by {0} to finish'.format(
+                                    holder
+                                    )
+                                ))
+                            )
+                except LeaseBusy as e:
+                    raise SyncError(str(e))
+            if not acquired:
+                events.Emit(Notice(
+                    'A newer sync of this repository is queued, skipping'
+                    ))
+                return False
+            try:
+                _SyncLeased(
+                        host, name, localpath, remote_root, remote, state,
+                        transfer, options, progress, events
+                        )
+            finally:
+                try:
+                    lease.Release()
+                except Exception:
+                    # An unreleased lease goes stale after lease_ttl, so
+                    # don't hide the error that got us here
+                    pass
+    finally:
+        queue.Leave()
+    return True
+
+
+def _QueueDirectory(host, remote_path, localpath):
+    '''
+    Gets the directory that local syncs of a repository queue in
+
+    :param host:        The hostname of the remote repository
+    :param remote_path: The path to the remote repository as a string
+    :param localpath:   The path to the local repository
+    '''
+    key = hashlib.sha1(
+            '\n'.join([host, remote_path, str(localpath)])
+            ).hexdigest()
+    return os.path.join(UserDirectory(), 'queues', key)
+
+
+def _SyncLeased(host, name, localpath, remote_root, remote, state, transfer,
+                options, progress, events):
+    '''
+    Syncs a remote repository, once the lease on it has been acquired
+    '''
+    remote_path = remote_root + '/' + name
+    with plumbum.local.cwd(localpath):
+        local = _LocalRepo(host, options, remote, transfer)
+        local.progress = progress
+        local.Instrument(events.Emit)
+        with events.Phase('setup'):
+            checked = _SanityCheckRepos(
+                    local, host, remote_path, remote, events, state, options
+                    )
+            _RegisterProject(host, remote_root, name, localpath)
+        index = None
+        if options.index:
+            index = RemoteIndex(plumbum.local.cwd, host)
+
+        def Sync():
             with remote.cwd(remote.cwd / remote_path):
-                _DoSync(local, Repo(remote))
+                remote_repo = _RemoteRepo(host, remote, options)
+                remote_repo.progress = progress
+                remote_repo.Instrument(events.Emit)
+                _ConfigureSparse(remote_repo, options, events)
+                _DoSync(local, remote_repo, index, options, events)
+
+        try:
+            try:
+                Sync()
+            except plumbum.ProcessExecutionError as e:
+                if _IsLockError(e):
+                    raise SyncError(
+                            'A repository is locked by another hg process: '
+                            '{0}'.format(e.stderr.strip().splitlines()[-1])
+                            )
+                if not _IsPathError(e):
+                    raise
+                _ForgetSanityCheck(state, remote_path)
+                if checked:
+                    raise
+                # The cached sanity check is out of date, so check the
+                # repositories again and have another go
+                events.Emit(Notice('Remote repository has moved'))
+                with events.Phase('setup'):
+                    _SanityCheckRepos(
+                            local, host, remote_path, remote, events, state,
+                            options
+                            )
+                Sync()
+        finally:
+            if index:
+                index.Close()
+
+
+def _RemoteRepo(host, remote, options):
+    '''
+    Creates a :class:`Repo` for the repository in the current directory of a
+    remote machine, using the cached environment of the host.
+
+    :param host:    The hostname of the remote machine
+    :param remote:  A plumbum machine for the remote machine
+    :param options: The :class:`SyncOptions` for this sync
+    '''
+    env = HostEnvironment(remote, HostState(host), options.env_cache_ttl)
+    profile = None
+    if options.hg_profile == 'lean':
+        profile = LeanProfile(env.hgUiConfig)
+    repo = Repo(remote, env=env, profile=profile)
+    repo.rateLimit = options.rate_limit * 1024
+    repo.UseLockTimeout(options.hg_lock_timeout)
+    return repo
+
 
+def _LocalRepo(host, options, remote, transfer=None):
+    '''
+    Creates a :class:`Repo` for the repository in the current local directory.
+    If the remote machine can forward ports, hg will connect to the remote
+    through it.  hg's ssh command is also set up for the transfer settings
+    and rate limit.
+
+    :param host:        The hostname of the remote machine
+    :param options:     The :class:`SyncOptions` for this sync
+    :param remote:      A plumbum machine for the remote machine
+    :param transfer:    An optional :class:`TransferSettings` for the host
+    '''
+    uiConfig = None
+    if options.hg_profile == 'lean' or options.rate_limit or \
+            options.connect_timeout or \
+            (transfer and transfer.sshCompression):
+        uiConfig = ReadConfig(plumbum.local['hg'], 'ui')
+    profile = None
+    if options.hg_profile == 'lean':
+        profile = LeanProfile(uiConfig)
+    cls = Repo
+    if options.local_backend == 'auto':
+        # Importing mercurial is slow, so only do so if it may be used
+        import inprocess
+        if inprocess.Available:
+            cls = inprocess.InProcessRepo
+    # The local repository keeps hg's own lock timeout: it's locked by the
+    # user's own hg commands, which should be waited for rather than failed
+    repo = cls(plumbum.local, host, profile=profile)
+    ssh = None
+    if hasattr(remote, 'SshTunnel'):
+        ssh = remote.HgSshCommand(remote.SshTunnel())
+    elif options.connect_timeout and options.ssh_backend == 'ssh':
+        ssh = uiConfig.get('ui.ssh', 'ssh')
+        if os.path.basename(ssh.split()[0]) == 'ssh':
+            ssh += ' -o ConnectTimeout={0}'.format(options.connect_timeout)
+        else:
+            ssh = None
+    if transfer:
+        if transfer.sshCompression:
+            ssh = ssh or uiConfig.get('ui.ssh', 'ssh')
+            if '-C' not in ssh.split():
+                ssh += ' -C'
+        repo.compressionLevel = transfer.compressionLevel
+        repo.pushBatch = transfer.pushBatch
+    if options.rate_limit:
+        ssh = ThrottledSsh(
+                ssh or uiConfig.get('ui.ssh', 'ssh'), options.rate_limit * 1024
+                )
+    if ssh:
+        repo.UseSsh(ssh)
+    return repo
+
+
+def _Connect(host, options):
+    '''
+    Connects to a remote machine
+
+    :param host:    The hostname of the remote machine
+    :param options: The :class:`SyncOptions` for this sync
+    :returns:       A plumbum machine
+    '''
+    return RemoteMachine(
+            host, backend=options.ssh_backend,
+            connect_timeout=options.connect_timeout
+            )
+
+
+def _Ask(options, name, prompt, default='y'):
+    '''
+    Decides a yes or no question with the policy in the options, asking
+    the user if it says to
 
-def _SanityCheckRepos(local_repo, host, remote_path, remote):
+    :param options: The :class:`SyncOptions` for this sync
+    :param name:    The name of the question in the policy
+    :param prompt:  The question to ask
+    :param default: The default answer, y or n
+    :returns:       True if the answer was yes
+    '''
+    try:
+        return _Policy(options).Decide(name, prompt, default)
+    except PolicyError as e:
+        raise SyncError(str(e))
+
+
+def _Policy(options):
+    '''
+    Gets the policy of a sync
+
+    :param options: The :class:`SyncOptions` for this sync
+    :returns:       A :class:`Policy`
+    :raises:        :class:`SyncError` if a rule of the policy is invalid
+    '''
+    try:
+        return Policy(options.policy, options.interactive)
+    except PolicyError as e:
+        raise SyncError(str(e))
+
+
+def _SetPriority(options):
+    '''
+    Lowers the priority of this process (and the hg & ssh processes it
+    starts) for background syncs.  This can't be undone.  Processes that
+    run many syncs, such as a scheduler, are only lowered once: the
+    priority is only changed while the niceness is below
+    :data:`BackgroundNiceness`.
+
+    :param options: The :class:`SyncOptions` for this sync
+    '''
+    if options.background and hasattr(os, 'nice'):
+        current = os.nice(0)
+        if current < BackgroundNiceness:
+            os.nice(BackgroundNiceness - current)
+
+
+def _SanityFingerprint(host, remote_path):
+    '''
+    Gets a fingerprint of the local state that a sanity check depends on.
+    It's made from the metadata of local files, so is cheap to work out.
+
+    :param host:        The hostname of the remote repo
+    :param remote_path: The path to the remote repository as a string
+    :returns:           A string
+    '''
+    hg_dir = plumbum.local.cwd / '.hg'
+    parts = [str(plumbum.local.cwd), host, remote_path]
+    for path in (hg_dir / 'patches', hg_dir / 'patches' / '.hg'):
+        parts.append(path.exists())
+    for path in (hg_dir / 'hgrc', hg_dir / 'patches' / '.hg' / 'hgrc'):
+        try:
+            stat = os.stat(str(path))
+            parts.append([stat.st_mtime, stat.st_size])
+        except OSError:
+            parts.append(None)
+    return hashlib.sha1(json.dumps(parts)).hexdigest()
+
+
+def _ForgetSanityCheck(state, remote_path):
+    '''
+    Forgets that a remote repository passed a sanity check, so that it's
+    checked again on the next sync
+
+    :param state:       The :class:`HostState` for the host
+    :param remote_path: The path to the remote repository as a string
+    '''
+    if remote_path in state.Get(_SanityStateKey, {}):
+        def Forget(checked):
+            checked.pop(remote_path, None)
+            return checked
+        state.Update(_SanityStateKey, Forget, {})
+
+
+def _IsLockError(error):
+    '''
+    Checks if an hg command failed because a repository was locked
+
+    :param error:   A ``ProcessExecutionError``
+    '''
+    return _LockErrorRegexp.search(error.stderr or '') is not None
+
+
+def _IsPathError(error):
+    '''
+    Checks if a command failed because the remote repository has moved or
+    been deleted
+
+    :param error:   A ``ProcessExecutionError``
+    '''
+    output = '{0}\n{1}'.format(error.stdout or '', error.stderr or '')
+    return _PathErrorRegexp.search(output) is not None
+
+
+def _SanityCheckRepos(local_repo, host, remote_path, remote, events,
+                      state=None, options=None):
     '''
     Does a sanity check of the repositories, and attempts
     to fix any problems found.
@@ -59,13 +632,30 @@ def _SanityCheckRepos(local_repo, host, remote_path, remote):
     This includes cloning the repository, setting up remotes
     and setting up mq repositories.
 
+    The checks need several round trips to the remote, so a fingerprint of
+    the local state is stored after they pass.  The checks are skipped while
+    the fingerprint is unchanged.
+
     It's expected that the local path will be set up by this point
 
     :param local_repo:  A Repo object for the local repository
     :param host:        The hostname of the remote repo
     :param remote_path: The path to the remote repository as a string
     :param remote:      A plumbum machine for the remote machine
+    :param events:      The :class:`EventBus` for this sync
+    :param state:       An optional :class:`HostState` for the host, to
+                        store the fingerprint in
+    :param options:     The :class:`SyncOptions` for this sync.  If None,
+                        the defaults will be used.
+    :returns:           False if the checks were skipped, True otherwise
     '''
+    if options is None:
+        options = SyncOptions()
+    if state is not None:
+        fingerprint = state.Get(_SanityStateKey, {}).get(remote_path)
+        if fingerprint == _SanityFingerprint(host, remote_path):
+            return False
+
     patch_dir = plumbum.local.cwd / '.hg' / 'patches'
     if patch_dir.exists():
         if not (patch_dir / '.hg').exists():
@@ -77,88 +667,614 @@ def _SanityCheckRepos(local_repo, host, remote_path, remote):
     hg_remote_path = 'ssh://{0}/{1}'.format(host, remote_path)
     rpath = remote.cwd / remote_path
     if not rpath.exists():
-        print "Remote repository can't be found."
-        if yn('Do you want to create a clone?'):
-            local_repo.Clone(hg_remote_path)
+        events.Emit(Notice("Remote repository can't be found."))
+        if _Ask(options, 'clone', 'Do you want to create a clone?'):
+            with events.Phase('clone'):
+                local_repo.Clone(hg_remote_path)
         else:
             raise AbortException
 
-    # Check if remote paths are set up properly
-    if host not in local_repo.config.remotes:
-        local_repo.config.AddRemote(host, hg_remote_path)
+    # Check if remote paths are set up properly.  Each config is read & any
+    # change written in one batch
+    with local_repo.config.Batch() as config:
+        if host not in config.remotes:
+            config.AddRemote(host, hg_remote_path)
 
-    if host not in local_repo.mqconfig.remotes:
-        local_repo.mqconfig.AddRemote(host, hg_remote_path + '/.hg/patches')
+    with local_repo.mqconfig.Batch() as config:
+        if host not in config.remotes:
+            config.AddRemote(host, hg_remote_path + '/.hg/patches')
 
     # TODO: Would probably be good to check that the remotes aren't
     #       pointing at the wrong address as well
 
     # Finally, check if the mq repository needs cloned
     if patch_dir.exists() and not (rpath / '.hg' / 'patches').exists():
-        local_repo.CloneMq(hg_remote_path)
+        with events.Phase('clone-mq'):
+            local_repo.CloneMq(hg_remote_path)
+
+    if state is not None:
+        fingerprint = _SanityFingerprint(host, remote_path)
+
+        def Record(checked):
+            checked[remote_path] = fingerprint
+            return checked
+        state.Update(_SanityStateKey, Record, {})
+    return True
+
+
+def _ConfigureSparse(remote, options, events):
+    '''
+    Applies the sparse checkout rules from the options to the remote
+    repository, if they aren't already in place.  If the options have no
+    rules, any rules the remote has are cleared so it has a full working
+    copy again.
+
+    :param remote:  The remote repository
+    :param options: The :class:`SyncOptions` for this sync
+    :param events:  The :class:`EventBus` for this sync
+    '''
+    rules = (list(options.sparse_include), list(options.sparse_exclude))
+    if any(rules) and remote.env and remote.env.hgVersion < (4, 3):
+        raise SyncError(
+                'Sparse checkouts need Mercurial 4.3 or later on the remote'
+                )
+    if remote.sparseRules != rules:
+        with events.Phase('sparse'):
+            remote.SetSparse(*rules)
+
+
+# Describes what should be pushed during a sync
+#   rev:            The revision the remote should be updated to
+#   revs:           Revisions (or revsets) to push
+#   branches:       Branches to push
+#   bookmarks:      Bookmarks to push
+#   stripBranches:  Branches that remote only changesets should be
+#                   stripped from
+SyncTargets = namedtuple(
+        'SyncTargets',
+        ['rev', 'revs', 'branches', 'bookmarks', 'stripBranches']
+        )
+
+
+def _FindTargets(local, options, applied=False):
+    '''
+    Works out what should be pushed for a sync.  This doesn't need any
+    patches popped on the local repository: the targets leave them out.
+
+    :param local:   The local repository
+    :param options: The :class:`SyncOptions` for this sync
+    :param applied: True if there are mq patches applied locally
+    :returns:       A :class:`SyncTargets`
+    '''
+    rev = local.baseRev
+    revs = [rev]
+    branches = sorted(local.BranchesOf(revs))
+    for branch in options.branches:
+        if branch not in branches:
+            branches.append(branch)
+    stripBranches = set(branches)
+    if options.bookmarks:
+        bookmarkRevs = [
+                'bookmark({0!r})'.format(bookmark)
+                for bookmark in options.bookmarks
+                ]
+        revs += bookmarkRevs
+        stripBranches |= local.BranchesOf(bookmarkRevs)
+    if options.draft_heads:
+        for cs in local.Log('heads(draft())'):
+            revs.append(cs.hash)
+            stripBranches.add(cs.branch)
+    if applied:
+        # The applied patches are the working copy's ancestors after the
+        # base revision.  Branch & draft heads can be patches, so the heads
+        # that are left without them are pushed instead
+        revs += ['head() and branch({0!r})'.format(b) for b in branches]
+        revs = ['heads(::({0}) - ({1}::. - {1}))'.format(
+                ' or '.join('({0})'.format(r) for r in revs), rev
+                )]
+        branches = []
+    return SyncTargets(
+            rev, revs, branches, list(options.bookmarks),
+            sorted(stripBranches)
+            )
 
 
-def _DoSync(local, remote):
+def _FindChanges(local, remote, index, targets):
+    '''
+    Finds the outgoing and incoming changesets for a sync.  If the index is up
+    to date with the remote then it will be used, otherwise discovery will be
+    run against the remote.
+
+    Should be called with no patches applied on the remote repository
+
+    :param local:   The local repository
+    :param remote:  The remote repository
+    :param index:   A :class:`RemoteIndex` or None
+    :param targets: The :class:`SyncTargets` for this sync
+    :returns:       A tuple of (outgoings, incomings, indexed) where indexed
+                    is True if the index was used
+    '''
+    if index and index.IsCurrent(remote.heads):
+        outgoings, incomings = index.FindChanges(
+                local, targets.revs, targets.branches, targets.stripBranches
+                )
+        return outgoings, incomings, True
+    outgoings = local.FindOutgoings(targets.revs, targets.branches)
+    incomings = []
+    if outgoings:
+        incomings = local.FindIncomings(targets.stripBranches)
+    return outgoings, incomings, False
+
+
+def _BookmarksDiffer(local, remote, bookmarks):
+    '''
+    Checks if any of a list of bookmarks need to be pushed to the remote
+
+    :param local:       The local repository
+    :param remote:      The remote repository
+    :param bookmarks:   A list of bookmark names
+    '''
+    if not bookmarks:
+        return False
+    localBookmarks = local.bookmarks
+    remoteBookmarks = remote.bookmarks
+    return any(
+            localBookmarks.get(name) != remoteBookmarks.get(name)
+            for name in bookmarks
+            )
+
+
+def _UpdateIndex(local, remote, index, outgoings, incomings, indexed):
+    '''
+    Updates the index after changesets have been pushed to the remote
+
+    :param local:       The local repository
+    :param remote:      The remote repository
+    :param index:       A :class:`RemoteIndex` or None
+    :param outgoings:   The changesets that were pushed
+    :param incomings:   The changesets that were stripped
+    :param indexed:     True if the index was used to find the changes
+    '''
+    if not index:
+        return
+    heads = remote.heads
+    if indexed:
+        index.Update(
+                heads,
+                outgoings,
+                [cs.hash for cs in incomings]
+                )
+    else:
+        index.Rebuild(heads, remote.Log())
+
+
+def CompactRemote(host, name, remote_root, options=None):
+    '''
+    Strips any changesets that were previously hidden by an obsolete mode
+    sync from a remote repository.
+
+    :param host:        The hostname of the remote repository
+    :param name:        The name of the project
+    :param remote_root: The path to the parent directory of the
+                        remote repository
+    :param options:     A :class:`SyncOptions`.  If None, the defaults
+                        will be used.
+    '''
+    if options is None:
+        options = SyncOptions()
+    print "Compact {0} on {1}".format(name, host)
+    with _Connect(host, options) as remote:
+        with remote.cwd(remote.cwd / (remote_root + '/' + name)):
+            remote_repo = _RemoteRepo(host, remote, options)
+            count = remote_repo.Compact(options.strip_backup)
+    print "Stripped {0} obsolete changesets".format(count)
+
+
+def SquashRemoteMq(host, name, localpath, remote_root, options=None):
+    '''
+    Squashes runs of synchg-commit changesets in the local mq repository,
+    and makes the remote mq repository match.
+
+    :param host:        The hostname of the remote repository
+    :param name:        The name of the project
+    :param localpath:   A plumbum path to the local repository
+    :param remote_root: The path to the parent directory of the
+                        remote repository
+    :param options:     A :class:`SyncOptions`.  If None, the defaults
+                        will be used.
+    '''
+    if options is None:
+        options = SyncOptions()
+    events = EventBus([ConsoleSubscriber()])
+    events.Emit(Notice(
+            'Squash mq history of {0} on {1}'.format(name, host)
+            ))
+    _SetPriority(options)
+    with _Connect(host, options) as remote:
+        with plumbum.local.cwd(localpath):
+            local = _LocalRepo(host, options, remote)
+            local.CommitMq()
+            with remote.cwd(remote.cwd / (remote_root + '/' + name)):
+                remote_repo = _RemoteRepo(host, remote, options)
+                if not _SquashMqHistory(local, remote_repo, options, events):
+                    events.Emit(Notice('Nothing to squash'))
+
+
+def _SquashMqHistory(local, remote, options, events):
+    '''
+    Squashes the local mq history, pushes the result to the remote and then
+    strips the old history from the remote.
+
+    :param local:   The local repository
+    :param remote:  The remote repository
+    :param options: The :class:`SyncOptions` for this sync
+    :param events:  The :class:`EventBus` for this sync
+    :returns:       True if the history was squashed (and pushed)
+    '''
+    with events.Phase('mq-squash'):
+        if not _SquashLocalMq(local, events):
+            return False
+        _ReplaceRemoteMq(local, remote, options, events)
+    return True
+
+
+def _SquashLocalMq(local, events):
+    '''
+    Squashes the local mq history
+
+    :param local:   The local repository
+    :param events:  The :class:`EventBus` for this sync
+    :returns:       True if the history was squashed
+    '''
+    if not local.SquashMq():
+        return False
+    events.Emit(Notice(
+            'Squashed mq history, {0} synchg-commits remain'.format(
+                local.mqCommitCount
+                )
+            ))
+    return True
+
+
+def _ReplaceRemoteMq(local, remote, options, events):
+    '''
+    Pushes a squashed mq history to the remote, and strips the old history
+    from it.  This only reads the local mq repository.
+
+    :param local:   The local repository
+    :param remote:  The remote repository
+    :param options: The :class:`SyncOptions` for this sync
+    :param events:  The :class:`EventBus` for this sync
+    '''
+    local.PushMqToRemote(force=True)
+    # The remote working directory is still on the old history, which
+    # isn't an ancestor of the new one, so it has to be moved explicitly.
+    # Otherwise it's the new history that would be stripped as stale
+    remote.UpdateMq(local.mqRev)
+    count = remote.StripStaleMq(options.strip_backup)
+    events.Emit(Notice(
+            'Stripped {0} old synchg-commits from remote'.format(count)
+            ))
+
+
+def CollectRemoteGarbage(host, remote_root, options=None):
+    '''
+    Cleans up a remote machine.  Strip backups are pruned according to the
+    retention options, stale synchg-commit changesets are stripped from mq
+    repositories and (after prompting) any remote repositories whose local
+    repository no longer exists are deleted.
+
+    :param host:        The hostname of the remote machine
+    :param remote_root: The path to the directory containing the
+                        remote repositories
+    :param options:     A :class:`SyncOptions`.  If None, the defaults
+                        will be used.
+    '''
+    if options is None:
+        options = SyncOptions()
+    state = HostState(host)
+    projects = state.Get('projects', {})
+    orphans = [
+            key for key, project in projects.iteritems()
+            if project['root'] == remote_root and
+            not os.path.isdir(os.path.join(project['local'], '.hg'))
+            ]
+    if orphans:
+        print "Local repositories for these remotes no longer exist:"
+        for key in orphans:
+            print "  {0}  (was {1})".format(key, projects[key]['local'])
+        if not _Ask(options, 'delete-orphans', 'Do you want to delete them?',
+                    default='n'):
+            orphans = []
+    print "Collecting garbage on {0}".format(host)
+    with _Connect(host, options) as remote:
+        lines = CollectGarbage(
+                remote, remote_root, options.retention,
+                [projects[key]['name'] for key in orphans]
+                )
+    for line in lines:
+        print "  " + line
+    if orphans:
+        def Forget(projects):
+            for key in orphans:
+                projects.pop(key, None)
+            return projects
+        state.Update('projects', Forget, {})
+    print "Ok!"
+
+
+def _RegisterProject(host, remote_root, name, localpath):
+    '''
+    Records a synced project in the host state, so that garbage collection
+    can find remote repositories whose local repository has been deleted.
+
+    :param host:        The hostname of the remote machine
+    :param remote_root: The path to the parent directory of the
+                        remote repository
+    :param name:        The name of the project
+    :param localpath:   A plumbum path to the local repository
+    '''
+    state = HostState(host)
+    projects = state.Get('projects', {})
+    key = remote_root + '/' + name
+    project = {'root': remote_root, 'name': name, 'local': str(localpath)}
+    if projects.get(key) != project:
+        def Register(projects):
+            projects[key] = project
+            return projects
+        state.Update('projects', Register, {})
+
+
+def _RemoveFromRemote(remote, changesets, options, events):
+    '''
+    Removes changesets from the remote repository, either by stripping
+    them or hiding them with obsolescence markers
+
+    :param remote:      The remote repository
+    :param changesets:  A list of :class:`Repo.ChangesetInfo` to remove
+    :param options:     The :class:`SyncOptions` for this sync
+    :param events:      The :class:`EventBus` for this sync
+    '''
+    if options.strip_mode == 'obsolete':
+        if remote.supportsObsolescence:
+            remote.Obsolete(changesets)
+            events.Emit(ChangesetsStripped(changesets, True))
+            return
+        events.Emit(Notice(
+                'Remote does not support obsolescence markers, stripping'
+                ))
+    remote.Strip(changesets, options.strip_backup)
+    events.Emit(ChangesetsStripped(changesets, False))
+    if options.strip_backup and any(options.retention):
+        PruneBackups(remote.machine, '.', options.retention)
+
+
+def _DoSync(local, remote, index=None, options=None, events=None):
     '''
     Function that actually handles the syncing after everything
     has been set up
 
     :param local:   The local repository
     :param remote:  The remote repository
+    :param index:   An optional :class:`RemoteIndex` to use for
+                    finding changes.
+    :param options: A :class:`SyncOptions`.  If None, the defaults
+                    will be used.
+    :param events:  An :class:`EventBus` to report events on.  If None,
+                    they will be printed to stdout.
     '''
+    if options is None:
+        options = SyncOptions()
+    if events is None:
+        events = EventBus([ConsoleSubscriber()])
+    # Remove any uncommitted changes that a previous sync transferred
+    if remote.ResetWorkingCopy():
+        events.Emit(Notice(
+                'Removed previously transferred changes from remote'
+                ))
+
     # First, check the state of each repository
-    if remote.summary.commit.modified:
+    if remote.WorkingChanges():
         # Changes might be lost on remote...
         raise SyncError('Remote repository has uncommitted changes')
 
-    lsummary = local.summary
-    if lsummary.commit.modified:
-        print "Local repository has uncommitted changes."
-        if lsummary.mq.applied:
+    # Syncs to other hosts may be sharing the local working copy, so it's
+    # mq state is only read & changed under the lock.  Nothing pops the
+    # local patches, so discovery & pushes run outside it
+    with local.LockWorkingCopy():
+        archive = _CheckLocal(local, options, events)
+        appliedPatch = local.lastAppliedPatch
+        targets = _FindTargets(local, options, bool(appliedPatch))
+    if remote.env and not remote.profile and appliedPatch and \
+            not remote.env.HasExtension('mq', remote.hg):
+        raise SyncError('The mq extension is not enabled on the remote')
+
+    delta = None
+    if options.mq_strategy == 'delta' and appliedPatch:
+        delta = MqDelta(local, remote)
+    # If the remote already has our revision, any unchanged patches can be
+    # left applied
+    remoteClean = not (delta and _OnlyCurrentRev(options) and
+                       remote.baseRev == targets.rev)
+    if remoteClean:
+        _SyncChangesets(local, remote, index, targets, options, events)
+        with events.Phase('update'):
+            remote.Update(targets.rev)
+    _SyncPatches(
+            local, remote, appliedPatch, delta, remoteClean, options, events
+            )
+
+    if archive:
+        with events.Phase('uncommitted'):
+            remote.ApplyWorkingCopyArchive(archive)
+        events.Emit(BytesSent('uncommitted changes', len(archive)))
+
+
+def _CheckLocal(local, options, events):
+    '''
+    Checks the local working copy for uncommitted changes, refreshing the
+    current patch if asked to.  Should be called with the working copy
+    locked.
+
+    :param local:   The local repository
+    :param options: The :class:`SyncOptions` for this sync
+    :param events:  The :class:`EventBus` for this sync
+    :returns:       The archive of uncommitted changes to transfer, or None
+    '''
+    archive = None
+    transfer = options.uncommitted == 'transfer'
+    changes = local.WorkingChanges(unknown=transfer)
+    if transfer and changes:
+        events.Emit(Notice(
+                'Local uncommitted changes will be transferred to remote'
+                ))
+        archive = local.WorkingCopyArchive()
+        # Any applied patches will need to be popped & pushed with the
+        # changes in place
+        local.keepChanges = True
+    elif changes:
+        events.Emit(Notice('Local repository has uncommitted changes.'))
+        if local.summary.mq.applied:
             # We can't push/pop patches to check remote is
             # in sync if we've got local changes, so prompt to refresh.
-            if yn('Do you want to refresh the current patch?'):
+            if _Ask(options, 'refresh',
+                    'Do you want to refresh the current patch?'):
                 local.RefreshMq()
             else:
-                print "Ok.  Please run again after dealing with changes."
+                events.Emit(Notice(
+                        'Ok.  Please run again after dealing with changes.'
+                        ))
                 raise AbortException
         else:
             # If we're not doing an mq sync, we can happily ignore
             # these changes, but probably want to make sure that's
             # what the user wants...
-            if not yn('Do you want to ignore these changes?'):
-                print "Ok.  Please run again after dealing with changes."
+            if not _Ask(options, 'ignore-changes',
+                        'Do you want to ignore these changes?'):
+                events.Emit(Notice(
+                        'Ok.  Please run again after dealing with changes.'
+                        ))
                 raise AbortException
+    return archive
+
+
+def _OnlyCurrentRev(options):
+    '''
+    Checks if a sync only needs to push the current revision
+
+    :param options: The :class:`SyncOptions` for this sync
+    '''
+    return not (options.branches or options.bookmarks or options.draft_heads)
+
+
+def _SyncChangesets(local, remote, index, targets, options, events):
+    '''
+    Pushes changesets to the remote (stripping any that aren't present
+    locally).  This will leave no patches applied on the remote.
 
+    :param local:   The local repository
+    :param remote:  The remote repository
+    :param index:   An optional :class:`RemoteIndex` to use for
+                    finding changes.
+    :param targets: The :class:`SyncTargets` for this sync
+    :param options: The :class:`SyncOptions` for this sync
+    :param events:  The :class:`EventBus` for this sync
+    '''
     # Pop any patches on the remote before we begin
     remote.PopPatch()
 
-    with local.CleanMq():
-        if local.outgoings:
-            incomings = local.incomings
-            if incomings:
-                # Don't want to be creating new remote heads when we push
-                print "Changesets will be stripped from remote:"
-                for hash, desc in incomings:
-                    if len(desc) > 50:
-                        desc = desc[:47] + '...'
-                    print "  {0}  {1}".format(hash[:6], desc)
-                if not yn('Do you want to continue?'):
-                    raise AbortException()
-                remote.Strip(incomings)
-            print "Pushing to remote"
-            local.PushToRemote()
-
-    print "Updating remote"
-    remote.Update(local.currentRev)
-
-    appliedPatch = local.lastAppliedPatch
-    if appliedPatch:
-        print "Syncing mq repos"
-        local.CommitMq()
-        local.PushMqToRemote()
-        print "Updating remote mq repo"
-        remote.UpdateMq()
-        remote.PushPatch(appliedPatch)
+    with events.Phase('discovery'):
+        outgoings, incomings, indexed = _FindChanges(
+                local, remote, index, targets
+                )
+    if outgoings and incomings:
+        # Don't want to be creating new remote heads when we push
+        events.Emit(Notice('Changesets will be stripped from remote:'))
+        for hash, desc in incomings:
+            if len(desc) > 50:
+                desc = desc[:47] + '...'
+            events.Emit(Notice('  {0}  {1}'.format(hash[:6], desc)))
+        if not _Ask(options, 'strip', 'Do you want to continue?'):
+            raise AbortException()
+        with events.Phase('strip'):
+            _RemoveFromRemote(remote, incomings, options, events)
+    if outgoings or _BookmarksDiffer(local, remote, targets.bookmarks):
+        with events.Phase('push'):
+            pushed = _PushInBatches(local, outgoings, events)
+            local.PushToRemote(
+                    targets.revs, targets.branches, targets.bookmarks
+                    )
+        events.Emit(ChangesetsPushed(outgoings[pushed:]))
+    if outgoings or not indexed:
+        _UpdateIndex(local, remote, index, outgoings, incomings, indexed)
 
-    print "Ok!"
+
+def _PushInBatches(local, outgoings, events):
+    '''
+    Pushes all but the last batch of the outgoing changesets in batches of
+    `local.pushBatch` changesets.  Each push sends a changeset along with
+    it's ancestors, so the final batch is sent by the full push that follows.
+
+    :param local:       The local repository
+    :param outgoings:   The outgoing changesets, in the order hg lists them
+                        (ancestors before descendants)
+    :param events:      The :class:`EventBus` for this sync
+    :returns:           The number of changesets that were pushed
+    '''
+    batch = local.pushBatch
+    if not batch or len(outgoings) <= batch:
+        return 0
+    ends = range(batch - 1, len(outgoings) - 1, batch)
+    for count, end in enumerate(ends, 1):
+        events.Emit(Notice(
+                'Pushing batch {0} of {1}'.format(count, len(ends) + 1)
+                ))
+        local.PushToRemote([outgoings[end].hash], [])
+        events.Emit(ChangesetsPushed(outgoings[end + 1 - batch:end + 1]))
+    return ends[-1] + 1
+
+
+def _SyncPatches(local, remote, appliedPatch, delta, remoteClean, options,
+                 events):
+    '''
+    Syncs the mq patch queue and applies the same patches on the remote
+    as are applied locally.  Only the mq repository is used locally, and
+    it's only locked while it's committed (& squashed).
+
+    :param local:           The local repository
+    :param remote:          The remote repository
+    :param appliedPatch:    The last patch applied locally, or None
+    :param delta:           A :class:`MqDelta` if the delta strategy is
+                            being used, otherwise None
+    :param remoteClean:     True if all patches have been popped on the
+                            remote
+    :param options:         The :class:`SyncOptions` for this sync
+    :param events:          The :class:`EventBus` for this sync
+    '''
+    if delta:
+        with events.Phase('mq-delta'):
+            changed = delta.changedFiles
+            if changed:
+                events.Emit(Notice(
+                        'Sending {0} changed mq files'.format(len(changed))
+                        ))
+            sent = delta.Sync(appliedPatch, remoteClean)
+        if sent:
+            events.Emit(BytesSent('mq patches', sent))
+    elif appliedPatch:
+        with events.Phase('mq-repo'):
+            with local.LockWorkingCopy():
+                local.CommitMq()
+                threshold = options.mq_squash_threshold
+                squashed = threshold and \
+                        local.mqCommitCount > threshold and \
+                        _SquashLocalMq(local, events)
+            if squashed:
+                _ReplaceRemoteMq(local, remote, options, events)
+            else:
+                local.PushMqToRemote()
+        with events.Phase('mq-update'):
+            remote.UpdateMq()
+            remote.PushPatch(appliedPatch)
+    if appliedPatch:
+        events.Emit(PatchApplied(appliedPatch))
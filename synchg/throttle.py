@@ -0,0 +1,122 @@
+'''
+This module limits the rate that synchg sends data to a remote host.
+:class:`RateLimiter` paces data that synchg sends itself, and hg's ssh
+connections are throttled by running ssh through this module as a relay::
+
+    python throttle.py RATE ssh [ARGS...]
+
+The relay starts the ssh command and copies it's own stdin to the command no
+faster than RATE bytes per second.  The output of the command isn't limited.
+Only the standard library is used, so that the relay starts quickly.
+'''
+
+import os
+import sys
+import time
+import errno
+import pipes
+from subprocess import Popen, PIPE
+
+__all__ = ['RateLimiter', 'Relay', 'ThrottledSsh']
+
+# The size of the chunks that the relay copies
+_ChunkSize = 16 * 1024
+
+
+class RateLimiter(object):
+    '''
+    Paces data so that it's sent no faster than a given rate.  Up to a
+    second's worth of data can be sent in a burst after a pause.
+    '''
+
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        '''
+        :param rate:    The rate in bytes per second.  0 means no limit
+        :param clock:   The function used to get the time
+        :param sleep:   The function used to wait
+        '''
+        self.rate = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._allowance = rate
+        self._last = clock()
+
+    def Wait(self, size):
+        '''
+        Waits until size bytes can be sent
+
+        :param size:    The number of bytes about to be sent
+        '''
+        if not self.rate:
+            return
+        now = self._clock()
+        self._allowance = min(
+                self._allowance + (now - self._last) * self.rate, self.rate
+                )
+        self._last = now
+        self._allowance -= size
+        if self._allowance < 0:
+            self._sleep(-self._allowance / float(self.rate))
+
+
+def Relay(argv, rate, source=None):
+    '''
+    Runs a command, copying data from a file descriptor to it's stdin no
+    faster than rate.  The command's stdout & stderr are inherited.
+
+    :param argv:    The command line to run
+    :param rate:    The rate limit in bytes per second
+    :param source:  The file descriptor to copy from.  Defaults to stdin
+    :returns:       The exit code of the command
+    '''
+    if source is None:
+        source = sys.stdin.fileno()
+    proc = Popen(argv, stdin=PIPE, bufsize=0)
+    limiter = RateLimiter(rate)
+    try:
+        while True:
+            data = os.read(source, _ChunkSize)
+            if not data:
+                break
+            limiter.Wait(len(data))
+            proc.stdin.write(data)
+    except (IOError, OSError) as e:
+        # The command exiting before we've finished isn't our error to report
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+    return proc.wait()
+
+
+def ThrottledSsh(ssh, rate):
+    '''
+    Builds an ssh command for hg's ``ui.ssh`` that sends data through the
+    relay in this module
+
+    :param ssh:     The ssh command line to throttle
+    :param rate:    The rate limit in bytes per second
+    :returns:       A command line string
+    '''
+    script = os.path.abspath(__file__)
+    if script.endswith(('.pyc', '.pyo')):
+        script = script[:-1]
+    return '{0} {1} {2} {3}'.format(
+            pipes.quote(sys.executable), pipes.quote(script), int(rate), ssh
+            )
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if len(args) < 2:
+        sys.stderr.write('usage: throttle.py RATE COMMAND [ARGS...]\n')
+        return 2
+    return Relay(args[1:], int(args[0]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,374 @@
+'''
+This module records traces of syncs, for diagnosing slow syncs.  A
+:class:`Tracer` profiles the synchg process with cProfile and keeps a
+transcript of every command the repositories run.  The transcript can be
+summarised, or replayed against mocks with :class:`ReplayCommands` so that a
+slow case can become a performance regression test.  To summarise a trace::
+
+    python -m synchg.trace FILE
+'''
+
+import sys
+import json
+import time
+import cProfile
+import tempfile
+import posixpath
+from StringIO import StringIO
+from contextlib import contextmanager
+from collections import namedtuple
+from plumbum.commands import ProcessExecutionError
+from events import CommandRun
+
+__all__ = [
+        'TraceRecord', 'Tracer', 'LoadTranscript', 'Summarise',
+        'ReplayCommands', 'ReplayError'
+        ]
+
+# A command in a transcript.  The fields are those of
+# :class:`synchg.events.CommandRun`, along with start: the number of seconds
+# between the trace starting and the command starting
+TraceRecord = namedtuple(
+        'TraceRecord', ['start'] + list(CommandRun._fields)
+        )
+
+
+class Tracer(object):
+    '''
+    An event subscriber that records a transcript of the commands run, and
+    a context manager that profiles the code run within it.  On exit the
+    transcript is written to the trace path, and the profile to
+    ``<path>.prof`` for reading with pstats or a profile viewer.
+    '''
+
+    def __init__(self, path, clock=time.time):
+        '''
+        :param path:    The path to write the transcript to
+        :param clock:   The function used to get the time
+        '''
+        self.path = path
+        self.records = []
+        self._clock = clock
+        self._start = clock()
+        self._profile = cProfile.Profile()
+
+    def __call__(self, event):
+        if isinstance(event, CommandRun):
+            start = self._clock() - event.duration - self._start
+            self.records.append(TraceRecord(max(start, 0), *event))
+
+    def __enter__(self):
+        self._start = self._clock()
+        self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profile.disable()
+        self._profile.dump_stats(self.path + '.prof')
+        with open(self.path, 'w') as f:
+            for record in self.records:
+                f.write(json.dumps(record._asdict(), sort_keys=True) + '\n')
+
+
+def LoadTranscript(path):
+    '''
+    Reads a transcript written by a :class:`Tracer`
+
+    :param path:    The path of the transcript
+    :returns:       A list of :class:`TraceRecord`
+    '''
+    with open(path) as f:
+        return [
+                TraceRecord(**dict(
+                    (str(name), value)
+                    for name, value in json.loads(line).iteritems()
+                    ))
+                for line in f if line.strip()
+                ]
+
+
+def Summarise(records, slowest=5):
+    '''
+    Summarises a transcript: where the time went, by command & machine, and
+    the slowest commands
+
+    :param records: A list of :class:`TraceRecord`
+    :param slowest: The number of slowest commands to list
+    :returns:       A list of lines of text
+    '''
+    total = sum(record.duration for record in records)
+    remote = [record for record in records if record.remote]
+    lines = [
+            '{0} commands took {1:.2f}s'.format(len(records), total),
+            '{0} round trips to the remote took {1:.2f}s'.format(
+                len(remote), sum(record.duration for record in remote)
+                ),
+            '',
+            ]
+    byCommand = {}
+    for record in records:
+        key = (record.machine, ' '.join(record.argv[:2]))
+        count, duration = byCommand.get(key, (0, 0))
+        byCommand[key] = (count + 1, duration + record.duration)
+    for (machine, command), (count, duration) in sorted(
+            byCommand.iteritems(), key=lambda item: -item[1][1]
+            ):
+        lines.append('{0:8.2f}s {1:4}x {2}: {3}'.format(
+                duration, count, machine, command
+                ))
+    lines.append('')
+    lines.append('Slowest commands:')
+    for record in sorted(records, key=lambda r: -r.duration)[:slowest]:
+        lines.append('{0:8.2f}s at {1:.2f}s {2}: {3}'.format(
+                record.duration, record.start, record.machine,
+                ' '.join(record.argv)
+                ))
+    return lines
+
+
+class ReplayError(Exception):
+    '''
+    Raised when a replayed command isn't in the transcript
+    '''
+    pass
+
+
+class ReplayCommands(object):
+    '''
+    Replays the timing of a transcript against mocks.  Commands from
+    :meth:`Machine` are matched to the next unused record with the same
+    machine & command line.  Rather than sleeping, each command adds it's
+    recorded duration to :attr:`elapsed`, so a test can assert that the
+    code under test doesn't take longer than the transcript it came from.
+    The machines can be used to create a :class:`synchg.repo.Repo`, so a
+    whole sync can be replayed.
+    '''
+
+    def __init__(self, records, outputs=None, strict=True):
+        '''
+        :param records: A list of :class:`TraceRecord`
+        :param outputs: An optional dictionary mapping tuples of command
+                        line arguments to the output they should return.
+                        A list of outputs is returned in turn by repeated
+                        runs of a command, with the last one repeated.
+                        Transcripts only record the size of the output, so
+                        other commands return an empty string
+        :param strict:  If True, commands not in the transcript raise a
+                        :class:`ReplayError`.  Otherwise they take no time
+        '''
+        self.unused = list(records)
+        self.elapsed = 0
+        self.run = []
+        self._outputs = dict(
+                (argv, list(output) if isinstance(output, list) else output)
+                for argv, output in (outputs or {}).iteritems()
+                )
+        self._strict = strict
+
+    def Machine(self, name='local', cwd='/'):
+        '''
+        Gets a mock plumbum machine whose commands are replayed.  None of
+        the files on the machine exist, although the path of the working
+        directory is used for any local files, such as lock files.
+
+        :param name:    The name of the machine, as recorded in the
+                        transcript
+        :param cwd:     The working directory of the machine
+        '''
+        return _ReplayMachine(self, name, cwd)
+
+    def _Output(self, argv):
+        ''' Gets the output a command should return '''
+        output = self._outputs.get(tuple(argv), '')
+        if isinstance(output, list):
+            if len(output) > 1:
+                return output.pop(0)
+            return output[0] if output else ''
+        return output
+
+    def Run(self, machine, argv):
+        '''
+        Replays a command
+
+        :param machine: The name of the machine the command runs on
+        :param argv:    The command line, as a list of strings
+        :returns:       The output of the command
+        '''
+        for index, record in enumerate(self.unused):
+            if record.machine == machine and record.argv == argv:
+                del self.unused[index]
+                self.elapsed += record.duration
+                self.run.append(record)
+                output = self._Output(argv)
+                if record.retcode != 0:
+                    raise ProcessExecutionError(
+                            argv, record.retcode, output, ''
+                            )
+                return output
+        if self._strict:
+            raise ReplayError(
+                    'Not in transcript: {0}: {1}'.format(
+                        machine, ' '.join(argv)
+                        )
+                    )
+        return self._Output(argv)
+
+
+class _ReplayPath(object):
+    '''
+    A path on a replayed machine.  No files exist on a replayed machine, so
+    there's nothing to read or delete.
+    '''
+
+    def __init__(self, path):
+        self._path = path
+
+    def __div__(self, other):
+        return _ReplayPath(posixpath.join(self._path, str(other)))
+
+    def __str__(self):
+        return self._path
+
+    def exists(self):
+        return False
+
+    def delete(self):
+        pass
+
+
+class _ReplayWorkdir(_ReplayPath):
+    '''
+    The working directory of a replayed machine.  Like a plumbum
+    ``Workdir``, calling it changes directory for the life of a context.
+    '''
+
+    def __init__(self, machine):
+        super(_ReplayWorkdir, self).__init__(machine._cwd)
+        self._machine = machine
+
+    @contextmanager
+    def __call__(self, path):
+        previous = self._machine._cwd
+        self._machine._cwd = posixpath.join(previous, str(path))
+        try:
+            yield
+        finally:
+            self._machine._cwd = previous
+
+
+class _ReplayEnv(dict):
+    '''
+    The environment of a replayed machine.  Like a plumbum ``Env``, calling
+    it sets variables for the life of a context.
+    '''
+
+    @contextmanager
+    def __call__(self, **kwargs):
+        previous = dict(self)
+        self.update(kwargs)
+        try:
+            yield
+        finally:
+            self.clear()
+            self.update(previous)
+
+
+class _ReplayMachine(object):
+    def __init__(self, replay, name, cwd):
+        self._replay = replay
+        self._name = name
+        self._cwd = cwd
+        self.env = _ReplayEnv()
+
+    @property
+    def cwd(self):
+        return _ReplayWorkdir(self)
+
+    def path(self, *parts):
+        return _ReplayPath(posixpath.join(self._cwd, *map(str, parts)))
+
+    def __getitem__(self, command):
+        return _ReplayCommand(self._replay, self._name, [command])
+
+    def popen(self, args, **kwargs):
+        if not isinstance(args, (tuple, list)):
+            args = (args,)
+        return self[args[0]].popen(args[1:], **kwargs)
+
+    def __str__(self):
+        return self._name
+
+
+class _ReplayCommand(object):
+    def __init__(self, replay, machine, argv):
+        self._replay = replay
+        self._machine = machine
+        self._argv = argv
+
+    def __getitem__(self, args):
+        if not isinstance(args, tuple):
+            args = (args,)
+        return _ReplayCommand(
+                self._replay, self._machine,
+                self._argv + [str(arg) for arg in args]
+                )
+
+    def __lshift__(self, data):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return self._replay.Run(
+                self._machine, self._argv + [str(arg) for arg in args]
+                )
+
+    def popen(self, args=(), **kwargs):
+        if not isinstance(args, (tuple, list)):
+            args = (args,)
+        return _ReplayPopen(
+                self._replay, self._machine,
+                self._argv + [str(arg) for arg in args]
+                )
+
+    def __str__(self):
+        return ' '.join(self._argv)
+
+
+class _ReplayPopen(object):
+    '''
+    Stands in for the ``Popen`` of a replayed command.  The command is
+    replayed as it starts, so it's output can be read straight away.
+    '''
+
+    def __init__(self, replay, machine, argv):
+        self.argv = argv
+        try:
+            output = replay.Run(machine, argv)
+            self.returncode = 0
+        except ProcessExecutionError as e:
+            output = e.stdout
+            self.returncode = e.retcode
+        self.stdin = StringIO()
+        self.stdout = StringIO(output)
+        # stderr is read through it's file descriptor, so needs a real file
+        self.stderr = tempfile.TemporaryFile()
+
+    def wait(self):
+        return self.returncode
+
+    def communicate(self, input=None):
+        return self.stdout.read(), self.stderr.read()
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if len(args) != 1:
+        sys.stderr.write('usage: python -m synchg.trace FILE\n')
+        return 2
+    for line in Summarise(LoadTranscript(args[0])):
+        print line
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+'''
+This module provides utilities for sending data to a remote machine through
+the plumbum machine that synchg already has open, rather than through a
+separate mercurial connection.
+'''
+
+import os
+import tarfile
+from StringIO import StringIO
+from subprocess import PIPE
+from plumbum.commands import ProcessExecutionError
+from throttle import RateLimiter
+from progress import ProgressTracker
+
+__all__ = ['BuildArchive', 'SendData']
+
+# The size of the chunks that data is streamed to remote commands in
+ChunkSize = 64 * 1024
+
+
+def BuildArchive(root, paths=(), extra=None, level=9):
+    '''
+    Builds a gzip compressed tar archive in memory
+
+    :param root:    The local directory that paths are relative to
+    :param paths:   A list of relative paths of files to add to the archive
+    :param extra:   A dictionary of archive path to string contents, for
+                    adding files that don't exist on disk
+    :param level:   The gzip compression level, from 0 (none) to 9 (best)
+    :returns:       The archive as a string
+    '''
+    data = StringIO()
+    archive = tarfile.open(fileobj=data, mode='w:gz', compresslevel=level)
+    try:
+        for path in paths:
+            archive.add(os.path.join(str(root), path), path, recursive=False)
+        for path, contents in (extra or {}).iteritems():
+            info = tarfile.TarInfo(path)
+            info.size = len(contents)
+            archive.addfile(info, StringIO(contents))
+    finally:
+        archive.close()
+    return data.getvalue()
+
+
+def SendData(command, data, rate=0, progress=None):
+    '''
+    Runs a command, streaming data to it's stdin
+
+    :param command:     The plumbum command to run
+    :param data:        The string to send
+    :param rate:        The maximum rate to send at, in bytes per second.
+                        0 means no limit
+    :param progress:    An optional progress callback, that is passed a
+                        :class:`synchg.progress.Progress` as data is sent
+    :returns:           The stdout of the command
+    '''
+    limiter = RateLimiter(rate)
+    tracker = ProgressTracker(progress) if progress else None
+    proc = command.popen(stdin=PIPE)
+    try:
+        for offset in xrange(0, len(data), ChunkSize):
+            chunk = data[offset:offset + ChunkSize]
+            limiter.Wait(len(chunk))
+            proc.stdin.write(chunk)
+            if tracker:
+                tracker.Update(
+                        'sending', offset + len(chunk), len(data), 'bytes'
+                        )
+    finally:
+        proc.stdin.close()
+        # Stop communicate from trying to flush the closed stdin
+        proc.stdin = None
+    stdout, stderr = proc.communicate()
+    if tracker:
+        tracker.Finish()
+    if proc.returncode != 0:
+        raise ProcessExecutionError(
+                getattr(proc, 'argv', None), proc.returncode, stdout, stderr
+                )
+    return stdout
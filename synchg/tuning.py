@@ -0,0 +1,186 @@
+'''
+This module tunes how synchg transfers data to a remote host from measured
+characteristics of the link to it.  The round trip time and throughput of the
+link are measured with two small remote commands, and stored in the
+:class:`HostState` for the host so that they're only measured again when they
+expire.  From these a :class:`TransferSettings` is chosen: whether hg's ssh
+connections are compressed, the compression level of the archives synchg
+sends itself, and how many changesets are pushed at a time.  Any of these can
+be fixed with options rather than chosen.
+'''
+
+import os
+import time
+from collections import namedtuple
+from transfer import SendData
+
+__all__ = [
+        'LinkStats', 'TransferSettings', 'MeasureLink', 'LinkStatsFor',
+        'ChooseSettings', 'TuneTransfers'
+        ]
+
+# Measured characteristics of the link to a host
+#   rtt:        The time taken to run a no-op remote command, in seconds
+#   throughput: The rate data can be sent to the host, in bytes per second
+LinkStats = namedtuple('LinkStats', ['rtt', 'throughput'])
+
+# How transfers to a host are done
+#   sshCompression:     Whether hg's ssh connections use compression
+#   compressionLevel:   The gzip level (0-9) of archives synchg sends
+#   pushBatch:          The number of changesets to push at a time.  0 means
+#                       everything is pushed at once
+TransferSettings = namedtuple(
+        'TransferSettings', ['sshCompression', 'compressionLevel', 'pushBatch']
+        )
+
+# The number of bytes sent to measure throughput
+ProbeSize = 256 * 1024
+
+# Links at least this fast (bytes per second) are treated as local networks,
+# where compressing data takes longer than sending it
+FastLink = 20 * 1024 * 1024
+
+# Links slower than this are pushed to in batches, so that an interrupted
+# sync keeps the changesets it has already sent
+SlowLink = 1024 * 1024
+
+# The number of changesets pushed at a time on slow links
+SlowLinkBatch = 200
+
+# The settings used for fast, medium & slow links
+_FastSettings = TransferSettings(False, 1, 0)
+_MediumSettings = TransferSettings(True, 6, 0)
+_SlowSettings = TransferSettings(True, 9, SlowLinkBatch)
+
+# The key that link stats are stored under in the host state
+_StateKey = 'link'
+
+_TrueValues = ['1', 'yes', 'true', 'on']
+_FalseValues = ['0', 'no', 'false', 'off']
+
+
+def MeasureLink(machine, probeSize=ProbeSize):
+    '''
+    Measures the link to a remote machine
+
+    :param machine:     The plumbum machine for the host
+    :param probeSize:   The number of bytes to send to measure throughput
+    :returns:           A :class:`LinkStats`
+    '''
+    # Look the commands up first, so only running them is timed
+    true = machine['true']
+    wc = machine['wc']['-c']
+    start = time.time()
+    true()
+    rtt = time.time() - start
+    # Random data, so that any compression on the link doesn't flatter it
+    data = os.urandom(probeSize)
+    start = time.time()
+    SendData(wc, data)
+    elapsed = max(time.time() - start - rtt, 0.001)
+    return LinkStats(rtt, probeSize / elapsed)
+
+
+def LinkStatsFor(machine, state, ttl):
+    '''
+    Gets the link stats for a host, measuring them if the stored stats are
+    missing or expired
+
+    :param machine: The plumbum machine for the host
+    :param state:   The :class:`synchg.state.HostState` for the host
+    :param ttl:     The number of seconds that stored stats can be used for.
+                    If 0, the link is measured every time
+    :returns:       A :class:`LinkStats`
+    '''
+    if ttl:
+        stored = state.Get(_StateKey, ttl=ttl)
+        if stored is not None:
+            return LinkStats(*stored)
+    stats = MeasureLink(machine)
+    if ttl:
+        state.Set(_StateKey, list(stats))
+    return stats
+
+
+def ChooseSettings(stats):
+    '''
+    Chooses transfer settings for a link
+
+    :param stats:   A :class:`LinkStats`
+    :returns:       A :class:`TransferSettings`
+    '''
+    if stats.throughput >= FastLink:
+        return _FastSettings
+    if stats.throughput >= SlowLink:
+        return _MediumSettings
+    return _SlowSettings
+
+
+def _ParseSetting(name, value, parse):
+    '''
+    Parses a tuning option
+
+    :param name:    The name of the option, for error messages
+    :param value:   The value of the option
+    :param parse:   A function that converts a (non auto) string value
+    :returns:       The parsed value, or None if the value is auto
+    '''
+    if not isinstance(value, basestring):
+        return value
+    if value.lower() == 'auto':
+        return None
+    try:
+        return parse(value.lower())
+    except ValueError:
+        raise ValueError('Invalid value for {0}: {1}'.format(name, value))
+
+
+def _ParseBool(value):
+    if value in _TrueValues:
+        return True
+    if value in _FalseValues:
+        return False
+    raise ValueError(value)
+
+
+def _ParseLevel(value):
+    level = int(value)
+    if not 0 <= level <= 9:
+        raise ValueError(value)
+    return level
+
+
+def _ParseBatch(value):
+    batch = int(value)
+    if batch < 0:
+        raise ValueError(value)
+    return batch
+
+
+def TuneTransfers(machine, state, options):
+    '''
+    Gets the transfer settings for a host.  Settings that are fixed by the
+    options are used as they are, and the rest are chosen from the link
+    stats.  The link is only measured if some settings need chosen.
+
+    :param machine: The plumbum machine for the host
+    :param state:   The :class:`synchg.state.HostState` for the host
+    :param options: A :class:`synchg.sync.SyncOptions`
+    :returns:       A :class:`TransferSettings`
+    '''
+    fixed = TransferSettings(
+            _ParseSetting('ssh_compression', options.ssh_compression,
+                          _ParseBool),
+            _ParseSetting('compression_level', options.compression_level,
+                          _ParseLevel),
+            _ParseSetting('push_batch', options.push_batch, _ParseBatch)
+            )
+    if None not in fixed:
+        return fixed
+    chosen = ChooseSettings(
+            LinkStatsFor(machine, state, options.link_probe_ttl)
+            )
+    return TransferSettings(*[
+            value if value is not None else default
+            for value, default in zip(fixed, chosen)
+            ])
@@ -0,0 +1,35 @@
+'''
+This module finds the directory that synchg keeps it's configuration & state
+in.  This is the directory clint's resources use, but working it out without
+importing clint saves a noticeable amount of startup time.
+'''
+
+import os
+import sys
+
+__all__ = ['UserDirectory']
+
+Vendor = 'obmarg'
+AppName = 'synchg'
+
+
+def UserDirectory():
+    '''
+    Gets the synchg user directory.  It isn't created if it doesn't exist.
+
+    :returns:   A path string
+    '''
+    if sys.platform.startswith('win'):
+        # Finding the application data folder on windows needs the win32
+        # APIs, so leave it to clint
+        from clint import resources
+        resources.init(Vendor, AppName)
+        return resources.user.path
+    if sys.platform == 'darwin':
+        return os.path.join(
+                os.path.expanduser('~/Library/Application Support/'), AppName
+                )
+    return os.path.join(
+            os.getenv('XDG_CONFIG_HOME', os.path.expanduser('~/.config')),
+            AppName
+            )
@@ -29,16 +29,12 @@ def yn(prompt, default='y', batch=False):
             input = ''
 
         # If input is empty default choice is assumed
-        # so we return True
         if input == '':
-            return True
+            return default == 'y'
 
-        # Given 'yes' as input if default choice is y
-        # then return True, False otherwise
+        # Unlike clint, return whether the answer was yes rather than
+        # whether it was the default
         if match('y(?:es)?', input, I):
-            return True if default == 'y' else False
-
-        # Given 'no' as input if default choice is n
-        # then return True, False otherwise
+            return True
         elif match('n(?:o)?', input, I):
-            return True if default == 'n' else False
+            return False
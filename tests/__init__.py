@@ -1,2 +1,21 @@
 
 from repo import *
+from index import *
+from sync import *
+from cleanup import *
+from mqdelta import *
+from hgenv import *
+from hgprofile import *
+from inprocess import *
+from paramikomachine import *
+from tuning import *
+from throttle import *
+from progress import *
+from events import *
+from metrics import *
+from trace import *
+from userdir import *
+from lease import *
+from scheduler import *
+from fleet import *
+from policy import *
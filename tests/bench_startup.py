@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+'''
+Benchmarks the startup costs of a sync.  This isn't collected by the test
+runner - run it by hand.  It times either the hg commands synchg runs most
+often, with the full and lean profiles, from the root of a mercurial
+repository::
+
+    python tests/bench_startup.py [--host HOST] [--runs N]
+
+If a host is given the commands are run in the home directory of that host
+over ssh, otherwise they are run locally.  Or it times importing synchg, in
+fresh python processes::
+
+    python tests/bench_startup.py --imports [--runs N] [--max MS]
+
+With ``--max`` it exits with an error if the mean import time of any module
+is over the limit, or if a module imports something it shouldn't, so it can
+be used to catch startup regressions.
+'''
+
+import os
+import sys
+import time
+import subprocess
+
+Root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, Root)
+
+from plumbum import cli, local
+
+# The commands that are timed.  These are the ones synchg runs most often
+Commands = [
+        ('id', '-i', '-b'),
+        ('summary',),
+        ('qtop',),
+        ]
+
+# The modules whose imports are timed, and the modules that should not have
+# been imported once they have been
+Modules = [
+        ('synchg', ['synchg.sync', 'plumbum']),
+        ('synchg.script', ['synchg.sync', 'clint', 'mercurial']),
+        ('synchg.sync', ['synchg.metrics', 'synchg.trace', 'mercurial']),
+        ]
+
+# Prints the time taken to import a module, and the modules it imported
+_ImportScript = '''
+import sys, time
+start = time.time()
+import {0}
+print (time.time() - start) * 1000
+print ' '.join(sys.modules)
+'''
+
+
+def TimeCommand(command, runs):
+    '''
+    Times a command
+
+    :param command: The plumbum (or profiled) command to run
+    :param runs:    The number of times to run it
+    :returns:       The mean time of a run in milliseconds
+    '''
+    start = time.time()
+    for _ in xrange(runs):
+        command(retcode=None)
+    return (time.time() - start) * 1000 / runs
+
+
+def TimeImport(module, runs):
+    '''
+    Times importing a module in new python processes
+
+    :param module:  The name of the module to import
+    :param runs:    The number of times to import it
+    :returns:       A tuple of the mean time in milliseconds, and the names
+                    of the modules that were imported
+    '''
+    total = 0
+    for _ in xrange(runs):
+        output = subprocess.check_output(
+                [sys.executable, '-c', _ImportScript.format(module)],
+                cwd=Root
+                )
+        elapsed, modules = output.splitlines()
+        total += float(elapsed)
+    return total / runs, modules.split()
+
+
+def BenchmarkCommands(machine, runs):
+    '''
+    Prints the mean time of each command with each profile
+    '''
+    from synchg.hgenv import ReadConfig
+    from synchg.hgprofile import LeanProfile
+    hg = machine['hg']
+    profiles = [
+            ('full', hg),
+            ('lean', LeanProfile(ReadConfig(hg, 'ui')).Wrap(machine, hg))
+            ]
+    print '{0:<16} {1:>10} {2:>10}'.format('command', 'full', 'lean')
+    for args in Commands:
+        times = [TimeCommand(command[args], runs) for _, command in profiles]
+        print '{0:<16} {1:>8.1f}ms {2:>8.1f}ms'.format(' '.join(args), *times)
+
+
+def BenchmarkImports(runs, limit=None):
+    '''
+    Prints the mean time to import each module
+
+    :param runs:    The number of times to import each module
+    :param limit:   An optional maximum mean time in milliseconds
+    :returns:       False if a module was over the limit, or imported a
+                    module that it shouldn't have
+    '''
+    passed = True
+    print '{0:<16} {1:>10}'.format('module', 'import')
+    for module, unwanted in Modules:
+        elapsed, imported = TimeImport(module, runs)
+        print '{0:<16} {1:>8.1f}ms'.format(module, elapsed)
+        for name in unwanted:
+            if name in imported:
+                print '  imported {0}'.format(name)
+                passed = False
+        if limit is not None and elapsed > limit:
+            passed = False
+    return passed
+
+
+class BenchStartup(cli.Application):
+    host = cli.SwitchAttr(['--host'], help='The host to run commands on')
+    runs = cli.SwitchAttr(
+            ['--runs'], int, default=20, help='The number of runs of each'
+            )
+    imports = cli.Flag(
+            ['--imports'], help='Time importing synchg rather than hg'
+            )
+    limit = cli.SwitchAttr(
+            ['--max'], float, requires=['--imports'],
+            help='The maximum mean import time, in milliseconds'
+            )
+
+    def main(self):
+        if self.imports:
+            return 0 if BenchmarkImports(self.runs, self.limit) else 1
+        if self.host:
+            from synchg.remote import RemoteMachine
+            with RemoteMachine(self.host) as machine:
+                BenchmarkCommands(machine, self.runs)
+        else:
+            BenchmarkCommands(local, self.runs)
+
+
+if __name__ == '__main__':
+    BenchStartup.run()
@@ -0,0 +1,171 @@
+
+import os
+import time
+import shutil
+import tempfile
+from should_dsl import should
+from plumbum import local
+from synchg.cleanup import BackupRetention, CollectGarbage, PruneBackups
+from synchg.state import HostState
+
+# Keep pep8 happy
+equal_to = be = throw = None
+
+
+def MakeBackups(path, count, size=1024):
+    backups = os.path.join(path, '.hg', 'strip-backup')
+    os.makedirs(backups)
+    now = time.time()
+    for i in range(count):
+        name = os.path.join(backups, '{0}-backup.hg'.format(i))
+        with open(name, 'w') as f:
+            f.write('x' * size)
+        # Make the higher numbered backups newer
+        os.utime(name, (now - (count - i) * 86400, now - (count - i) * 86400))
+    return backups
+
+
+class TestCleanup(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def it_keeps_a_number_of_backups(self):
+        backups = MakeBackups(self.dir, 5)
+        PruneBackups(local, self.dir, BackupRetention(2, 0, 0))
+        sorted(os.listdir(backups)) |should| equal_to(
+                ['3-backup.hg', '4-backup.hg']
+                )
+
+    def it_removes_old_backups(self):
+        backups = MakeBackups(self.dir, 5)
+        PruneBackups(local, self.dir, BackupRetention(0, 3, 0))
+        sorted(os.listdir(backups)) |should| equal_to(
+                ['2-backup.hg', '3-backup.hg', '4-backup.hg']
+                )
+
+    def it_limits_backup_size(self):
+        backups = MakeBackups(self.dir, 3, size=600 * 1024)
+        PruneBackups(local, self.dir, BackupRetention(0, 0, 1))
+        os.listdir(backups) |should| equal_to(['2-backup.hg'])
+
+    def it_collects_garbage_from_all_repos(self):
+        MakeBackups(os.path.join(self.dir, 'one'), 2)
+        MakeBackups(os.path.join(self.dir, 'two'), 2)
+        os.makedirs(os.path.join(self.dir, 'orphan', '.hg'))
+        lines = CollectGarbage(
+                local, self.dir, BackupRetention(1, 0, 0), ['orphan']
+                )
+        len(lines) |should| equal_to(3)
+        sorted(os.listdir(self.dir)) |should| equal_to(['one', 'two'])
+
+    def it_refuses_bad_orphan_names(self):
+        (lambda: CollectGarbage(
+            local, self.dir, BackupRetention(0, 0, 0), ['../etc']
+            )) |should| throw(ValueError)
+
+
+# A stand in for hg that logs it's arguments, and reports the working
+# directory of an mq repository as being at the revision in $PARENT, and
+# it's tip as the revision in $TIP
+FakeHg = """#!/bin/sh
+echo "$@" >> "$LOG"
+case "$*" in
+    *"log -r . "*) echo "$PARENT" ;;
+    *"log -r tip "*) echo "$TIP" ;;
+    *"log -r "*) echo stalenode ;;
+esac
+"""
+
+
+class TestStaleMq(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dir, 'repo', '.hg', 'patches', '.hg'))
+        self.hg = os.path.join(self.dir, 'hg')
+        with open(self.hg, 'w') as f:
+            f.write(FakeHg)
+        os.chmod(self.hg, 0755)
+        self.log = os.path.join(self.dir, 'log')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def Run(self, parent, tip=None):
+        with local.env(LOG=self.log, PARENT=parent, TIP=tip or parent):
+            CollectGarbage(
+                    local, self.dir, BackupRetention(0, 0, 0), hg=self.hg
+                    )
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def Strips(self, parent):
+        return [line for line in self.Run(parent) if ' strip ' in line]
+
+    def it_strips_stale_commits_with_backups(self):
+        strips = self.Strips('3')
+        len(strips) |should| equal_to(1)
+        ('--no-backup' in strips[0]) |should| equal_to(False)
+
+    def it_leaves_mq_repos_at_null_alone(self):
+        self.Strips('-1') |should| equal_to([])
+
+    def it_moves_to_the_newest_history_before_stripping(self):
+        lines = self.Run('3', tip='5')
+        updates = [i for i, line in enumerate(lines) if ' update ' in line]
+        strips = [i for i, line in enumerate(lines) if ' strip ' in line]
+        len(updates) |should| equal_to(1)
+        ('update -c tip' in lines[updates[0]]) |should| equal_to(True)
+        (updates[0] < strips[0]) |should| equal_to(True)
+
+    def it_only_updates_when_behind_tip(self):
+        lines = self.Run('3')
+        [line for line in lines if ' update ' in line] |should| equal_to([])
+
+
+class TestHostState(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def it_persists_entries(self):
+        HostState('host', self.dir).Set('key', {'a': 1})
+        HostState('host', self.dir).Get('key') |should| equal_to({'a': 1})
+
+    def it_expires_entries(self):
+        state = HostState('host', self.dir)
+        state.Set('key', 1)
+        state.Get('key', ttl=3600) |should| equal_to(1)
+        state.Get('key', 'default', ttl=-1) |should| equal_to('default')
+
+    def it_deletes_entries(self):
+        state = HostState('host', self.dir)
+        state.Set('key', 1)
+        state.Delete('key')
+        HostState('host', self.dir).Get('key') |should| be(None)
+
+    def it_keeps_changes_made_by_other_instances(self):
+        first = HostState('host', self.dir)
+        second = HostState('host', self.dir)
+        first.Get('a') |should| be(None)
+        second.Set('b', 2)
+        first.Set('a', 1)
+        HostState('host', self.dir).Get('b') |should| equal_to(2)
+
+    def it_updates_the_latest_value(self):
+        first = HostState('host', self.dir)
+        first.Set('projects', {'a': 1})
+        HostState('host', self.dir).Update(
+                'projects', lambda p: dict(p, b=2), {}
+                )
+        first.Update('projects', lambda p: dict(p, c=3), {}) |should| \
+                equal_to({'a': 1, 'b': 2, 'c': 3})
+
+    def it_leaves_no_temporary_files(self):
+        HostState('host', self.dir).Set('key', 1)
+        sorted(os.listdir(self.dir)) |should| \
+                equal_to(['host.json', 'host.json.lock'])
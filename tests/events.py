@@ -0,0 +1,108 @@
+
+import json
+from StringIO import StringIO
+from mock import Mock, MagicMock, patch
+from should_dsl import should
+from synchg.repo import Repo
+from synchg.sync import SyncOptions, SyncRemote, AbortException, SyncError
+from synchg.sync import _SyncPatches
+from synchg.events import EventBus, ConsoleSubscriber, JsonLinesSubscriber
+from synchg.events import PhaseStarted, PhaseFinished, SyncStarted
+from synchg.events import SyncFinished, ChangesetsStripped, PatchApplied
+from synchg.events import Notice
+
+# Keep pep8 happy
+equal_to = throw = None
+
+
+class TestEventBus(object):
+    def setup(self):
+        self.events = []
+        self.bus = EventBus([self.events.append])
+
+    def it_reports_phases(self):
+        with self.bus.Phase('push'):
+            pass
+        self.events[0] |should| equal_to(PhaseStarted('push'))
+        (self.events[1].phase, self.events[1].ok) |should| \
+                equal_to(('push', True))
+
+    def it_reports_failed_phases(self):
+        def Fail():
+            with self.bus.Phase('push'):
+                raise ValueError()
+        Fail |should| throw(ValueError)
+        self.events[1].ok |should| equal_to(False)
+
+
+class TestSubscribers(object):
+    def it_prints_familiar_output(self):
+        console = ConsoleSubscriber()
+        console.Format(SyncStarted('host', 'proj')) |should| \
+                equal_to('Sync proj -> host')
+        console.Format(PhaseStarted('push')) |should| \
+                equal_to('Pushing to remote')
+        console.Format(PhaseStarted('discovery')) |should| equal_to(None)
+        console.Format(SyncFinished('host', 'proj', 1.0, 'ok')) |should| \
+                equal_to('Ok!')
+
+    def it_writes_json_lines(self):
+        stream = StringIO()
+        subscriber = JsonLinesSubscriber(stream, lambda: 12.5)
+        subscriber(ChangesetsStripped([Repo.ChangesetInfo('abc', 'x')], True))
+        subscriber(PhaseFinished('push', 2.0, True))
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        lines |should| equal_to([
+                {'event': 'ChangesetsStripped', 'time': 12.5,
+                 'changesets': ['abc'], 'obsolete': True},
+                {'event': 'PhaseFinished', 'time': 12.5,
+                 'phase': 'push', 'duration': 2.0, 'ok': True},
+                ])
+
+
+class TestSyncEvents(object):
+    def setup(self):
+        self.events = []
+        self.bus = EventBus([self.events.append])
+
+    @patch('synchg.sync._SyncRemote')
+    def it_reports_outcome(self, sync):
+        sync.side_effect = AbortException()
+        (lambda: SyncRemote('host', 'proj', '/local', '/root', None, None,
+                            self.bus)) |should| throw(AbortException)
+        self.events[0] |should| equal_to(SyncStarted('host', 'proj'))
+        self.events[-1].outcome |should| equal_to('abort')
+
+    @patch('synchg.sync._SyncRemote')
+    def it_checks_the_policy_before_starting(self, sync):
+        (lambda: SyncRemote(
+            'host', 'proj', '/local', '/root',
+            SyncOptions(policy=['strp=always']), None, self.bus
+            )) |should| throw(SyncError)
+        sync.called |should| equal_to(False)
+        self.events |should| equal_to([])
+
+    def it_reports_applied_patches(self):
+        local = MagicMock(mqCommitCount=0)
+        remote = Mock()
+        _SyncPatches(
+                local, remote, 'fix.patch', None, True, SyncOptions(),
+                self.bus
+                )
+        remote.PushPatch.assert_called_once_with('fix.patch')
+        phases = [e.phase for e in self.events if isinstance(e, PhaseStarted)]
+        phases |should| equal_to(['mq-repo', 'mq-update'])
+        self.events[-1] |should| equal_to(PatchApplied('fix.patch'))
+
+    def it_reports_mq_delta_bytes(self):
+        delta = Mock(changedFiles=['a'])
+        delta.Sync.return_value = 100
+        _SyncPatches(
+                Mock(), Mock(), 'fix.patch', delta, False, SyncOptions(),
+                self.bus
+                )
+        (Notice('Sending 1 changed mq files') in self.events) |should| \
+                equal_to(True)
+        sent = [e for e in self.events if type(e).__name__ == 'BytesSent']
+        [(e.what, e.size) for e in sent] |should| \
+                equal_to([('mq patches', 100)])
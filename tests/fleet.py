@@ -0,0 +1,238 @@
+
+import os
+import shutil
+import tempfile
+import subprocess
+import threading
+from ConfigParser import ConfigParser
+from StringIO import StringIO
+from should_dsl import should
+from plumbum import local
+from plumbum.commands import ProcessExecutionError
+from synchg.sync import SyncOptions
+from synchg.repo import RepoConfig
+from synchg.fleet import FleetHosts, SyncFleet, FleetResult, FormatSummary
+from synchg.fleet import _IsTransient, _Process
+from synchg.policy import Questions
+
+# Keep pep8 happy
+equal_to = throw = be_into = None
+
+
+class FakeProcess(object):
+    ''' A host sync that finishes at a given time with a given result '''
+
+    def __init__(self, clock, duration, result):
+        self._clock = clock
+        self._end = clock() + duration
+        self._result = result
+        self.killed = False
+
+    def Done(self):
+        return self._clock() >= self._end
+
+    def Result(self):
+        return self._result
+
+    def Kill(self):
+        self.killed = True
+
+
+class TestSyncFleet(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, '.hg'))
+        self.localpath = local.path(self.dir)
+        self.now = [0.0]
+        self.results = {}
+        self.started = []
+        self.options = {}
+        self.asked = []
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def Clock(self):
+        return self.now[0]
+
+    def Sleep(self, seconds):
+        self.now[0] += seconds
+
+    def Start(self, host, name, localpath, remote_root, options):
+        self.started.append((self.now[0], host))
+        self.options[host] = options
+        duration, result = self.results[host].pop(0)
+        return FakeProcess(self.Clock, duration, result)
+
+    def Sync(self, hosts, concurrency=2, **options):
+        return SyncFleet(
+                hosts, 'proj', self.localpath, 'src',
+                lambda host: SyncOptions(**options), concurrency,
+                None, self.Start, self.Clock, self.Sleep
+                )
+
+    def it_limits_concurrency(self):
+        for host in 'abc':
+            self.results[host] = [(1.0, ('ok', ''))]
+        results = self.Sync(['a', 'b', 'c'])
+        [r.outcome for r in results] |should| equal_to(['ok'] * 3)
+        [host for at, host in self.started if at == 0] |should| \
+                equal_to(['a', 'b'])
+        (self.started[2][0] >= 1.0) |should| equal_to(True)
+
+    def it_runs_without_prompts(self):
+        self.results['a'] = [(1.0, ('ok', ''))]
+        self.Sync(['a'])
+        self.options['a'].interactive |should| equal_to(False)
+
+    def it_asks_questions_up_front(self):
+        answers = {'clone': True, 'strip': False}
+
+        def Ask(prompt, default):
+            name = [n for n, _, q in Questions if prompt.startswith(q)][0]
+            self.asked.append((name, prompt))
+            return answers.get(name, default == 'y')
+
+        self.results['a'] = [(1.0, ('ok', ''))]
+        self.results['b'] = [(1.0, ('ok', ''))]
+        SyncFleet(
+                ['a', 'b'], 'proj', self.localpath, 'src',
+                lambda host: SyncOptions(
+                    policy=['strip=never'] if host == 'b' else []
+                    ),
+                2, Ask, self.Start, self.Clock, self.Sleep
+                )
+        asked = [name for name, _ in self.asked]
+        asked.count('clone') |should| equal_to(1)
+        # Fleet syncs never delete orphans, so don't ask about it
+        ('delete-orphans' in asked) |should| equal_to(False)
+        ('strip', "Strip remote changesets that aren't in the local "
+                  "repository? (a)") |should| be_into(self.asked)
+        self.options['a'].policy[0] |should| equal_to('clone=always')
+        ('strip=never' in self.options['a'].policy) |should| equal_to(True)
+        ('strip=never' in self.options['b'].policy) |should| equal_to(True)
+
+    def it_retries_transient_failures_with_backoff(self):
+        self.results['a'] = [
+                (1.0, ('transient', 'reset')),
+                (1.0, ('transient', 'reset')),
+                (1.0, ('ok', '')),
+                ]
+        results = self.Sync(['a'], retry_backoff=5.0)
+        results[0].outcome |should| equal_to('ok')
+        results[0].attempts |should| equal_to(3)
+        times = [at for at, _ in self.started]
+        (times[1] - times[0] >= 6.0) |should| equal_to(True)
+        (times[2] - times[1] >= 11.0) |should| equal_to(True)
+
+    def it_gives_up_after_retries(self):
+        self.results['a'] = [(1.0, ('transient', 'reset'))] * 2
+        results = self.Sync(['a'], retries=1, retry_backoff=1.0)
+        results[0] |should| equal_to(FleetResult(
+                'a', 'failed', 2, results[0].duration, 'reset'
+                ))
+
+    def it_does_not_retry_sync_errors(self):
+        self.results['a'] = [(1.0, ('error', 'diverged'))]
+        results = self.Sync(['a'])
+        (results[0].outcome, results[0].attempts) |should| \
+                equal_to(('error', 1))
+
+    def it_kills_hosts_past_their_deadline(self):
+        self.results['a'] = [(100.0, ('ok', ''))]
+        self.results['b'] = [(1.0, ('ok', ''))]
+        results = self.Sync(['a', 'b'], sync_timeout=10)
+        [r.outcome for r in results] |should| equal_to(['timeout', 'ok'])
+        (results[0].duration < 11) |should| equal_to(True)
+
+    def it_adds_remotes_in_one_write(self):
+        self.results['a'] = [(1.0, ('ok', ''))]
+        self.results['b'] = [(1.0, ('ok', ''))]
+        self.Sync(['a', 'b'])
+        RepoConfig(self.localpath).remotes |should| equal_to({
+                'a': 'ssh://a/src/proj', 'b': 'ssh://b/src/proj'
+                })
+
+
+def SleepingWorker(conn, host, name, localpath, remote_root, options):
+    child = subprocess.Popen(['sleep', '60'])
+    with open(os.path.join(localpath, 'child'), 'w') as f:
+        f.write(str(child.pid))
+    try:
+        child.wait()
+    finally:
+        open(os.path.join(localpath, 'cleaned'), 'w').close()
+
+
+def Running(pid):
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class TestKill(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def Wait(self, check):
+        for _ in range(100):
+            if check():
+                return True
+            threading.Event().wait(0.05)
+        return False
+
+    def it_cleans_up_then_kills_the_process_group(self):
+        process = _Process(
+                'host', 'proj', self.dir, 'src', SyncOptions(), SleepingWorker
+                )
+        childPath = os.path.join(self.dir, 'child')
+        self.Wait(lambda: os.path.exists(childPath)) |should| equal_to(True)
+        with open(childPath) as f:
+            child = int(f.read())
+        process.Kill(grace=5)
+        process.Done() |should| equal_to(True)
+        os.path.exists(os.path.join(self.dir, 'cleaned')) |should| \
+                equal_to(True)
+        self.Wait(lambda: not Running(child)) |should| equal_to(True)
+
+
+class TestFleetHelpers(object):
+    def it_reads_fleets_from_config(self):
+        config = ConfigParser()
+        config.readfp(StringIO(
+            '[fleet:ci]\nhosts = ci01 ci02\nconcurrency = 4\n'
+            ))
+        FleetHosts(config, 'ci') |should| equal_to((['ci01', 'ci02'], 4))
+        (lambda: FleetHosts(config, 'prod')) |should| throw(ValueError)
+
+    def it_recognises_ssh_failures(self):
+        _IsTransient(EOFError()) |should| equal_to(True)
+        _IsTransient(ProcessExecutionError(
+            ['ssh', 'ci01', 'hg'], 255, '',
+            'ssh: connect to host ci01 port 22: Connection refused\n'
+            )) |should| equal_to(True)
+        _IsTransient(ProcessExecutionError(
+            ['hg', 'push', 'ci01'], 255, '',
+            'remote: ssh: connect to host ci01 port 22: Connection timed out\n'
+            'abort: no suitable response from remote hg!\n'
+            )) |should| equal_to(True)
+        _IsTransient(ValueError()) |should| equal_to(False)
+
+    def it_does_not_retry_hg_aborts(self):
+        for argv in (['hg', 'push', 'ci01'], ['ssh', 'ci01', 'hg', 'update']):
+            _IsTransient(ProcessExecutionError(
+                argv, 255, '', 'abort: push creates new remote head abc!\n'
+                )) |should| equal_to(False)
+
+    def it_formats_summary(self):
+        lines = FormatSummary([
+                FleetResult('ci01', 'ok', 1, 12.34, ''),
+                FleetResult('ci02', 'timeout', 1, 600.0, 'Gave up after 600s'),
+                ])
+        lines[1].split() |should| equal_to(['ci01', 'ok', '1', '12.3s'])
+        lines[-1] |should| equal_to('1 ok, 1 timeout')
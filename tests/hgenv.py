@@ -0,0 +1,113 @@
+
+import shutil
+import tempfile
+from mock import MagicMock
+from should_dsl import should
+from plumbum.commands import ProcessExecutionError
+from synchg.hgenv import HostEnvironment, ReadConfig
+from synchg.hgenv import _ParseVersion, _EnabledExtensions
+from synchg.state import HostState
+
+# Keep pep8 happy
+equal_to = throw = None
+
+
+class TestHostEnvironment(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.machine = MagicMock()
+        self.machine.which.return_value = '/usr/bin/hg'
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def Env(self, ttl=60):
+        return HostEnvironment(
+                self.machine, HostState('host', self.dir), ttl
+                )
+
+    def it_caches_paths_between_runs(self):
+        self.Env().Resolve('hg') |should| equal_to('/usr/bin/hg')
+        self.Env().Resolve('hg') |should| equal_to('/usr/bin/hg')
+        self.machine.which.assert_called_once_with('hg')
+
+    def it_does_not_cache_without_ttl(self):
+        self.Env(0).Resolve('hg')
+        self.Env(0).Resolve('hg')
+        self.machine.which.call_count |should| equal_to(2)
+
+    def it_runs_commands_from_cached_path(self):
+        self.Env()['hg']['log', '-r', '.']('-q')
+        self.machine.__getitem__.assert_called_with('/usr/bin/hg')
+        command = self.machine.__getitem__.return_value
+        command.__getitem__.assert_called_with(('log', '-r', '.'))
+        command.__getitem__.return_value.assert_called_with('-q')
+
+    def it_revalidates_when_command_not_found(self):
+        env = self.Env()
+        env.Resolve('hg')
+        command = self.machine.__getitem__.return_value
+        command.side_effect = [
+                ProcessExecutionError('', 127, '', ''), 'output'
+                ]
+        self.machine.which.return_value = '/opt/bin/hg'
+        env['hg']('id') |should| equal_to('output')
+        self.machine.__getitem__.assert_called_with('/opt/bin/hg')
+        self.Env().Resolve('hg') |should| equal_to('/opt/bin/hg')
+
+    def it_propagates_other_errors(self):
+        command = self.machine.__getitem__.return_value
+        command.side_effect = ProcessExecutionError('', 255, '', '')
+        (lambda: self.Env()['hg']('id')) |should| throw(ProcessExecutionError)
+        self.machine.which.call_count |should| equal_to(1)
+
+    def it_caches_hg_version(self):
+        command = self.machine.__getitem__.return_value
+        command.return_value = 'Mercurial Distributed SCM (version 4.5.3)\n'
+        self.Env().hgVersion |should| equal_to((4, 5, 3))
+        self.Env().hgVersion |should| equal_to((4, 5, 3))
+        command.assert_called_once_with('version', '-q')
+
+    def it_looks_again_for_extensions_that_arent_cached(self):
+        command = self.machine.__getitem__.return_value
+        command.return_value = 'extensions.rebase=\n'
+        self.Env().HasExtension('mq') |should| equal_to(False)
+        command.return_value = 'extensions.rebase=\nextensions.mq=\n'
+        self.Env().HasExtension('mq') |should| equal_to(True)
+        self.Env().hgExtensions |should| equal_to(['mq', 'rebase'])
+
+    def it_finds_extensions_enabled_by_the_repository(self):
+        command = self.machine.__getitem__.return_value
+        command.return_value = 'extensions.rebase=\n'
+        hg = MagicMock(return_value='extensions.mq=\n')
+        self.Env().HasExtension('mq', hg) |should| equal_to(True)
+        hg.assert_called_once_with('config', 'extensions')
+
+
+class TestParseEnvironment(object):
+    def it_parses_versions(self):
+        _ParseVersion('Mercurial Distributed SCM (version 4.3+12-abc)') \
+                |should| equal_to((4, 3))
+        _ParseVersion('nonsense') |should| equal_to(())
+
+    def it_reads_config_sections(self):
+        hg = MagicMock(
+                return_value='ui.username=A User <a@b.c>\nui.ssh=ssh -C\n'
+                )
+        ReadConfig(hg, 'ui') |should| equal_to({
+            'ui.username': 'A User <a@b.c>', 'ui.ssh': 'ssh -C'
+            })
+        hg.assert_called_with('config', 'ui')
+
+    def it_reads_empty_config_sections(self):
+        hg = MagicMock(side_effect=ProcessExecutionError('', 1, '', ''))
+        ReadConfig(hg, 'ui') |should| equal_to({})
+
+    def it_finds_enabled_extensions(self):
+        config = {
+                'extensions.mq': '',
+                'extensions.hgext.rebase': '',
+                'extensions.color': '!',
+                'extensions.local': '/path/to/ext.py'
+                }
+        _EnabledExtensions(config) |should| equal_to(['local', 'mq', 'rebase'])
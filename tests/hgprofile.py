@@ -0,0 +1,34 @@
+
+from mock import MagicMock
+from should_dsl import should
+from synchg.hgprofile import LeanProfile
+
+# Keep pep8 happy
+equal_to = None
+
+
+class TestLeanProfile(object):
+    def it_enables_required_extensions(self):
+        LeanProfile().configArgs |should| equal_to((
+            '--config', 'extensions.mq=', '--config', 'extensions.strip='
+            ))
+
+    def it_carries_user_settings(self):
+        profile = LeanProfile({
+            'ui.username': 'A User', 'ui.editor': 'vim', 'ui.ssh': ''
+            })
+        profile.settings |should| equal_to([('ui.username', 'A User')])
+        profile.configArgs[-2:] |should| equal_to(
+                ('--config', 'ui.username=A User')
+                )
+
+    def it_runs_commands_in_plain_environment(self):
+        machine = MagicMock()
+        hg = MagicMock()
+        command = LeanProfile().Wrap(machine, hg)
+        command['log']('-q')
+        machine.env.assert_called_once_with(HGPLAIN='1', HGRCPATH='')
+        hg.__getitem__.assert_called_once_with(LeanProfile().configArgs)
+        bound = hg.__getitem__.return_value.__getitem__
+        bound.assert_called_once_with('log')
+        bound.return_value.assert_called_once_with('-q')
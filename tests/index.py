@@ -0,0 +1,68 @@
+
+import shutil
+import tempfile
+from mock import Mock
+from should_dsl import should
+from plumbum import local
+from synchg.repo import Repo
+from synchg.index import RemoteIndex
+
+# Keep pep8 happy
+equal_to = be = None
+
+
+def Node(hash, p1='0', branch='default'):
+    return Repo.ChangesetNodeInfo(hash, p1, '0', branch, 'desc ' + hash)
+
+
+class TestRemoteIndex(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = RemoteIndex(local.path(self.dir), 'host')
+
+    def teardown(self):
+        self.index.Close()
+        shutil.rmtree(self.dir)
+
+    def it_is_not_current_when_empty(self):
+        self.index.IsCurrent(['a']) |should| be(False)
+
+    def it_is_current_when_heads_match(self):
+        self.index.Rebuild(['b'], [Node('a'), Node('b', 'a')])
+        self.index.IsCurrent(['b']) |should| be(True)
+        self.index.IsCurrent(['c']) |should| be(False)
+
+    def it_keeps_remotes_separate(self):
+        self.index.Rebuild(['a'], [Node('a')])
+        other = RemoteIndex(local.path(self.dir), 'other')
+        other.IsCurrent(['a']) |should| be(False)
+        other.Close()
+
+    def it_updates_changesets(self):
+        self.index.Rebuild(['b'], [Node('a'), Node('b', 'a')])
+        self.index.Update(['c'], [Node('c', 'a')], ['b'])
+        self.index.heads |should| equal_to(set(['c']))
+        sorted(self.index.Changesets()) |should| equal_to(['a', 'c'])
+
+    def it_finds_changes_locally(self):
+        # Remote has a <- b <- c, locally c has been rebased to d
+        self.index.Rebuild(
+                ['c'], [Node('a'), Node('b', 'a'), Node('c', 'b')]
+                )
+        localRepo = Mock(spec_set=Repo)
+        localNodes = {'a': Node('a'), 'b': Node('b', 'a'), 'd': Node('d', 'b')}
+
+        def Log(revset):
+            if revset.startswith('::'):
+                return [localNodes[n] for n in sorted(localNodes)]
+            return [
+                    localNodes[n] for n in sorted(localNodes)
+                    if 'id({0})'.format(n) in revset
+                    ]
+        localRepo.Log.side_effect = Log
+
+        outgoings, incomings = self.index.FindChanges(
+                localRepo, ['d'], ['default']
+                )
+        outgoings |should| equal_to([localNodes['d']])
+        incomings |should| equal_to([Repo.ChangesetInfo('c', 'desc c')])
@@ -0,0 +1,148 @@
+
+import os
+import shutil
+import tempfile
+from mock import MagicMock, patch
+from should_dsl import should
+from plumbum import local
+from synchg.repo import Repo
+from synchg.hgprofile import LeanProfile
+from synchg.inprocess import InProcessRepo, _PatchDir, _ReadQueue
+
+# Keep pep8 happy
+equal_to = None
+
+
+class TestInProcessMq(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.hgDir = os.path.join(self.dir, '.hg')
+        os.makedirs(os.path.join(self.hgDir, 'patches'))
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def Write(self, path, contents):
+        with open(os.path.join(self.hgDir, path), 'w') as f:
+            f.write(contents)
+
+    def it_uses_default_queue(self):
+        _PatchDir(self.hgDir) |should| equal_to(
+                os.path.join(self.hgDir, 'patches')
+                )
+
+    def it_uses_active_queue(self):
+        self.Write('patches.queue', 'other\n')
+        _PatchDir(self.hgDir) |should| equal_to(
+                os.path.join(self.hgDir, 'patches-other')
+                )
+
+    def it_reads_queue(self):
+        self.Write('patches/series', 'one\ntwo\nthree\n')
+        self.Write('patches/status', 'abc:one\ndef:two\n')
+        _ReadQueue(os.path.join(self.hgDir, 'patches')) |should| equal_to(
+                (['one', 'two', 'three'], [('abc', 'one'), ('def', 'two')])
+                )
+
+    def it_finds_last_applied_patch(self):
+        machine = MagicMock()
+        machine.cwd = local.path(self.dir)
+        repo = InProcessRepo(machine)
+        repo.lastAppliedPatch |should| equal_to(None)
+        self.Write('patches/status', 'abc:one\ndef:two\n')
+        repo.lastAppliedPatch |should| equal_to('two')
+        assert not machine.__getitem__.return_value.called
+
+
+class TestInProcessWorkingChanges(object):
+    def Changes(self, listUnknown=False, **files):
+        # The order of the lists returned by mercurial's repo.status
+        kinds = ['modified', 'added', 'removed', 'deleted', 'unknown']
+        status = [files.get(kind, []) for kind in kinds] + [[], []]
+        repo = InProcessRepo(MagicMock())
+        repo._Open = MagicMock()
+        repo._Open.return_value.status.return_value = status
+        return repo.WorkingChanges(listUnknown)
+
+    def it_finds_modified_files(self):
+        self.Changes(modified=['a']) |should| equal_to(['a'])
+
+    def it_finds_added_files(self):
+        self.Changes(added=['a']) |should| equal_to(['a'])
+
+    def it_finds_removed_files(self):
+        self.Changes(removed=['a']) |should| equal_to(['a'])
+
+    def it_finds_deleted_files(self):
+        self.Changes(deleted=['a']) |should| equal_to(['a'])
+
+    def it_only_finds_unknown_files_when_asked(self):
+        self.Changes(unknown=['a']) |should| equal_to([])
+        self.Changes(True, unknown=['a']) |should| equal_to(['a'])
+
+
+class TestInProcessOutgoings(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.hgDir = os.path.join(self.dir, '.hg')
+        os.makedirs(os.path.join(self.hgDir, 'patches'))
+        with open(os.path.join(self.hgDir, 'patches', 'status'), 'w') as f:
+            f.write('patchnode:fix.diff\n')
+        self.repo = MagicMock()
+        self.repo.path = self.hgDir
+        self.repo.__getitem__.side_effect = self.Changeset
+        branchmap = self.repo.branchmap.return_value
+        branchmap.__contains__.return_value = True
+        branchmap.branchheads.return_value = ['patchnode']
+        self.ui = MagicMock()
+        self.mocks = dict(
+                (name, MagicMock())
+                for name in ('hglib', 'discovery', 'scmutil', 'uilib')
+                )
+        self.patches = patch.multiple(
+                'synchg.inprocess', create=True,
+                hexnode=lambda node: node, **self.mocks
+                )
+        self.patches.start()
+        self.mocks['hglib'].repository.return_value = self.repo
+        self.mocks['uilib'].ui.load.return_value = self.ui
+        self.mocks['uilib'].ui.return_value = self.ui
+        self.mocks['scmutil'].revrange.return_value = ['qparent']
+        outgoing = self.mocks['discovery'].findcommonoutgoing.return_value
+        outgoing.missing = ['qparent', 'patchnode']
+
+    def teardown(self):
+        self.patches.stop()
+        shutil.rmtree(self.dir)
+
+    def Changeset(self, node):
+        ctx = MagicMock()
+        ctx.node.return_value = node
+        ctx.description.return_value = node + ' desc\nmore'
+        return ctx
+
+    def Repo(self, profile=None):
+        machine = MagicMock()
+        machine.cwd = local.path(self.dir)
+        repo = InProcessRepo(machine, 'host', profile=profile)
+        repo.UseSsh('ssh -C')
+        return repo
+
+    def it_finds_outgoings_without_applied_patches(self):
+        self.Repo().FindOutgoings(['.'], ['default']) |should| equal_to(
+                [Repo.ChangesetInfo('qparent', 'qparent desc')]
+                )
+        onlyheads = self.mocks['discovery'].findcommonoutgoing.call_args[1]
+        sorted(onlyheads['onlyheads']) |should| \
+                equal_to(['patchnode', 'qparent'])
+
+    def it_connects_with_the_configured_ssh(self):
+        self.Repo().FindOutgoings(['.'], ['default'])
+        self.ui.setconfig.assert_any_call('ui', 'ssh', 'ssh -C', 'synchg')
+        assert self.mocks['hglib'].peer.call_args[0][0] is self.repo
+
+    def it_uses_the_lean_profile(self):
+        profile = LeanProfile({'ui.username': 'me'})
+        self.Repo(profile).FindOutgoings(['.'], ['default'])
+        assert not self.mocks['uilib'].ui.load.called
+        self.ui.setconfig.assert_any_call('ui', 'username', 'me', 'synchg')
@@ -0,0 +1,127 @@
+
+import os
+import shutil
+import tempfile
+from mock import Mock, patch
+from should_dsl import should
+from plumbum import local
+from plumbum.commands import ProcessExecutionError
+from synchg.lease import Lease, LeaseBusy, SyncQueue, AcquireLease
+from synchg.sync import _IsLockError
+
+# Keep pep8 happy
+equal_to = throw = None
+
+
+class TestLease(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'leases', 'repo')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def it_is_held_by_one_sync(self):
+        first = Lease(local, self.path, 60)
+        second = Lease(local, self.path, 60)
+        first.TryAcquire() |should| equal_to(True)
+        second.TryAcquire() |should| equal_to(False)
+        second.holder.endswith('(pid {0})'.format(os.getpid())) |should| \
+                equal_to(True)
+
+    def it_can_be_acquired_after_release(self):
+        first = Lease(local, self.path, 60)
+        second = Lease(local, self.path, 60)
+        first.TryAcquire()
+        second.Release()
+        second.TryAcquire() |should| equal_to(False)
+        first.Release()
+        second.TryAcquire() |should| equal_to(True)
+
+    def it_breaks_stale_leases(self):
+        Lease(local, self.path, 60).TryAcquire()
+        Lease(local, self.path, -1).TryAcquire() |should| equal_to(True)
+
+    def Seen(self):
+        with open(os.path.join(self.path, 'time')) as f:
+            time = f.read().strip()
+        with open(os.path.join(self.path, 'owner')) as f:
+            return time + '\n' + f.read().strip()
+
+    def it_only_breaks_the_lease_that_was_seen(self):
+        stale = Lease(local, self.path, 60)
+        stale.TryAcquire()
+        seen = self.Seen()
+        # Another waiter breaks the stale lease & takes a new one first
+        stale.Release()
+        fresh = Lease(local, self.path, 60)
+        fresh.TryAcquire()
+        Lease(local, self.path, -1)._Break(seen)
+        os.path.exists(self.path) |should| equal_to(True)
+        Lease(local, self.path, 60).TryAcquire() |should| equal_to(False)
+        Lease(local, self.path, -1)._Break(self.Seen())
+        os.path.exists(self.path) |should| equal_to(False)
+
+
+class TestSyncQueue(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.queue = os.path.join(self.dir, 'queue')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    @patch('time.time')
+    def it_is_superseded_by_newer_syncs(self, time):
+        older, newer = SyncQueue(self.queue), SyncQueue(self.queue)
+        time.return_value = 100.0
+        older.Join()
+        time.return_value = 101.0
+        newer.Join()
+        older.Superseded() |should| equal_to(True)
+        newer.Superseded() |should| equal_to(False)
+        newer.Leave()
+        older.Superseded() |should| equal_to(False)
+
+    @patch('synchg.lease._Alive')
+    def it_removes_tickets_of_dead_syncs(self, alive):
+        alive.return_value = False
+        queue = SyncQueue(self.queue)
+        queue.Join()
+        open(os.path.join(self.queue, '9999999999.000000-1'), 'w').close()
+        queue.Superseded() |should| equal_to(False)
+        len(os.listdir(self.queue)) |should| equal_to(1)
+
+
+class TestAcquireLease(object):
+    def setup(self):
+        self.lease = Mock(holder='me@box (pid 1)')
+        self.queue = Mock()
+        self.queue.Superseded.return_value = False
+        self.sleep = Mock()
+
+    def it_gives_way_to_newer_syncs(self):
+        self.queue.Superseded.return_value = True
+        AcquireLease(self.lease, self.queue, 60) |should| equal_to(False)
+        self.lease.TryAcquire.called |should| equal_to(False)
+
+    def it_waits_for_lease(self):
+        self.lease.TryAcquire.side_effect = [False, False, True]
+        onWait = Mock()
+        AcquireLease(
+                self.lease, self.queue, 60, onWait, sleep=self.sleep
+                ) |should| equal_to(True)
+        onWait.assert_called_once_with('me@box (pid 1)')
+        self.sleep.call_count |should| equal_to(2)
+
+    def it_reports_busy_lease_without_waiting(self):
+        self.lease.TryAcquire.return_value = False
+        (lambda: AcquireLease(self.lease, self.queue, 0)) |should| \
+                throw(LeaseBusy)
+
+    def it_recognises_hg_lock_errors(self):
+        _IsLockError(ProcessExecutionError(
+                ['hg', 'strip'], 255, '',
+                "waiting for lock on repository /src/repo held by 'box:12'\n"
+                "abort: timeout while waiting for lock held by 'box:12'"
+                )) |should| equal_to(True)
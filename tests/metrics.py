@@ -0,0 +1,152 @@
+
+import os
+import shutil
+import urllib2
+import tempfile
+import threading
+from StringIO import StringIO
+from mock import MagicMock, patch
+from should_dsl import should
+from synchg.events import PhaseFinished, SyncFinished, CommandRun, BytesSent
+from synchg.metrics import MetricsStore, MetricsSink, MetricsServer
+from synchg.instrument import InstrumentedCommand
+from plumbum.commands import ProcessExecutionError
+
+# Keep pep8 happy
+equal_to = throw = None
+
+
+def Command(argv, remote):
+    return CommandRun(argv, 'local', '/repo', 0.1, 0, 10, remote)
+
+
+class TestMetrics(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'synchg.prom')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def Sync(self, outcome='ok'):
+        sink = MetricsSink(self.path, 'host', 'proj')
+        sink(PhaseFinished('push', 0.3, True))
+        sink(Command(['hg', 'push', 'host'], True))
+        sink(Command(['hg', 'summary'], False))
+        sink(Command(['tar', 'xzf', '-'], True))
+        sink(BytesSent('mq patches', 100))
+        sink(SyncFinished('host', 'proj', 2.0, outcome))
+
+    def Lines(self):
+        with open(self.path) as f:
+            return f.read().splitlines()
+
+    def it_writes_textfile_when_sync_finishes(self):
+        self.Sync()
+        lines = self.Lines()
+        for line in [
+                'synchg_syncs_total{host="host",outcome="ok",repo="proj"} 1',
+                'synchg_hg_commands_total{host="host",repo="proj"} 2',
+                'synchg_round_trips_total{host="host",repo="proj"} 2',
+                'synchg_bytes_sent_total{host="host",repo="proj"} 100',
+                'synchg_phase_duration_seconds_bucket'
+                '{host="host",le="0.5",phase="push",repo="proj"} 1',
+                'synchg_phase_duration_seconds_bucket'
+                '{host="host",le="0.25",phase="push",repo="proj"} 0',
+                'synchg_sync_duration_seconds_count'
+                '{host="host",repo="proj"} 1',
+                ]:
+            (line in lines) |should| equal_to(True)
+        ('# TYPE synchg_syncs_total counter' in lines) |should| \
+                equal_to(True)
+
+    def it_writes_textfiles_other_users_can_read(self):
+        umask = os.umask(022)
+        try:
+            self.Sync()
+        finally:
+            os.umask(umask)
+        (os.stat(self.path).st_mode & 0777) |should| equal_to(0644)
+
+    def it_keeps_the_permissions_of_textfiles(self):
+        self.Sync()
+        os.chmod(self.path, 0640)
+        self.Sync()
+        (os.stat(self.path).st_mode & 0777) |should| equal_to(0640)
+
+    def it_accumulates_between_syncs(self):
+        self.Sync()
+        self.Sync('abort')
+        lines = self.Lines()
+        ('synchg_hg_commands_total{host="host",repo="proj"} 4' in lines) \
+                |should| equal_to(True)
+        ('synchg_syncs_total{host="host",outcome="abort",repo="proj"} 1'
+         in lines) |should| equal_to(True)
+
+    def it_keeps_every_sync_when_flushed_at_once(self):
+        threads = [threading.Thread(target=self.Sync) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ('synchg_syncs_total{host="host",outcome="ok",repo="proj"} 8'
+         in self.Lines()) |should| equal_to(True)
+        sorted(os.listdir(self.dir)) |should| equal_to([
+                'synchg.prom', 'synchg.prom.json', 'synchg.prom.lock'
+                ])
+
+    def it_reports_rather_than_raises_write_errors(self):
+        # A file where the directory should be can't be written under
+        open(os.path.join(self.dir, 'file'), 'w').close()
+        self.path = os.path.join(self.dir, 'file', 'synchg.prom')
+        with patch('sys.stderr', StringIO()) as stderr:
+            self.Sync()
+        ('Could not write metrics' in stderr.getvalue()) |should| \
+                equal_to(True)
+
+    def it_serves_metrics_over_http(self):
+        self.Sync()
+        server = MetricsServer(self.path, 0, 'localhost')
+        server.Start()
+        try:
+            url = 'http://localhost:{0}/metrics'.format(server.port)
+            body = urllib2.urlopen(url).read()
+        finally:
+            server.Close()
+        store = MetricsStore(self.path)
+        store.Load()
+        body |should| equal_to(store.Render())
+
+
+class TestInstrumentedCommand(object):
+    def setup(self):
+        self.command = MagicMock()
+        self.reports = []
+        self.wrapped = InstrumentedCommand(
+                self.command, ['hg'],
+                lambda *args: self.reports.append(args)
+                )
+
+    def it_reports_bound_arguments(self):
+        self.command.__getitem__.return_value.return_value = 'output'
+        self.wrapped['status', '-m']() |should| equal_to('output')
+        argv, duration, retcode, size = self.reports[0]
+        argv |should| equal_to(['hg', 'status', '-m'])
+        (retcode, size) |should| equal_to((0, 6))
+
+    def it_reports_failures(self):
+        self.command.side_effect = ProcessExecutionError(
+                ['hg'], 255, 'out', 'err'
+                )
+        (lambda: self.wrapped('push')) |should| throw(ProcessExecutionError)
+        self.reports[0][0] |should| equal_to(['hg', 'push'])
+        self.reports[0][2] |should| equal_to(255)
+
+    def it_reports_popen_when_waited_for(self):
+        self.command.popen.return_value.returncode = 1
+        proc = self.wrapped.popen(['pull'])
+        self.reports |should| equal_to([])
+        proc.wait()
+        proc.wait()
+        len(self.reports) |should| equal_to(1)
+        self.reports[0][2] |should| equal_to(1)
@@ -0,0 +1,114 @@
+
+import os
+import shutil
+import tempfile
+from mock import Mock, MagicMock, patch
+from plumbum import local as localMachine
+from should_dsl import should
+from synchg.mqdelta import MqDelta, PatchState, LocalPatchState
+
+# Keep pep8 happy
+equal_to = None
+
+
+def MakeDelta(local, remote):
+    delta = MqDelta.__new__(MqDelta)
+    delta.local = Mock(compressionLevel=6)
+    delta.remote = MagicMock()
+    delta.remote.path = localMachine.path('/remote')
+    delta._patchDir = '/patches'
+    delta.localState = local
+    delta.remoteState = remote
+    return delta
+
+
+class TestLocalPatchState(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        files = {
+                'series': 'one\n# comment\ntwo #guard\n',
+                'status': 'abc:one\n',
+                'one': 'patch one',
+                'two': 'patch two'
+                }
+        for name, contents in files.iteritems():
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(contents)
+        os.makedirs(os.path.join(self.dir, '.hg'))
+        with open(os.path.join(self.dir, '.hg', 'dirstate'), 'w') as f:
+            f.write('ignored')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def it_hashes_patch_files(self):
+        state = LocalPatchState(self.dir)
+        sorted(state.hashes) |should| equal_to(['one', 'series', 'two'])
+
+    def it_reads_series_and_status(self):
+        state = LocalPatchState(self.dir)
+        state.series |should| equal_to(['one', 'two'])
+        state.applied |should| equal_to(['one'])
+
+
+class TestMqDelta(object):
+    def setup(self):
+        self.series = ['a', 'b', 'c']
+        hashes = {'series': 's', 'a': '1', 'b': '2', 'c': '3'}
+        self.local = PatchState(hashes, self.series, [])
+        self.remoteHashes = dict(hashes)
+
+    def Delta(self, applied):
+        return MakeDelta(
+                self.local,
+                PatchState(self.remoteHashes, self.series, applied)
+                )
+
+    def it_finds_changed_files(self):
+        self.remoteHashes['b'] = 'x'
+        del self.remoteHashes['c']
+        self.Delta([]).changedFiles |should| equal_to(['b', 'c'])
+
+    def it_keeps_unchanged_prefix(self):
+        self.remoteHashes['b'] = 'x'
+        self.Delta(['a', 'b']).UnchangedPrefix('c') |should| equal_to(1)
+
+    def it_finds_removed_files(self):
+        self.remoteHashes['old'] = 'x'
+        self.Delta([]).removedFiles |should| equal_to(['old'])
+
+    def it_keeps_nothing_if_guards_changed(self):
+        self.remoteHashes['guards'] = 'x'
+        self.Delta(['a', 'b']).UnchangedPrefix('c') |should| equal_to(0)
+
+    def it_keeps_only_patches_below_target(self):
+        self.Delta(['a', 'b', 'c']).UnchangedPrefix('a') |should| equal_to(1)
+
+    @patch('synchg.mqdelta.SendData')
+    @patch('synchg.mqdelta.BuildArchive')
+    def it_pops_changed_and_pushes_target(self, archive, send):
+        self.remoteHashes['b'] = 'x'
+        delta = self.Delta(['a', 'b'])
+        delta.Sync('c')
+        delta.remote.PopPatch.assert_called_once_with('a')
+        archive.assert_called_once_with('/patches', ['b'], level=6)
+        tar = delta.remote.Command.return_value
+        tar.__getitem__.assert_called_once_with(
+                ('xzf', '-', '-C', '/remote/.hg/patches')
+                )
+        delta.remote.PushPatch.assert_called_once_with('c')
+
+    @patch('synchg.mqdelta.SendData')
+    def it_does_nothing_if_in_sync(self, send):
+        delta = self.Delta(['a', 'b'])
+        delta.Sync('b')
+        delta.remote.PopPatch.called |should| equal_to(False)
+        delta.remote.PushPatch.called |should| equal_to(False)
+        send.called |should| equal_to(False)
+
+    @patch('synchg.mqdelta.SendData')
+    def it_pushes_everything_when_remote_clean(self, send):
+        delta = self.Delta(['a', 'b'])
+        delta.Sync('b', remoteClean=True)
+        delta.remote.PopPatch.called |should| equal_to(False)
+        delta.remote.PushPatch.assert_called_once_with('b')
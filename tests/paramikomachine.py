@@ -0,0 +1,89 @@
+
+import time
+import socket
+import threading
+from nose import SkipTest
+from should_dsl import should
+from plumbum.commands import ProcessExecutionError
+from synchg.transfer import SendData
+
+try:
+    import paramiko
+    from synchg.paramikomachine import ParamikoMachine
+    from sshstandin import StandInSshd
+except ImportError:
+    paramiko = None
+
+# Keep pep8 happy
+equal_to = throw = None
+
+
+class TestParamikoMachine(object):
+    def setup(self):
+        if not paramiko:
+            raise SkipTest('paramiko is not installed')
+        self.sshd = StandInSshd()
+        self.machine = ParamikoMachine(
+                '127.0.0.1', port=self.sshd.port, password='password',
+                missing_host_policy=paramiko.AutoAddPolicy()
+                )
+
+    def teardown(self):
+        if paramiko:
+            self.machine.close()
+            self.sshd.close()
+
+    def it_runs_commands(self):
+        self.machine['echo']('hello') |should| equal_to('hello\n')
+
+    def it_runs_commands_in_working_directory(self):
+        with self.machine.cwd('/tmp'):
+            self.machine['pwd']().strip() |should| equal_to('/tmp')
+
+    def it_reports_return_codes(self):
+        command = self.machine['sh']['-c', 'exit 3']
+        (lambda: command()) |should| throw(ProcessExecutionError)
+
+    def it_sends_stdin(self):
+        (self.machine['cat'] << 'some data')() |should| equal_to('some data')
+        data = 'x' * (256 * 1024)
+        SendData(self.machine['wc']['-c'], data).strip() \
+                |should| equal_to(str(len(data)))
+
+    def it_runs_commands_in_parallel(self):
+        sleep = self.machine['sleep']
+        threads = [
+                threading.Thread(target=sleep, args=('0.5',))
+                for _ in range(4)
+                ]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert time.time() - start < 1.5
+
+    def it_forwards_ports(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+
+        def Echo():
+            conn, _ = server.accept()
+            conn.sendall(conn.recv(1024))
+            conn.close()
+        threading.Thread(target=Echo).start()
+
+        with self.machine.tunnel(0, server.getsockname()[1]) as tunnel:
+            sock = socket.create_connection((tunnel.host, tunnel.port))
+            sock.sendall('ping')
+            sock.recv(1024) |should| equal_to('ping')
+            sock.close()
+        server.close()
+
+    def it_builds_hg_ssh_command(self):
+        with self.machine.SshTunnel() as tunnel:
+            self.machine.HgSshCommand(tunnel) |should| equal_to(
+                    'ssh -o HostName=127.0.0.1 -o Port={0} '
+                    '-o HostKeyAlias=127.0.0.1'.format(tunnel.port)
+                    )
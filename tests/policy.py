@@ -0,0 +1,72 @@
+
+from mock import Mock, patch
+from should_dsl import should
+from synchg.policy import Policy, PolicyError, AskUpFront
+
+# Keep pep8 happy
+equal_to = throw = None
+
+
+class TestPolicy(object):
+    def it_asks_by_default(self):
+        ask = Mock(return_value=True)
+        Policy(ask=ask).Decide('strip', 'Continue?') |should| equal_to(True)
+        ask.assert_called_once_with('Continue?', default='y')
+
+    def it_answers_no_when_no_is_the_default(self):
+        ask = Mock(return_value=False)
+        policy = Policy(ask=ask)
+        policy.Decide('delete-orphans', 'Delete?', 'n') |should| \
+                equal_to(False)
+        ask.assert_called_once_with('Delete?', default='n')
+
+    def it_follows_rules(self):
+        policy = Policy(['strip=always', 'clone=never', 'strip=never'])
+        policy.Decide('strip', 'Continue?') |should| equal_to(False)
+        policy.Decide('clone', 'Clone?') |should| equal_to(False)
+        policy.Rules() |should| equal_to(['clone=never', 'strip=never'])
+
+    def it_picks_safe_answers_for_auto(self):
+        policy = Policy(['clone=auto', 'strip=auto'])
+        policy.Decide('clone', 'Clone?') |should| equal_to(True)
+        policy.Decide('strip', 'Continue?') |should| equal_to(False)
+
+    def it_refuses_to_ask_when_not_interactive(self):
+        policy = Policy(interactive=False)
+        (lambda: policy.Decide('clone', 'Clone?')) |should| \
+                throw(PolicyError)
+
+    def it_rejects_invalid_rules(self):
+        (lambda: Policy(['clone=maybe'])) |should| throw(PolicyError)
+        (lambda: Policy(['frobnicate=always'])) |should| throw(PolicyError)
+
+
+class TestAskUpFront(object):
+    def it_asks_each_question_once(self):
+        policies = {
+                'a': Policy(['clone=auto', 'refresh=never']),
+                'b': Policy(['refresh=never']),
+                'c': Policy(interactive=False),
+                }
+        ask = Mock(side_effect=lambda prompt, default: default == 'y')
+        AskUpFront(policies, ask)
+        prompts = [call[0][0] for call in ask.call_args_list]
+        len(prompts) |should| equal_to(4)
+        prompts[0].endswith('(b)') |should| equal_to(True)
+        prompts[1].endswith('(a, b)') |should| equal_to(True)
+        # Choosing the default of no strips nothing
+        policies['a'].Rule('strip') |should| equal_to('never')
+        policies['b'].Rule('clone') |should| equal_to('always')
+        policies['c'].Rules() |should| equal_to([])
+
+    def it_takes_the_answers_given_to_yn(self):
+        # yn returns whether the answer was yes, so no must never become
+        # an always rule
+        policies = {'a': Policy(['clone=never', 'refresh=never',
+                                 'ignore-changes=never', 'strip=never'])}
+        for answer, rule in (('n', 'never'), ('y', 'always'),
+                             ('', 'never')):
+            policies['a'].Set('delete-orphans', 'ask')
+            with patch('__builtin__.raw_input', Mock(return_value=answer)):
+                AskUpFront(policies)
+            policies['a'].Rule('delete-orphans') |should| equal_to(rule)
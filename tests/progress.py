@@ -0,0 +1,107 @@
+
+from StringIO import StringIO
+from mock import Mock
+from plumbum import local
+from plumbum.commands import ProcessExecutionError
+from should_dsl import should
+from synchg.progress import Progress, ProgressTracker, ProgressParser
+from synchg.progress import ConsoleProgress, RunWithProgress
+from synchg.transfer import SendData
+
+# Keep pep8 happy
+equal_to = throw = None
+
+
+class TestProgressTracker(object):
+    def setup(self):
+        self.now = 100.0
+        self.callback = Mock()
+        self.tracker = ProgressTracker(self.callback, lambda: self.now)
+
+    def it_calculates_rate_and_eta(self):
+        self.tracker.Update('bundling', 0, 10, 'changesets')
+        self.now += 2
+        self.tracker.Update('bundling', 4, 10, 'changesets')
+        self.callback.call_args[0][0] |should| equal_to(
+                Progress('bundling', 4, 10, 'changesets', 2.0, 3.0, False)
+                )
+
+    def it_finishes_each_unit_in_order(self):
+        self.tracker.Update('bundling', 1, 1, 'changesets')
+        self.tracker.Update('bundling', 3, 5, 'files')
+        self.callback.reset_mock()
+        self.tracker.Finish()
+        done = [args[0][0] for args in self.callback.call_args_list]
+        [(p.unit, p.done) for p in done] |should| equal_to([
+                ('changesets', True), ('files', True)
+                ])
+
+
+class TestProgressParser(object):
+    def setup(self):
+        self.tracker = Mock()
+        self.parser = ProgressParser(self.tracker)
+
+    def it_parses_progress_lines(self):
+        self.parser.Feed('\rbundling  3/10 changesets\rbund')
+        self.parser.Feed('ling 1 files\r   \r')
+        self.tracker.Update.call_args_list |should| equal_to([
+                (('bundling', 3, 10, 'changesets'),),
+                (('bundling', 1, None, 'files'),)
+                ])
+
+    def it_keeps_other_output(self):
+        self.parser.Feed('abort: push creates new remote head\n')
+        self.parser.Close()
+        self.parser.other |should| equal_to([
+                'abort: push creates new remote head'
+                ])
+
+
+class TestRunWithProgress(object):
+    def Hg(self, script):
+        # Stands in for hg, ignoring the progress config arguments
+        return local['sh']['-c', script, 'hg']
+
+    def it_reports_progress_and_returns_output(self):
+        callback = Mock()
+        hg = self.Hg(
+                "printf 'bundling 1/2 changesets\\rbundling 2/2 changesets"
+                "\\r' >&2; echo pushed"
+                )
+        RunWithProgress(local, hg, (), callback) |should| \
+                equal_to('pushed\n')
+        last = callback.call_args[0][0]
+        (last.pos, last.total, last.done) |should| equal_to((2, 2, True))
+
+    def it_raises_on_failure(self):
+        hg = self.Hg("echo 'abort: nope' >&2; exit 255")
+        (lambda: RunWithProgress(local, hg, (), Mock())) |should| \
+                throw(ProcessExecutionError)
+
+    def it_reports_data_sent(self):
+        callback = Mock()
+        SendData(local['cat'], 'x' * 100, progress=callback)
+        last = callback.call_args[0][0]
+        (last.topic, last.pos, last.unit, last.done) |should| \
+                equal_to(('sending', 100, 'bytes', True))
+
+
+class TestConsoleProgress(object):
+    def it_formats_counts(self):
+        progress = Progress('bundling', 3, 10, 'changesets', 1.5, 65, False)
+        ConsoleProgress().Format(progress) |should| equal_to(
+                '  bundling 3/10 changesets (1.5 changesets/s) ETA 1:05'
+                )
+
+    def it_formats_bytes(self):
+        progress = Progress('sending', 2048, 4096, 'bytes', 1024.0, 2, False)
+        ConsoleProgress().Format(progress) |should| equal_to(
+                '  sending 2.0KB/4.0KB (1.0KB/s) ETA 0:02'
+                )
+
+    def it_ends_line_when_done(self):
+        stream = StringIO()
+        progress = Progress('sending', 10, 10, 'bytes', None, 0, True)
+        ConsoleProgress(stream)(progress)
+        stream.getvalue() |should| equal_to('\r  sending 10B/10B\n')
@@ -1,9 +1,16 @@
+import os
+import shutil
+import tempfile
+import threading
+from nose import SkipTest
 from mock import Mock, MagicMock, create_autospec, sentinel, call, patch
 from mock import DEFAULT, ANY
 from should_dsl import should, should_not
+from plumbum import local
 from plumbum.local_machine import LocalMachine, Workdir
-from plumbum.commands import ProcessExecutionError
+from plumbum.commands import ProcessExecutionError, CommandNotFound
 from synchg.repo import Repo, RepoConfig
+from synchg.cleanup import BackupRetention, CollectGarbage
 
 # Keep pep8 happy
 equal_to = be = be_called = throw = None
@@ -27,6 +34,15 @@ def CreateRepo(remote=None, clean_mq=False):
     return repo
 
 
+class TestRepoUseSsh:
+    def it_passes_ssh_command_to_hg(self):
+        repo = CreateRepo()
+        hg = repo.hg
+        repo.UseSsh('ssh -p 2222')
+        hg.__getitem__.assert_called_with(('--config', 'ui.ssh=ssh -p 2222'))
+        assert repo.hg is hg.__getitem__.return_value
+
+
 class TestRepoCleanMq:
     @patch.multiple(
             Repo, lastAppliedPatch=sentinel.patch,
@@ -39,6 +55,19 @@ class TestRepoCleanMq:
             assert not PushPatch.called
         repo.PushPatch.assert_called_with(sentinel.patch)
 
+    @patch.multiple(
+            Repo, lastAppliedPatch=sentinel.patch,
+            PopPatch=DEFAULT, PushPatch=DEFAULT
+            )
+    def should_push_after_errors(self, PopPatch, PushPatch):
+        repo = CreateRepo(clean_mq=True)
+
+        def Fail():
+            with repo.CleanMq():
+                raise ValueError()
+        Fail |should| throw(ValueError)
+        repo.PushPatch.assert_called_with(sentinel.patch)
+
     @patch.multiple(
             Repo, lastAppliedPatch=None,
             PopPatch=DEFAULT, PushPatch=DEFAULT
@@ -51,6 +80,24 @@ class TestRepoCleanMq:
         assert not PushPatch.called
 
 
+class TestRepoWorkingChanges:
+    def it_lists_tracked_changes(self):
+        repo = CreateRepo()
+        repo.hg[''].return_value = 'added.txt\nremoved.txt\n'
+        repo.WorkingChanges() |should| equal_to(['added.txt', 'removed.txt'])
+        repo.hg.__getitem__.assert_called_with(
+                ('status', '-mard', '--no-status')
+                )
+
+    def it_can_list_unknown_files(self):
+        repo = CreateRepo()
+        repo.hg[''].return_value = 'new.txt\n'
+        repo.WorkingChanges(unknown=True) |should| equal_to(['new.txt'])
+        repo.hg.__getitem__.assert_called_with(
+                ('status', '-mardu', '--no-status')
+                )
+
+
 class TestRepoSummary:
     def doTest(self, commitLine, mqLine, expected):
         repo = CreateRepo()
@@ -149,6 +196,30 @@ class TestRepoIncomings:
         (lambda: repo.incomings) |should| throw(ProcessExecutionError)
 
 
+class TestRepoHeads:
+    def it_lists_heads(self):
+        repo = CreateRepo()
+        repo.hg[''].return_value = 'abc\ndef\n'
+        repo.heads |should| equal_to(['abc', 'def'])
+
+
+class TestRepoLog:
+    def it_parses_node_info(self):
+        repo = CreateRepo()
+        repo.hg[''].return_value = 'abc\t123\t000\tdefault\tA changeset\n'
+        repo.Log('::.') |should| equal_to([
+            ('abc', '123', '000', 'default', 'A changeset')
+            ])
+
+    def it_passes_revset(self):
+        repo = CreateRepo()
+        repo.hg[''].return_value = ''
+        repo.Log('::.')
+        repo.hg.__getitem__.assert_called_with(
+                ('log', '--template', Repo.HgNodeTemplateParam, '-r', '::.')
+                )
+
+
 class TestRepoLastAppliedPatch:
     def should_return_none_if_mq_disabled(self):
         repo = CreateRepo()
@@ -188,6 +259,74 @@ class TestRepoPushToRemote:
                 )
 
 
+    def should_push_multiple_targets_and_bookmarks(self):
+        repo = CreateRepo(sentinel.remote)
+        repo.PushToRemote(['a', 'b'], ['default'], ['feature'])
+        repo.hg.assert_called_with(
+                'push', '-b', 'default', '-r', 'a', '-r', 'b',
+                '-B', 'feature', sentinel.remote
+                )
+
+    def should_ignore_no_changesets_when_pushing_bookmarks(self):
+        repo = CreateRepo(sentinel.remote)
+        repo.hg.side_effect = ProcessExecutionError('', 1, '', '')
+        (lambda: repo.PushToRemote(['a'], [], ['feature'])) |should_not| \
+                throw(ProcessExecutionError)
+        (lambda: repo.PushToRemote(['a'], [])) |should| \
+                throw(ProcessExecutionError)
+
+    def should_not_pop_patches_for_explicit_targets(self):
+        repo = CreateRepo(sentinel.remote)
+        repo.PushToRemote(['a'], [])
+        repo.hg.call_args_list |should| equal_to(
+                [call('push', '-r', 'a', sentinel.remote)]
+                )
+
+
+class TestRepoFindOutgoings:
+    def it_passes_revs_and_branches(self):
+        repo = CreateRepo(sentinel.remote)
+        repo.hg[''].return_value = '\n\n'
+        repo.FindOutgoings(['a', 'b'], ['x', 'y'])
+        repo.hg.__getitem__.assert_called_with((
+            'outgoing', '-b', 'x', '-b', 'y', '-r', 'a', '-r', 'b',
+            '--template', Repo.HgTemplateParam, sentinel.remote
+            ))
+        # Nothing else is run, so no patches are popped
+        repo.hg.called |should| equal_to(False)
+
+
+class TestRepoBookmarks:
+    def it_parses_bookmarks(self):
+        repo = CreateRepo()
+        repo.hg.return_value = (
+                '   feature                   3:abcdef123456\n'
+                ' * my work                  10:123456abcdef\n'
+                )
+        repo.bookmarks |should| equal_to({
+            'feature': 'abcdef123456', 'my work': '123456abcdef'
+            })
+
+    def it_handles_no_bookmarks(self):
+        repo = CreateRepo()
+        repo.hg.return_value = 'no bookmarks set\n'
+        repo.bookmarks |should| equal_to({})
+
+
+class TestRepoBranchesOf:
+    def it_finds_branches(self):
+        repo = CreateRepo()
+        repo.hg[''].return_value = 'default\nstable\ndefault\n'
+        repo.BranchesOf(['a', 'b']) |should| equal_to(
+                set(['default', 'stable'])
+                )
+
+    def it_does_nothing_without_revs(self):
+        repo = CreateRepo()
+        repo.BranchesOf([]) |should| equal_to(set())
+        assert not repo.hg.called
+
+
 class TestRepoPushMqToRemote:
     def should_assert_if_no_remote(self):
         repo = CreateRepo()
@@ -198,6 +337,11 @@ class TestRepoPushMqToRemote:
         repo.PushMqToRemote()
         repo.hg.assert_called_with('push', '--mq', sentinel.remote)
 
+    def should_force_push_if_requested(self):
+        repo = CreateRepo(sentinel.remote)
+        repo.PushMqToRemote(force=True)
+        repo.hg.assert_called_with('push', '--mq', '-f', sentinel.remote)
+
     def should_ignore_no_outgoings_return_code(self):
         repo = CreateRepo(sentinel.remote)
         repo.hg.side_effect = ProcessExecutionError('', 1, '', '')
@@ -209,6 +353,59 @@ class TestRepoPushMqToRemote:
         repo.PushMqToRemote |should| throw(ProcessExecutionError)
 
 
+class TestRepoSquashMq:
+    def History(self, *descs):
+        return [
+                Repo.ChangesetNodeInfo(str(i), '', '', 'default', desc)
+                for i, desc in enumerate(descs)
+                ]
+
+    def it_squashes_runs_of_messages(self):
+        history = self.History('a', 'm', 'm', 'b', 'm', 'm', 'm')
+        Repo._SquashRules(history, 'm') |should| equal_to([
+            ('pick', '1'), ('roll', '2'), ('pick', '3'),
+            ('pick', '4'), ('roll', '5'), ('roll', '6')
+            ])
+
+    def it_leaves_single_messages(self):
+        history = self.History('m', 'a', 'm', 'b')
+        Repo._SquashRules(history, 'm') |should| equal_to([])
+
+    def it_counts_synchg_commits(self):
+        repo = CreateRepo()
+        repo.Log = Mock(return_value=self.History('synchg-commit', 'a'))
+        repo.mqCommitCount |should| equal_to(1)
+        repo.Log.assert_called_with('::.', mq=True)
+
+    def it_runs_histedit(self):
+        repo = CreateRepo()
+        repo.Log = Mock(return_value=self.History('a', 'm', 'm'))
+        repo.MqCommitMessage = 'm'
+        repo.SquashMq() |should| equal_to(True)
+        repo.hg.assert_called_with(
+                'phase', '--mq', '--draft', '--force', '-r', '1::.'
+                )
+        repo.hg.__getitem__.assert_called_with((
+                '--config', Repo.HisteditConfigParam,
+                'histedit', '--mq', '--commands', '-', '1'
+                ))
+        repo.hg[''].__lshift__.assert_called_with('pick 1\nroll 2\n')
+
+    def it_does_nothing_without_runs(self):
+        repo = CreateRepo()
+        repo.Log = Mock(return_value=self.History('a', 'synchg-commit'))
+        repo.SquashMq() |should| equal_to(False)
+        assert not repo.hg.called
+
+    def it_strips_stale_mq_commits(self):
+        repo = CreateRepo()
+        repo.Log = Mock(return_value=self.History('synchg-commit'))
+        repo.StripStaleMq(backup=False) |should| equal_to(1)
+        repo.hg.assert_called_with(
+                'strip', '--no-backup', '--mq', '-r', ANY
+                )
+
+
 class TestRepoPopPatch:
     @patch.object(Repo, 'lastAppliedPatch', None)
     def it_only_pops_if_needed(self):
@@ -236,12 +433,63 @@ class TestRepoPushPatch:
         repo.PushPatch()
         repo.hg.assert_called_with('qpush', '-a')
 
+    def it_can_keep_changes(self):
+        repo = CreateRepo()
+        repo.keepChanges = True
+        repo.PushPatch()
+        repo.hg.assert_called_with('qpush', '--keep-changes', '-a')
+
     def it_pushes_a_specific_patch_if_requested(self):
         repo = CreateRepo()
         repo.PushPatch(sentinel.patch)
         repo.hg.assert_called_with('qpush', sentinel.patch)
 
 
+class TestRepoWorkingCopy:
+    @patch('synchg.repo.BuildArchive')
+    def it_archives_uncommitted_changes(self, BuildArchive):
+        repo = CreateRepo()
+        repo.hg[''].side_effect = [['new'], ['added']]
+        repo._RunListCommand = lambda command: command()
+        repo._RunRaw = Mock(return_value=sentinel.diff)
+        archive = repo.WorkingCopyArchive()
+        assert archive is BuildArchive.return_value
+        repo._RunRaw.assert_called_with('diff', '--git')
+        BuildArchive.assert_called_with(repo._path, ['new'], {
+            '.hg/' + Repo.WorkingDiffPath: sentinel.diff,
+            '.hg/' + Repo.WorkingFilesPath: 'new\nadded'
+            }, level=9)
+
+    @patch('synchg.repo.SendData')
+    def it_applies_archives(self, SendData):
+        repo = CreateRepo()
+        diff = repo._path / '.hg' / Repo.WorkingDiffPath
+        diff.stat.return_value.st_size = 10
+        repo.ApplyWorkingCopyArchive(sentinel.archive)
+        SendData.assert_called_with(ANY, sentinel.archive, 0, None)
+        repo.hg.assert_called_with('import', '--no-commit', str(diff))
+
+    def it_does_not_reset_without_marker(self):
+        repo = CreateRepo()
+        (repo._path / '.hg' / Repo.WorkingFilesPath).exists.return_value = \
+                False
+        repo.ResetWorkingCopy() |should| be(False)
+        assert not repo.hg.called
+
+    def it_resets_transferred_changes(self):
+        repo = CreateRepo()
+        files = repo._path / '.hg' / Repo.WorkingFilesPath
+        files.exists.return_value = True
+        files.read.return_value = 'one\ntwo\n'
+        repo.ResetWorkingCopy() |should| be(True)
+        # hg & rm are the same mock
+        repo.hg.assert_has_calls([
+            call('revert', '--all', '--no-backup'),
+            call('-f', str(repo._path / 'one'), str(repo._path / 'two'))
+            ])
+        assert files.delete.called
+
+
 class TestRepoStrip:
     def it_strips_some_changesets(self):
         repo = CreateRepo()
@@ -249,6 +497,132 @@ class TestRepoStrip:
         repo.Strip(data)
         repo.hg.assert_called_with('strip', 0, 1, 2, 3, 4)
 
+    def it_can_skip_backups(self):
+        repo = CreateRepo()
+        data = [Repo.ChangesetInfo(i, sentinel.desc) for i in range(2)]
+        repo.Strip(data, backup=False)
+        repo.hg.assert_called_with('strip', '--no-backup', 0, 1)
+
+
+class TestRepoObsolete:
+    def it_supports_obsolescence_if_debugobsolete_works(self):
+        repo = CreateRepo()
+        repo.supportsObsolescence |should| be(True)
+        repo.hg.assert_called_with('debugobsolete')
+
+    def it_does_not_support_obsolescence_if_debugobsolete_fails(self):
+        repo = CreateRepo()
+        repo.hg.side_effect = ProcessExecutionError('', 255, '', '')
+        repo.supportsObsolescence |should| be(False)
+
+    def it_makes_changesets_draft_then_marks_them_in_one_command(self):
+        repo = CreateRepo()
+        data = [Repo.ChangesetInfo(i, sentinel.desc) for i in range(2)]
+        repo.Obsolete(data)
+        repo.hg.call_args_list |should| equal_to([
+            call('phase', '--draft', '--force', 0, 1),
+            call('--config', Repo.ObsoleteAliasParam, 'synchg-obsolete', 0, 1)
+            ])
+
+    def it_runs_debugobsolete_for_each_changeset(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            hg = os.path.join(tmp, 'hg')
+            with open(hg, 'w') as f:
+                f.write('#!/bin/sh\necho "$@" >> "$0.log"\n')
+            os.chmod(hg, 0755)
+            script = Repo.ObsoleteAliasParam.partition('!')[2]
+            local['sh']('-c', script, 'sh', 'abc', 'def', env={'HG': hg})
+            with open(hg + '.log') as f:
+                f.read().splitlines() |should| equal_to([
+                    '--config {0} debugobsolete {1}'.format(
+                        Repo.ObsoleteConfigParam, node
+                        )
+                    for node in ('abc', 'def')
+                    ])
+        finally:
+            shutil.rmtree(tmp)
+
+    def it_does_nothing_without_changesets(self):
+        repo = CreateRepo()
+        repo.Obsolete([])
+        repo.hg.called |should| equal_to(False)
+
+
+class TestRepoCompact:
+    def it_strips_obsolete_changesets(self):
+        repo = CreateRepo()
+        repo.hg[''].return_value = 'abc\ndef\n'
+        repo.Compact() |should| equal_to(2)
+        repo.hg.assert_called_with('--hidden', 'strip', '-r', 'obsolete()')
+
+    def it_does_nothing_without_obsolete_changesets(self):
+        repo = CreateRepo()
+        repo.hg[''].return_value = ''
+        repo.Compact() |should| equal_to(0)
+        assert not repo.hg.called
+
+
+class TestRepoSparse:
+    def it_has_no_rules_without_sparse_file(self):
+        repo = CreateRepo()
+        (repo._path / '.hg' / 'sparse').exists.return_value = False
+        repo.sparseRules |should| equal_to(([], []))
+
+    def it_parses_sparse_file(self):
+        repo = CreateRepo()
+        sparse = repo._path / '.hg' / 'sparse'
+        sparse.exists.return_value = True
+        sparse.read.return_value = (
+                '[include]\nsrc\n# comment\ndocs\n\n[exclude]\nsrc/big\n'
+                )
+        repo.sparseRules |should| equal_to((['src', 'docs'], ['src/big']))
+
+    @patch.object(Repo, 'config', Mock(spec_set=RepoConfig))
+    @patch.object(Repo, 'sparseRules', (['src'], []))
+    @patch('synchg.repo.SendData')
+    def it_sets_sparse_rules_with_one_refresh(self, send):
+        repo = CreateRepo()
+        repo.config.Get.return_value = None
+        repo.SetSparse(['src'], ['src/big'])
+        repo.config.Set.assert_called_with('extensions', 'sparse', '')
+        send.call_args[0][1] |should| equal_to(
+                '[include]\nsrc\n[exclude]\nsrc/big\n'
+                )
+        repo.hg.assert_called_once_with(
+                '--config', Repo.SparseConfigParam, 'debugsparse', '--refresh'
+                )
+
+    @patch.object(Repo, 'config', Mock(spec_set=RepoConfig))
+    @patch.object(Repo, 'sparseRules', (['src'], ['src/big']))
+    @patch('synchg.repo.SendData')
+    def it_clears_sparse_rules(self, send):
+        repo = CreateRepo()
+        repo.SetSparse([], [])
+        send.call_args[0][1] |should| equal_to('')
+        repo.hg.assert_called_once_with(
+                '--config', Repo.SparseConfigParam, 'debugsparse', '--refresh'
+                )
+
+    @patch.object(Repo, 'config', Mock(spec_set=RepoConfig))
+    @patch.object(Repo, 'sparseRules', ([], []))
+    @patch('synchg.repo.SendData')
+    def it_leaves_full_working_copies_alone(self, send):
+        repo = CreateRepo()
+        repo.SetSparse([], [])
+        assert not send.called
+        assert not repo.hg.called
+        assert not repo.config.Set.called
+
+    @patch.object(Repo, 'config', Mock(spec_set=RepoConfig))
+    @patch.object(Repo, 'sparseRules', (['src'], ['src/big']))
+    @patch('synchg.repo.SendData')
+    def it_leaves_unchanged_rules_alone(self, send):
+        repo = CreateRepo()
+        repo.SetSparse(['src'], ['src/big'])
+        assert not send.called
+        assert not repo.hg.called
+
 
 class TestRepoUpdate:
     def it_accepts_changeset_info(self):
@@ -269,6 +643,11 @@ class TestRepoUpdateMq:
         repo.UpdateMq()
         repo.hg.assert_called_with('update', '--mq')
 
+    def it_updates_mq_to_a_revision(self):
+        repo = CreateRepo()
+        repo.UpdateMq('abc')
+        repo.hg.assert_called_with('update', '--mq', '-C', 'abc')
+
 
 class TestRepoRefreshMq:
     def it_refreshes_mq(self):
@@ -357,52 +736,219 @@ class TestMqClone:
         repo.mqconfig.AddRemote |should| be_called
 
 
+class TestLockWorkingCopy(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, '.hg'))
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def Repo(self):
+        machine = MagicMock()
+        machine.cwd = local.path(self.dir)
+        return Repo(machine)
+
+    def it_makes_syncs_take_turns(self):
+        events = []
+
+        def Sync():
+            with self.Repo().LockWorkingCopy():
+                events.append('start')
+                threading.Event().wait(0.05)
+                events.append('end')
+
+        threads = [threading.Thread(target=Sync) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        events |should| equal_to(['start', 'end'] * 3)
+
+
 class TestRepoConfig(object):
-    @patch('synchg.repo.ConfigParser', autospec=True)
-    def it_reads_config_if_there(self, config_parser):
-        path = MagicMock()
-        (path / '.hg' / 'hgrc').exists.return_value = True
-        (path / '.hg' / 'hgrc').open.return_value = sentinel.config
-        RepoConfig(path)
-        config_parser.assert_has_calls([
-                call(),
-                call().readfp(sentinel.config)
-                ])
-
-    @patch('synchg.repo.ConfigParser', autospec=True)
-    def it_creates_paths_section_if_needed(self, config_parser):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, '.hg'))
+        self.hgrc = os.path.join(self.dir, '.hg', 'hgrc')
+        self.path = local.path(self.dir)
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def Write(self, text):
+        with open(self.hgrc, 'w') as f:
+            f.write(text)
+
+    def Read(self):
+        with open(self.hgrc) as f:
+            return f.read()
+
+    def it_reads_config_if_there(self):
+        self.Write('[paths]\nhost = ssh://host/repo\n')
+        RepoConfig(self.path).remotes |should| \
+                equal_to({'host': 'ssh://host/repo'})
+
+    def it_creates_paths_section_if_needed(self):
+        RepoConfig(self.path).remotes |should| equal_to({})
+        self.Write('[ui]\nusername = me\n')
+        RepoConfig(self.path).remotes |should| equal_to({})
+
+    def it_allows_add_remote(self):
+        config = RepoConfig(self.path)
+        config.AddRemote('host', 'ssh://host/repo')
+        self.Read() |should| equal_to('[paths]\nhost = ssh://host/repo\n\n')
+        os.listdir(os.path.join(self.dir, '.hg')) |should| equal_to(['hgrc'])
+
+    def it_sets_values_in_new_sections(self):
+        RepoConfig(self.path).Set('extensions', 'sparse', '')
+        RepoConfig(self.path).Get('extensions', 'sparse') |should| \
+                equal_to('')
+
+    def it_caches_parsed_files(self):
+        self.Write('[paths]\nhost = ssh://host/repo\n')
+        RepoConfig(self.path)
+        with patch('synchg.repo.ConfigParser.readfp') as readfp:
+            config = RepoConfig(self.path)
+        readfp.called |should| equal_to(False)
+        config.remotes |should| equal_to({'host': 'ssh://host/repo'})
+
+    def it_rereads_changed_files(self):
+        self.Write('[paths]\n')
+        RepoConfig(self.path)
+        self.Write('[paths]\nother = ssh://other/repo\n')
+        RepoConfig(self.path).remotes |should| \
+                equal_to({'other': 'ssh://other/repo'})
+
+    def it_batches_edits(self):
+        config = RepoConfig(self.path)
+        with config.Batch():
+            config.AddRemote('host', 'ssh://host/repo')
+            config.Set('extensions', 'sparse', '')
+            os.path.exists(self.hgrc) |should| equal_to(False)
+        RepoConfig(self.path).Get('extensions', 'sparse') |should| \
+                equal_to('')
+        RepoConfig(self.path).remotes |should| \
+                equal_to({'host': 'ssh://host/repo'})
+
+    def it_discards_edits_when_a_batch_fails(self):
+        config = RepoConfig(self.path)
+        try:
+            with config.Batch():
+                config.AddRemote('host', 'ssh://host/repo')
+                raise ValueError()
+        except ValueError:
+            pass
+        config.remotes |should| equal_to({})
+        with config.Batch():
+            config.Set('extensions', 'sparse', '')
+        RepoConfig(self.path).remotes |should| equal_to({})
+        RepoConfig(self.path).Get('extensions', 'sparse') |should| \
+                equal_to('')
+
+    def it_batches_edits_to_the_latest_file(self):
+        config = RepoConfig(self.path)
+        other = RepoConfig(self.path)
+        other.AddRemote('other', 'ssh://other/repo')
+        with config.Batch():
+            config.AddRemote('host', 'ssh://host/repo')
+        RepoConfig(self.path).remotes |should| equal_to({
+            'host': 'ssh://host/repo', 'other': 'ssh://other/repo'
+            })
+
+    def it_rereads_same_size_rewrites(self):
+        self.Write('[paths]\na = ssh://a/repo\n')
+        RepoConfig(self.path)
+        stat = os.stat(self.hgrc)
+        self.Write('[paths]\nb = ssh://b/repo\n')
+        os.utime(self.hgrc, (stat.st_atime, stat.st_mtime))
+        RepoConfig(self.path).remotes |should| \
+                equal_to({'b': 'ssh://b/repo'})
+
+    def it_writes_remote_files_with_one_command(self):
         path = MagicMock()
-        (path / '.hg' / 'hgrc').exists.return_value = False
-        RepoConfig(path)
-        config_parser.assert_has_calls([
-                call(),
-                call().add_section('paths')
-                ])
-
-    @patch('synchg.repo.ConfigParser', autospec=True)
-    def it_allows_add_remote(self, config_parser):
-        path = MagicMock()
-        (path / '.hg' / 'hgrc').exists.return_value = False
-        (path / '.hg' / 'hgrc').open.return_value = sentinel.config
+        hgrc = path.__div__.return_value.__div__.return_value = \
+                MagicMock(spec=['remote'])
+        hgrc.remote['cat'][hgrc].run.return_value = (1, '', '')
         config = RepoConfig(path)
-        config_parser.reset_mock()
-        config.AddRemote(sentinel.remote, sentinel.destination)
-        config_parser.assert_has_calls([
-                call().set('paths', sentinel.remote, sentinel.destination),
-                call().write(sentinel.config)
-                ])
-
-    @patch('synchg.repo.ConfigParser', autospec=True)
-    def it_returns_remote_dict(self, __):
-        config = RepoConfig(MagicMock())
-        config._config.reset_mock()
-        config._config.items.return_value = [
-                ('key1', sentinel.value1),
-                ('key2', sentinel.value2)
-                ]
-        config.remotes |should| equal_to(
-                dict(key1=sentinel.value1, key2=sentinel.value2)
+        with patch('synchg.repo.SendData') as send:
+            with config.Batch():
+                config.AddRemote('a', 'ssh://a/repo')
+                config.AddRemote('b', 'ssh://b/repo')
+        send.call_count |should| equal_to(1)
+        hgrc.remote['sh'].__getitem__.assert_called_with(
+                ('-c', RepoConfig._RemoteWriteScript, hgrc)
                 )
-        config._config.items.assert_called_with('paths')
 
 
+# The config the squashed mq history tests run hg with
+_SquashHgrc = '''
+[ui]
+username = synchg tests <synchg@example.com>
+[extensions]
+mq =
+'''
+
+
+class TestSquashedMqHistory(object):
+    '''
+    Squashes the mq history of a real repository and force pushes it to a
+    clone, like a sync with ``mq_squash_threshold`` set
+    '''
+    def setup(self):
+        try:
+            self.hg = local['hg']
+        except CommandNotFound:
+            raise SkipTest('hg is not installed')
+        self.dir = tempfile.mkdtemp()
+        self.hgrc = os.path.join(self.dir, 'hgrc')
+        with open(self.hgrc, 'w') as f:
+            f.write(_SquashHgrc)
+        self.local = os.path.join(self.dir, 'local')
+        self.remote = os.path.join(self.dir, 'remote')
+        with local.env(HGRCPATH=self.hgrc):
+            self.hg('init', self.local)
+            with local.cwd(self.local):
+                with open('file', 'w') as f:
+                    f.write('base\n')
+                self.hg('commit', '-A', '-m', 'base')
+                self.hg('init', '--mq')
+                for i in range(3):
+                    with open('.hg/patches/series', 'a') as f:
+                        f.write('{0}.patch\n'.format(i))
+                    self.hg(
+                            'commit', '--mq', '-A',
+                            '-m', Repo.MqCommitMessage
+                            )
+            self.hg('clone', self.local, self.remote)
+            self.hg(
+                    'clone', os.path.join(self.local, '.hg', 'patches'),
+                    os.path.join(self.remote, '.hg', 'patches')
+                    )
+            with local.cwd(self.local):
+                repo = Repo(local, self.remote)
+                repo.SquashMq() |should| equal_to(True)
+                repo.PushMqToRemote(force=True)
+                self.localMq = self.MqHistory(repo)
+                self.mqRev = repo.mqRev
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    @staticmethod
+    def MqHistory(repo):
+        return sorted(cs.hash for cs in repo.Log('all()', mq=True))
+
+    def it_strips_the_old_history_from_the_remote(self):
+        with local.env(HGRCPATH=self.hgrc), local.cwd(self.remote):
+            remote = Repo(local)
+            remote.UpdateMq(self.mqRev)
+            remote.StripStaleMq(backup=False) |should| equal_to(3)
+            self.MqHistory(remote) |should| equal_to(self.localMq)
+
+    def it_collects_the_old_history_from_the_remote(self):
+        with local.env(HGRCPATH=self.hgrc):
+            CollectGarbage(local, self.dir, BackupRetention(0, 0, 0))
+            with local.cwd(self.remote):
+                self.MqHistory(Repo(local)) |should| \
+                        equal_to(self.localMq)
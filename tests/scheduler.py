@@ -0,0 +1,116 @@
+
+import threading
+from mock import Mock
+from should_dsl import should
+from synchg.sync import SyncOptions, SyncError
+from synchg.scheduler import SyncScheduler
+
+# Keep pep8 happy
+equal_to = None
+
+
+class TestSyncScheduler(object):
+    def setup(self):
+        self.now = [0.0]
+        self.sync = Mock()
+        self.errors = []
+        self.scheduler = SyncScheduler(
+                self.sync, lambda *args: self.errors.append(args),
+                lambda: self.now[0]
+                )
+        self.options = SyncOptions(min_interval=2.0, max_staleness=10.0)
+
+    def Request(self, name='repo', host='host'):
+        self.scheduler.Request(host, name, name, 'src', self.options)
+
+    def At(self, now):
+        self.now[0] = now
+        return self.scheduler.RunPending()
+
+    def it_waits_for_requests_to_stop(self):
+        self.Request()
+        self.At(1.0) |should| equal_to(1.0)
+        self.sync.called |should| equal_to(False)
+        self.At(2.0) |should| equal_to(None)
+        self.sync.call_count |should| equal_to(1)
+
+    def it_coalesces_bursts(self):
+        for now in (0.0, 1.0, 2.5, 4.0):
+            self.At(now)
+            self.Request()
+        self.At(6.0)
+        self.sync.call_count |should| equal_to(1)
+
+    def it_limits_staleness(self):
+        for now in range(0, 12):
+            self.At(now)
+            self.Request()
+        self.sync.call_count |should| equal_to(1)
+        self.sync.call_args[0][:2] |should| equal_to(('host', 'repo'))
+
+    def it_schedules_repositories_separately(self):
+        self.Request('one')
+        self.At(1.0)
+        self.Request('two')
+        self.At(2.0)
+        [c[0][1] for c in self.sync.call_args_list] |should| equal_to(['one'])
+        self.At(3.0) |should| equal_to(None)
+        self.sync.call_count |should| equal_to(2)
+
+    def it_reports_errors(self):
+        self.sync.side_effect = SyncError('oops')
+        self.Request()
+        self.At(2.0)
+        self.errors[0][0] |should| equal_to(('host', 'repo'))
+
+    def it_runs_one_trailing_sync_after_running_sync(self):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def Sync(*args):
+            calls.append(args[2])
+            started.set()
+            release.wait()
+
+        options = SyncOptions(min_interval=0.0)
+        scheduler = SyncScheduler(Sync)
+        scheduler.Start()
+        try:
+            scheduler.Request('host', 'repo', 'first', 'src', options)
+            started.wait(5)
+            for path in ('second', 'third', 'fourth'):
+                scheduler.Request('host', 'repo', path, 'src', options)
+            release.set()
+        finally:
+            # Give the trailing sync a chance to start before stopping
+            for _ in range(50):
+                if len(calls) == 2:
+                    break
+                threading.Event().wait(0.1)
+            scheduler.Stop()
+        calls |should| equal_to(['first', 'fourth'])
+
+    def it_runs_one_sync_at_a_time(self):
+        running, overlaps, done = [0], [], threading.Event()
+        lock = threading.Lock()
+
+        def Sync(*args):
+            with lock:
+                running[0] += 1
+                overlaps.append(running[0])
+            threading.Event().wait(0.05)
+            with lock:
+                running[0] -= 1
+            if len(overlaps) == 3:
+                done.set()
+
+        options = SyncOptions(min_interval=0.0)
+        scheduler = SyncScheduler(Sync)
+        scheduler.Start()
+        try:
+            for name in ('one', 'two', 'three'):
+                scheduler.Request('host', name, name, 'src', options)
+            done.wait(5)
+        finally:
+            scheduler.Stop()
+        overlaps |should| equal_to([1, 1, 1])
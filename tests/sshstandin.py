@@ -0,0 +1,133 @@
+'''
+A minimal stand-in for sshd, for testing the paramiko machine without a real
+ssh server.  It accepts any password, runs exec & shell requests as local
+processes and connects direct-tcpip channels to local ports.
+'''
+
+import os
+import socket
+import threading
+import subprocess
+import paramiko
+from synchg.paramikomachine import _Pump
+
+_BufferSize = 32 * 1024
+
+
+def _Thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _RunProcess(channel, argv):
+    ''' Runs a process, connecting it's stdio to a channel '''
+    proc = subprocess.Popen(
+            argv, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+
+    def Input():
+        try:
+            while True:
+                data = channel.recv(_BufferSize)
+                if not data:
+                    break
+                proc.stdin.write(data)
+                proc.stdin.flush()
+        except (IOError, EOFError):
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except IOError:
+                pass
+
+    def Output(pipe, send):
+        while True:
+            data = os.read(pipe.fileno(), _BufferSize)
+            if not data:
+                break
+            send(data)
+
+    _Thread(Input)
+    outputs = [
+            _Thread(Output, proc.stdout, channel.sendall),
+            _Thread(Output, proc.stderr, channel.sendall_stderr)
+            ]
+    for thread in outputs:
+        thread.join()
+    channel.send_exit_status(proc.wait())
+    channel.close()
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self):
+        self.destinations = {}
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.destinations[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        _Thread(_RunProcess, channel, ['sh', '-c', command])
+        return True
+
+    def check_channel_shell_request(self, channel):
+        _Thread(_RunProcess, channel, ['sh'])
+        return True
+
+
+class StandInSshd(object):
+    '''
+    A stand-in sshd listening on a free port of localhost
+    '''
+
+    def __init__(self):
+        self.hostKey = paramiko.RSAKey.generate(1024)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(5)
+        self.port = self._sock.getsockname()[1]
+        self._transports = []
+        _Thread(self._Accept)
+
+    def _Accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                return
+            _Thread(self._Serve, conn)
+
+    def _Serve(self, conn):
+        transport = paramiko.Transport(conn)
+        self._transports.append(transport)
+        transport.add_server_key(self.hostKey)
+        server = _Server()
+        transport.start_server(server=server)
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is None:
+                continue
+            destination = server.destinations.pop(channel.get_id(), None)
+            if destination:
+                sock = socket.create_connection(destination)
+                _Thread(_Pump, sock, channel)
+
+    def close(self):
+        self._sock.close()
+        for transport in self._transports:
+            transport.close()
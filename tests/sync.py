@@ -0,0 +1,337 @@
+
+import os
+import shutil
+import tempfile
+import plumbum
+from ConfigParser import ConfigParser
+from StringIO import StringIO
+from mock import Mock, MagicMock, patch
+from should_dsl import should
+from plumbum.commands import ProcessExecutionError
+from synchg.repo import Repo
+from synchg.state import HostState
+from synchg.sync import SyncOptions, _FindTargets
+from synchg.sync import _SanityCheckRepos, _ForgetSanityCheck, _IsPathError
+from synchg.sync import _Ask, SyncError, CollectRemoteGarbage
+from synchg.sync import _DoSync, AbortException, _LocalRepo, _RemoteRepo
+from synchg.sync import _SetPriority, BackgroundNiceness, _ConfigureSparse
+from synchg.events import EventBus
+
+# Keep pep8 happy
+equal_to = throw = None
+
+
+def ReadConfig(text):
+    config = ConfigParser()
+    config.readfp(StringIO(text))
+    return config
+
+
+class TestSyncOptions(object):
+    def it_uses_defaults(self):
+        options = SyncOptions()
+        options.index |should| equal_to(True)
+        options.strip_mode |should| equal_to('strip')
+
+    def it_rejects_unknown_options(self):
+        (lambda: SyncOptions(nonsense=1)) |should| throw(TypeError)
+
+    def it_reads_global_config(self):
+        config = ReadConfig('[config]\nstrip_mode = obsolete\nindex = no\n')
+        options = SyncOptions.FromConfig(config, 'host', 'project')
+        options.strip_mode |should| equal_to('obsolete')
+        options.index |should| equal_to(False)
+
+    def it_prefers_host_then_project_config(self):
+        config = ReadConfig(
+                '[config]\nstrip_mode = strip\n'
+                '[host:host]\nstrip_mode = obsolete\nindex = no\n'
+                '[project:project]\nstrip_mode = strip\n'
+                )
+        options = SyncOptions.FromConfig(config, 'host', 'project')
+        options.strip_mode |should| equal_to('strip')
+        options.index |should| equal_to(False)
+        host = SyncOptions.FromConfig(config, 'host', 'project2')
+        host.strip_mode |should| equal_to('obsolete')
+        other = SyncOptions.FromConfig(config, 'other', 'project2')
+        other.strip_mode |should| equal_to('strip')
+
+    def it_rejects_unknown_strip_modes(self):
+        config = ReadConfig('[config]\nstrip_mode = prune\n')
+        (lambda: SyncOptions.FromConfig(config, 'host', 'project')) \
+                |should| throw(SyncError)
+
+    def it_rejects_unknown_choices(self):
+        for option, value in (('mq_strategy', 'deltas'),
+                              ('uncommitted', 'transfr'),
+                              ('hg_profile', 'lean2'),
+                              ('local_backend', 'mercurial'),
+                              ('ssh_backend', 'paramko')):
+            config = ReadConfig('[config]\n{0} = {1}\n'.format(option, value))
+            (lambda: SyncOptions.FromConfig(config, 'host', 'project')) \
+                    |should| throw(SyncError)
+
+
+class TestFindTargets(object):
+    def setup(self):
+        self.local = Mock(spec_set=Repo)
+        self.local.baseRev = 'abc'
+        self.local.BranchesOf.side_effect = lambda revs: \
+                set(['default' if revs == ['abc'] else 'stable'])
+
+    def it_targets_base_revision_by_default(self):
+        targets = _FindTargets(self.local, SyncOptions())
+        targets |should| equal_to(
+                ('abc', ['abc'], ['default'], [], ['default'])
+                )
+
+    def it_adds_branches_and_bookmarks(self):
+        options = SyncOptions(
+                branches=['default', 'other'], bookmarks=['feature']
+                )
+        targets = _FindTargets(self.local, options)
+        targets |should| equal_to((
+            'abc',
+            ['abc', "bookmark('feature')"],
+            ['default', 'other'],
+            ['feature'],
+            ['default', 'other', 'stable']
+            ))
+
+    def it_adds_draft_heads(self):
+        self.local.Log.return_value = [
+                Repo.ChangesetNodeInfo('def', '0', '0', 'topic', 'desc')
+                ]
+        targets = _FindTargets(self.local, SyncOptions(draft_heads=True))
+        targets.revs |should| equal_to(['abc', 'def'])
+        targets.stripBranches |should| equal_to(['default', 'topic'])
+
+    def it_leaves_out_applied_patches(self):
+        targets = _FindTargets(
+                self.local, SyncOptions(branches=['other']), applied=True
+                )
+        targets.revs |should| equal_to([
+            "heads(::((abc) or (head() and branch('default')) or "
+            "(head() and branch('other'))) - (abc::. - abc))"
+            ])
+        targets.branches |should| equal_to([])
+        targets.stripBranches |should| equal_to(['default', 'other'])
+
+
+class TestSanityCheckCache(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dir, 'repo', '.hg'))
+        self.hgrc = os.path.join(self.dir, 'repo', '.hg', 'hgrc')
+        with open(self.hgrc, 'w') as f:
+            f.write('[paths]\n')
+        self.state = HostState('host', os.path.join(self.dir, 'state'))
+        self.local = MagicMock()
+        for config in (self.local.config, self.local.mqconfig):
+            config.remotes = ['host']
+            config.Batch.return_value.__enter__.return_value = config
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def Check(self):
+        self.remote = MagicMock()
+        with plumbum.local.cwd(os.path.join(self.dir, 'repo')):
+            return _SanityCheckRepos(
+                    self.local, 'host', 'src/repo', self.remote, Mock(),
+                    HostState('host', os.path.join(self.dir, 'state'))
+                    )
+
+    def it_skips_checks_that_passed(self):
+        self.Check() |should| equal_to(True)
+        self.Check() |should| equal_to(False)
+        self.remote.cwd.__div__.called |should| equal_to(False)
+
+    def it_checks_again_when_fingerprint_changes(self):
+        self.Check()
+        with open(self.hgrc, 'a') as f:
+            f.write('host = ssh://host/src/repo\n')
+        self.Check() |should| equal_to(True)
+        self.remote.cwd.__div__.called |should| equal_to(True)
+
+    def it_checks_again_when_forgotten(self):
+        self.Check()
+        _ForgetSanityCheck(self.state, 'src/repo')
+        self.Check() |should| equal_to(True)
+
+    def it_recognises_path_errors(self):
+        _IsPathError(ProcessExecutionError(
+                ['cd', 'src/repo'], 1, '',
+                'cd: src/repo: No such file or directory'
+                )) |should| equal_to(True)
+        _IsPathError(ProcessExecutionError(
+                ['hg', 'push'], 255, '', 'abort: push creates new heads'
+                )) |should| equal_to(False)
+
+
+class TestAsk(object):
+    def it_follows_the_policy(self):
+        options = SyncOptions(policy=['clone=always', 'strip=never'])
+        _Ask(options, 'clone', 'Clone?') |should| equal_to(True)
+        _Ask(options, 'strip', 'Continue?') |should| equal_to(False)
+
+    def it_fails_unanswered_questions_when_not_interactive(self):
+        options = SyncOptions(interactive=False)
+        (lambda: _Ask(options, 'clone', 'Clone?')) |should| throw(SyncError)
+
+    def it_rejects_invalid_policies(self):
+        options = SyncOptions(policy=['clone=maybe'])
+        (lambda: _Ask(options, 'clone', 'Clone?')) |should| throw(SyncError)
+
+
+class TestCollectRemoteGarbage(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        HostState('host', self.dir).Set('projects', {
+            'src/gone': {
+                'root': 'src', 'name': 'gone',
+                'local': os.path.join(self.dir, 'gone')
+                }
+            })
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def Collect(self, answer):
+        collect = Mock(return_value=[])
+        with patch('synchg.sync.HostState',
+                   lambda host: HostState(host, self.dir)):
+            with patch('synchg.sync._Connect', MagicMock()):
+                with patch('synchg.sync.CollectGarbage', collect):
+                    with patch('__builtin__.raw_input',
+                               Mock(return_value=answer)):
+                        CollectRemoteGarbage('host', 'src')
+        return collect.call_args[0][3]
+
+    def it_keeps_orphans_when_told_no(self):
+        self.Collect('n') |should| equal_to([])
+        ('src/gone' in HostState('host', self.dir).Get('projects')) \
+                |should| equal_to(True)
+
+    def it_keeps_orphans_by_default(self):
+        self.Collect('') |should| equal_to([])
+
+    def it_deletes_orphans_when_told_yes(self):
+        self.Collect('y') |should| equal_to(['gone'])
+        HostState('host', self.dir).Get('projects') |should| equal_to({})
+
+
+class Transferring(Exception):
+    pass
+
+
+class TestUncommittedChanges(object):
+    def setup(self):
+        self.local = MagicMock()
+        self.local.summary.mq.applied = 0
+        self.local.WorkingCopyArchive.side_effect = Transferring
+        self.remote = MagicMock()
+        self.remote.ResetWorkingCopy.return_value = False
+        self.remote.WorkingChanges.return_value = []
+        self.remote.env = None
+
+    def Sync(self, changes, **options):
+        self.local.WorkingChanges.return_value = changes
+        _DoSync(
+                self.local, self.remote, None, SyncOptions(**options),
+                EventBus([])
+                )
+
+    def it_refuses_remotes_with_only_added_files(self):
+        self.remote.WorkingChanges.return_value = ['added.txt']
+        (lambda: self.Sync([])) |should| throw(SyncError)
+
+    def it_transfers_any_kind_of_change(self):
+        for changes in (['added.txt'], ['removed.txt'], ['unknown.txt']):
+            (lambda: self.Sync(changes, uncommitted='transfer')) \
+                    |should| throw(Transferring)
+        self.local.WorkingChanges.assert_called_with(unknown=True)
+
+    def it_asks_about_untransferred_changes(self):
+        (lambda: self.Sync(
+            ['deleted.txt'], policy=['ignore-changes=never']
+            )) |should| throw(AbortException)
+        self.local.WorkingChanges.assert_called_with(unknown=False)
+
+
+class TestLockTimeouts(object):
+    def it_sets_the_lock_timeout_of_remote_repos(self):
+        with patch.multiple(
+                'synchg.sync', Repo=Mock(), HostState=Mock(),
+                HostEnvironment=Mock()
+                ):
+            repo = _RemoteRepo('host', Mock(), SyncOptions(hg_lock_timeout=5))
+        repo.UseLockTimeout.assert_called_with(5)
+
+    def it_leaves_the_lock_timeout_of_local_repos(self):
+        with patch('synchg.sync.Repo') as Repo:
+            repo = _LocalRepo(
+                    'host', SyncOptions(local_backend='hg'), Mock(spec=[])
+                    )
+        (repo is Repo.return_value) |should| equal_to(True)
+        repo.UseLockTimeout.called |should| equal_to(False)
+
+
+class TestSetPriority(object):
+    def SetPriority(self, niceness, **options):
+        with patch('synchg.sync.os.nice', create=True) as nice:
+            nice.return_value = niceness
+            _SetPriority(SyncOptions(**options))
+        return [c[0][0] for c in nice.call_args_list if c[0][0]]
+
+    def it_leaves_foreground_syncs(self):
+        self.SetPriority(0) |should| equal_to([])
+
+    def it_lowers_to_the_background_niceness(self):
+        self.SetPriority(4, background=True) |should| \
+                equal_to([BackgroundNiceness - 4])
+
+    def it_only_lowers_once(self):
+        self.SetPriority(BackgroundNiceness, background=True) |should| \
+                equal_to([])
+
+
+class TestWorkingCopyLock(object):
+    def it_finds_changes_outside_the_lock(self):
+        calls = []
+        local = MagicMock()
+        local.WorkingChanges.return_value = []
+        local.lastAppliedPatch = None
+        lock = local.LockWorkingCopy.return_value
+        lock.__enter__.side_effect = lambda *args: calls.append('lock')
+        lock.__exit__.side_effect = lambda *args: calls.append('unlock')
+        local.FindOutgoings.side_effect = \
+                lambda *args: calls.append('discovery') or []
+        remote = MagicMock()
+        remote.ResetWorkingCopy.return_value = False
+        remote.WorkingChanges.return_value = []
+        remote.env = None
+        remote.Update.side_effect = lambda *args: calls.append('update')
+        _DoSync(local, remote, None, SyncOptions(), EventBus([]))
+        calls |should| equal_to(['lock', 'unlock', 'discovery', 'update'])
+        local.CleanMq.called |should| equal_to(False)
+        local.PopPatch.called |should| equal_to(False)
+
+
+class TestConfigureSparse(object):
+    def Configure(self, current, **options):
+        remote = Mock(env=None, sparseRules=current)
+        _ConfigureSparse(remote, SyncOptions(**options), EventBus([]))
+        return remote.SetSparse
+
+    def it_applies_new_rules(self):
+        self.Configure(([], []), sparse_include=['src']) \
+                .assert_called_once_with(['src'], [])
+
+    def it_widens_sparse_remotes_when_the_rules_are_removed(self):
+        self.Configure((['src'], [])).assert_called_once_with([], [])
+
+    def it_leaves_matching_remotes_alone(self):
+        self.Configure(([], [])).called |should| equal_to(False)
+        self.Configure((['src'], []), sparse_include=['src']).called \
+                |should| equal_to(False)
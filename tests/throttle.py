@@ -0,0 +1,67 @@
+
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+from mock import Mock, patch
+from should_dsl import should
+from synchg.throttle import RateLimiter, Relay, ThrottledSsh, main
+
+# Keep pep8 happy
+equal_to = None
+
+
+class TestRateLimiter(object):
+    def setup(self):
+        self.now = 0.0
+        self.sleep = Mock()
+        self.limiter = RateLimiter(100, lambda: self.now, self.sleep)
+
+    def it_allows_a_burst_of_one_second(self):
+        self.limiter.Wait(100)
+        self.sleep.called |should| equal_to(False)
+
+    def it_waits_when_over_the_rate(self):
+        self.limiter.Wait(150)
+        self.sleep.assert_called_once_with(0.5)
+
+    def it_refills_over_time(self):
+        self.limiter.Wait(100)
+        self.now = 0.5
+        self.limiter.Wait(50)
+        self.sleep.called |should| equal_to(False)
+
+    def it_does_not_limit_without_rate(self):
+        limiter = RateLimiter(0, sleep=self.sleep)
+        limiter.Wait(10 ** 9)
+        self.sleep.called |should| equal_to(False)
+
+
+class TestRelay(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def it_copies_input_to_command(self):
+        output = os.path.join(self.dir, 'output')
+        read, write = os.pipe()
+        os.write(write, 'some data')
+        os.close(write)
+        try:
+            code = Relay(['sh', '-c', 'cat > ' + output], 1024, read)
+        finally:
+            os.close(read)
+        code |should| equal_to(0)
+        with open(output) as f:
+            f.read() |should| equal_to('some data')
+
+    def it_builds_ssh_commands(self):
+        command = ThrottledSsh('ssh -C', 2048)
+        command.endswith('throttle.py 2048 ssh -C') |should| equal_to(True)
+
+    def it_needs_a_rate_and_command(self):
+        with patch('sys.stderr', StringIO()) as stderr:
+            main(['100']) |should| equal_to(2)
+        stderr.getvalue().startswith('usage:') |should| equal_to(True)
@@ -0,0 +1,163 @@
+
+import os
+import shutil
+import pstats
+import tempfile
+from should_dsl import should
+from plumbum.commands import ProcessExecutionError
+from synchg.events import CommandRun, Notice, EventBus, ChangesetsPushed
+from synchg.repo import Repo
+from synchg.sync import SyncOptions, _DoSync
+from synchg.trace import Tracer, TraceRecord, LoadTranscript, Summarise
+from synchg.trace import ReplayCommands, ReplayError
+
+# Keep pep8 happy
+equal_to = throw = None
+
+
+def Record(argv, duration, machine='local', retcode=0):
+    return TraceRecord(
+            0, argv, machine, '/repo', duration, retcode, 0, machine != 'local'
+            )
+
+
+class TestTracer(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'trace')
+        self.now = [100.0]
+        self.tracer = Tracer(self.path, lambda: self.now[0])
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def it_records_commands(self):
+        with self.tracer:
+            self.now[0] = 103.0
+            self.tracer(CommandRun(
+                ['hg', 'push'], 'local', '/repo', 2.0, 0, 10, True
+                ))
+            self.tracer(Notice('ignored'))
+        self.tracer.records |should| equal_to([TraceRecord(
+                1.0, ['hg', 'push'], 'local', '/repo', 2.0, 0, 10, True
+                )])
+
+    def it_writes_transcript_and_profile(self):
+        with self.tracer:
+            self.tracer(CommandRun(
+                ['hg', 'summary'], 'host', '/r', 0.5, 1, None, True
+                ))
+        records = LoadTranscript(self.path)
+        records |should| equal_to(self.tracer.records)
+        records[0].argv |should| equal_to(['hg', 'summary'])
+        pstats.Stats(self.path + '.prof')
+
+
+class TestSummarise(object):
+    def it_totals_commands(self):
+        lines = Summarise([
+                Record(['hg', 'push', 'host'], 2.0),
+                Record(['hg', 'summary'], 1.0, 'host'),
+                Record(['hg', 'summary'], 1.5, 'host'),
+                ])
+        lines[0] |should| equal_to('3 commands took 4.50s')
+        lines[1] |should| equal_to('2 round trips to the remote took 2.50s')
+        lines[3].split() |should| equal_to(
+                ['2.50s', '2x', 'host:', 'hg', 'summary']
+                )
+
+
+class TestReplayCommands(object):
+    def setup(self):
+        self.replay = ReplayCommands(
+                [Record(['hg', 'summary'], 1.0, 'host'),
+                 Record(['hg', 'push', 'host'], 2.0),
+                 Record(['hg', 'update', '-C'], 0.5, 'host', 255)],
+                outputs={('hg', 'summary'): 'parent: 1:abc'}
+                )
+        self.local = self.replay.Machine()
+        self.remote = self.replay.Machine('host')
+
+    def it_adds_recorded_durations(self):
+        self.remote['hg']['summary']() |should| equal_to('parent: 1:abc')
+        self.local['hg']('push', 'host')
+        self.replay.elapsed |should| equal_to(3.0)
+        len(self.replay.unused) |should| equal_to(1)
+
+    def it_fails_commands_that_failed(self):
+        (lambda: self.remote['hg']('update', '-C')) |should| \
+                throw(ProcessExecutionError)
+
+    def it_rejects_unknown_commands(self):
+        (lambda: self.local['hg']('summary')) |should| throw(ReplayError)
+
+    def it_returns_lists_of_outputs_in_turn(self):
+        replay = ReplayCommands([], {('hg', 'qtop'): ['a', 'b']}, False)
+        [replay.Machine()['hg']('qtop') for _ in range(3)] |should| \
+                equal_to(['a', 'b', 'b'])
+
+    def it_starts_replayed_processes(self):
+        proc = self.remote['hg'].popen(['summary'])
+        proc.communicate() |should| equal_to(('parent: 1:abc', ''))
+        proc.returncode |should| equal_to(0)
+        self.remote.popen(['hg', 'update', '-C']).wait() |should| \
+                equal_to(255)
+
+    def it_allows_unknown_commands_if_not_strict(self):
+        replay = ReplayCommands([], strict=False)
+        replay.Machine()['hg']('pull') |should| equal_to('')
+        replay.elapsed |should| equal_to(0)
+
+
+class TestReplaySync(object):
+    '''
+    Replays the transcript of a sync that pushes a single changeset
+    '''
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        template = Repo.HgTemplateParam
+        status = ['hg', 'status', '-mard', '--no-status']
+        self.records = [
+                Record(status, 0.25, 'host'),
+                Record(status, 0.25),
+                Record(['hg', 'qtop'], 0.25, retcode=1),
+                Record(['hg', 'qtop'], 0.25, retcode=1),
+                Record(['hg', 'log', '-r', '.', '--template', '{node|short}'],
+                       0.25),
+                Record(['hg', 'log', '-r', '(abc)', '--template',
+                        '{branch}\\n'], 0.25),
+                Record(['hg', 'qtop'], 0.25, 'host', 1),
+                Record(['hg', 'outgoing', '-b', 'default', '-r', 'abc',
+                        '--template', template, 'host'], 1.0),
+                Record(['hg', 'incoming', '-b', 'default', '--template',
+                        template, 'host'], 1.0, retcode=1),
+                Record(['hg', 'push', '-b', 'default', '-r', 'abc', 'host'],
+                       2.0),
+                Record(['hg', 'qtop'], 0.25, 'host', 1),
+                Record(['hg', 'qtop'], 0.25, 'host', 1),
+                Record(['hg', 'update', 'abc'], 0.5, 'host'),
+                ]
+        self.replay = ReplayCommands(self.records, {
+            ('hg', 'log', '-r', '.', '--template', '{node|short}'): 'abc',
+            ('hg', 'log', '-r', '(abc)', '--template', '{branch}\\n'):
+                'default\n',
+            ('hg', 'outgoing', '-b', 'default', '-r', 'abc', '--template',
+             template, 'host'):
+                'comparing with host\nsearching for changes\nabc\tChange\n',
+            })
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def it_replays_the_transcript(self):
+        local = Repo(self.replay.Machine('local', self.dir), 'host')
+        remote = Repo(self.replay.Machine('host', '/repo'))
+        events = []
+        _DoSync(local, remote, None, SyncOptions(), EventBus([events.append]))
+        self.replay.unused |should| equal_to([])
+        self.replay.elapsed |should| equal_to(
+                sum(record.duration for record in self.records)
+                )
+        pushed = [e for e in events if isinstance(e, ChangesetsPushed)]
+        pushed |should| equal_to([ChangesetsPushed([('abc', 'Change')])])
@@ -0,0 +1,98 @@
+
+import shutil
+import tempfile
+from mock import Mock, MagicMock, patch, call
+from should_dsl import should
+from synchg.state import HostState
+from synchg.sync import SyncOptions, _PushInBatches
+from synchg.tuning import LinkStats, TransferSettings, ChooseSettings
+from synchg.tuning import LinkStatsFor, TuneTransfers, MeasureLink
+from synchg.tuning import FastLink, SlowLink, SlowLinkBatch
+
+# Keep pep8 happy
+equal_to = throw = None
+
+
+class TestChooseSettings(object):
+    def it_does_not_compress_fast_links(self):
+        ChooseSettings(LinkStats(0.001, FastLink)) |should| \
+                equal_to(TransferSettings(False, 1, 0))
+
+    def it_compresses_medium_links(self):
+        ChooseSettings(LinkStats(0.05, SlowLink)) |should| \
+                equal_to(TransferSettings(True, 6, 0))
+
+    def it_batches_slow_links(self):
+        ChooseSettings(LinkStats(0.3, SlowLink - 1)) |should| \
+                equal_to(TransferSettings(True, 9, SlowLinkBatch))
+
+
+class TestTuneTransfers(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.state = HostState('host', self.dir)
+        self.machine = MagicMock()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    @patch('synchg.tuning.MeasureLink')
+    def it_caches_link_stats(self, measure):
+        measure.return_value = LinkStats(0.1, 1000.0)
+        LinkStatsFor(self.machine, self.state, 60)
+        stats = LinkStatsFor(self.machine, HostState('host', self.dir), 60)
+        stats |should| equal_to(LinkStats(0.1, 1000.0))
+        measure.assert_called_once_with(self.machine)
+
+    @patch('synchg.tuning.MeasureLink')
+    def it_does_not_measure_when_all_fixed(self, measure):
+        options = SyncOptions(
+                ssh_compression='no', compression_level='3', push_batch='50'
+                )
+        TuneTransfers(self.machine, self.state, options) |should| \
+                equal_to(TransferSettings(False, 3, 50))
+        measure.called |should| equal_to(False)
+
+    @patch('synchg.tuning.MeasureLink')
+    def it_overrides_chosen_settings(self, measure):
+        measure.return_value = LinkStats(0.001, FastLink)
+        options = SyncOptions(compression_level='9')
+        TuneTransfers(self.machine, self.state, options) |should| \
+                equal_to(TransferSettings(False, 9, 0))
+
+    def it_rejects_invalid_settings(self):
+        options = SyncOptions(compression_level='11')
+        (lambda: TuneTransfers(self.machine, self.state, options)) \
+                |should| throw(ValueError)
+
+    @patch('synchg.tuning.SendData')
+    def it_measures_with_remote_commands(self, send):
+        stats = MeasureLink(self.machine, 1024)
+        self.machine.__getitem__.assert_any_call('true')
+        self.machine.__getitem__.assert_any_call('wc')
+        len(send.call_args[0][1]) |should| equal_to(1024)
+        (stats.throughput > 0) |should| equal_to(True)
+
+
+class TestPushInBatches(object):
+    def setup(self):
+        self.local = Mock(pushBatch=2)
+        self.events = Mock()
+        self.outgoings = [Mock(hash=str(i)) for i in range(5)]
+
+    def it_pushes_all_but_last_batch(self):
+        _PushInBatches(self.local, self.outgoings, self.events) |should| \
+                equal_to(4)
+        self.local.PushToRemote.call_args_list |should| equal_to([
+                call(['1'], []), call(['3'], [])
+                ])
+
+    def it_does_nothing_without_batching(self):
+        self.local.pushBatch = 0
+        _PushInBatches(self.local, self.outgoings, self.events) |should| \
+                equal_to(0)
+        self.local.PushToRemote.called |should| equal_to(False)
+
+    def it_does_nothing_for_small_pushes(self):
+        _PushInBatches(self.local, self.outgoings[:2], self.events)
+        self.local.PushToRemote.called |should| equal_to(False)
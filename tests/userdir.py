@@ -0,0 +1,48 @@
+
+import os
+import sys
+import subprocess
+from mock import patch
+from should_dsl import should
+from synchg.userdir import UserDirectory
+
+# Keep pep8 happy
+equal_to = None
+
+Root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def ImportedBy(module):
+    ''' Gets the modules that importing a module in a new process imports '''
+    return subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, {0}; print " ".join(sys.modules)'.format(module)
+            ], cwd=Root).split()
+
+
+class TestUserDirectory(object):
+    @patch.dict(os.environ, {'XDG_CONFIG_HOME': '/xdg'})
+    @patch('sys.platform', 'linux2')
+    def it_follows_xdg_config_home(self):
+        UserDirectory() |should| equal_to('/xdg/synchg')
+
+    @patch('sys.platform', 'darwin')
+    def it_uses_application_support_on_mac(self):
+        UserDirectory() |should| equal_to(os.path.expanduser(
+                '~/Library/Application Support/synchg'
+                ))
+
+
+class TestLazyImports(object):
+    def it_does_not_import_sync_with_package(self):
+        ('synchg.sync' in ImportedBy('synchg')) |should| equal_to(False)
+
+    def it_does_not_import_sync_with_script(self):
+        imported = ImportedBy('synchg.script')
+        ('synchg.sync' in imported) |should| equal_to(False)
+        ('clint' in imported) |should| equal_to(False)
+
+    def it_imports_optional_modules_when_used(self):
+        imported = ImportedBy('synchg.sync')
+        ('synchg.metrics' in imported) |should| equal_to(False)
+        ('synchg.trace' in imported) |should| equal_to(False)